@@ -12,6 +12,7 @@ import { useLocation } from './hooks/useLocation';
 
 export interface AnalysisResult {
   id: string;
+  index: number; // position in the uploaded batch
   originalImage: string;
   vesselMap: string;
   binaryVesselMap: string;
@@ -24,6 +25,32 @@ export interface AnalysisResult {
   stage3Result?: string;
 }
 
+const API_BASE_URL = 'http://localhost:5000';
+
+function toAnalysisResult(result: any, index: number, batchId: number): AnalysisResult {
+  // Compact results omit the original and carry the preview's mimetype
+  const types = result.artifact_types || {};
+  const dataUri = (name: string) =>
+    `data:${types[name] || 'image/png'};base64,${result[name]}`;
+
+  return {
+    id: `result-${batchId}-${index}`,
+    index,
+    originalImage: result.original_image
+      ? dataUri('original_image')
+      : `${API_BASE_URL}${result.artifact_urls.original}`,
+    vesselMap: dataUri('vessel_map'),
+    binaryVesselMap: dataUri('binary_vessel_map'),
+    grade: result.classification.grade,
+    severity: result.classification.severity,
+    confidence: result.classification.confidence * 100,
+    processingTime: result.processing_time,
+    stage1Result: result.classification.stage1_result,
+    stage2Result: result.classification.stage2_result,
+    stage3Result: result.classification.stage3_result
+  };
+}
+
 export default function App() {
   const [results, setResults] = useState<AnalysisResult[]>([]);
   const [isAnalyzing, setIsAnalyzing] = useState(false);
@@ -31,39 +58,61 @@ export default function App() {
 
   const handleAnalysis = async (uploadedImages: File[]) => {
     setIsAnalyzing(true);
+    setResults([]);
 
     try {
       const formData = new FormData();
       uploadedImages.forEach(file => formData.append('images', file));
+      formData.append('artifacts', 'compact');
 
-      const response = await fetch('http://localhost:5000/api/predict', {
+      // Submit a background job, then render each image as soon as the
+      // backend streams its result back (NDJSON, one message per line)
+      const submitResponse = await fetch(`${API_BASE_URL}/api/jobs`, {
         method: 'POST',
         body: formData
       });
+      const job = await submitResponse.json();
+
+      if (!submitResponse.ok || !job.success) {
+        console.error('Analysis failed:', job.error);
+        alert(`Analysis failed: ${job.error || 'Unknown error'}. Please try again.`);
+        return;
+      }
+
+      const streamResponse = await fetch(`${API_BASE_URL}${job.stream_url}`);
+      if (!streamResponse.body) {
+        throw new Error('Streaming responses are not supported');
+      }
+
+      const batchId = Date.now();
+      const reader = streamResponse.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop() ?? '';
+
+        for (const line of lines) {
+          if (!line.trim()) continue;
+          const message = JSON.parse(line);
 
-      const data = await response.json();
-
-      if (data.success) {
-        const analysisResults: AnalysisResult[] = data.results.map((result: any, index: number) => {
-          return {
-            id: `result-${Date.now()}-${index}`,
-            originalImage: `data:image/png;base64,${result.original_image}`,
-            vesselMap: `data:image/png;base64,${result.vessel_map}`,
-            binaryVesselMap: `data:image/png;base64,${result.binary_vessel_map}`,
-            grade: result.classification.grade,
-            severity: result.classification.severity,
-            confidence: result.classification.confidence * 100,
-            processingTime: result.processing_time,
-            stage1Result: result.classification.stage1_result,
-            stage2Result: result.classification.stage2_result,
-            stage3Result: result.classification.stage3_result
-          };
-        });
-
-        setResults(analysisResults);
-      } else {
-        console.error('Analysis failed:', data.error);
-        alert(`Analysis failed: ${data.error || 'Unknown error'}. Please try again.`);
+          if (message.event === 'result') {
+            if (message.result.error) {
+              console.error(`Analysis failed for ${message.result.image_id}:`, message.result.error);
+              continue;
+            }
+            const analysisResult = toAnalysisResult(message.result, message.index, batchId);
+            setResults(prev => [...prev, analysisResult].sort((a, b) => a.index - b.index));
+          } else if (message.event === 'done' && message.status === 'failed') {
+            console.error('Analysis failed:', message.error);
+            alert(`Analysis failed: ${message.error || 'Unknown error'}. Please try again.`);
+          }
+        }
       }
     } catch (error) {
       console.error('Error calling backend:', error);
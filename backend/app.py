@@ -1,19 +1,47 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context, url_for
 from flask_cors import CORS
-import cv2
-import numpy as np
-import base64
+import hmac
+import json
+import os
 import time
+from functools import wraps
 import torch
 
+from models.memory import memory_report, process_memory
 from models.model_loader import ModelManager
-from services.vessel_inference import predict_vessel_segmentation
-from services.cascade_inference import cascade_classify
-from services.preprocessing import preprocess_for_classification, create_vessel_visualization
-from config import MAX_CONTENT_LENGTH
+from models.performance import configure_backends
+from services.admission import AdmissionController, AdmissionRejected, Deadline, serving_plan
+from services.analysis import PIPELINE_VERSION, ImageAnalyzer
+from services.artifacts import ARTIFACT_NAMES, ArtifactStore
+from services.batch_scheduler import MicroBatchScheduler
+from services.cascade_inference import SpeculativeCascade
+from services.jobs import JobManager, JobQueueFull
+from services.profiling import PROFILER, ProfilerBusy
+from services.metrics import (
+    REGISTRY, Gauge, REQUESTS, REQUEST_SECONDS, REQUESTS_IN_FLIGHT, REQUEST_BYTES
+)
+from services.prediction_cache import PredictionCache, model_fingerprint
+from services.quality import QualityGate
+from services.stage_workers import STAGE_TIERS, stage_worker_pool, start_stage_workers
+from services.uploads import MultipartImageStream
+from services.vessel_inference import VesselSegmenter
+from config import (
+    MAX_CONTENT_LENGTH, MODEL_PATHS, STAGE1_THRESHOLD, CASCADE_BATCH_SIZE,
+    BATCH_SCHEDULER_ENABLED, BATCH_SCHEDULER_MAX_BATCH_SIZE, BATCH_SCHEDULER_MAX_WAIT_MS,
+    CACHE_ENABLED, CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_DIR, CACHE_STORE_ARTIFACTS,
+    MODEL_BACKGROUND_LOAD, MODEL_WARMUP, JOB_WORKERS, JOB_MAX_QUEUED, JOB_TTL_SECONDS,
+    ARTIFACT_PREVIEW_MAX_SIDE, ARTIFACT_PREVIEW_FORMAT, ARTIFACT_PREVIEW_QUALITY,
+    ARTIFACT_STORE_MAX_BYTES, PIPELINE_DECODE_WORKERS, PIPELINE_ENCODE_WORKERS, PIPELINE_QUEUE_SIZE,
+    ADMIN_TOKEN, PROFILE_DIR, INFERENCE_PROFILE, DEVICE_PREPROCESSING, REDUCED_DECODE,
+    VESSEL_WORKING_SIZE, VESSEL_TILE_SIZE, VESSEL_TILE_OVERLAP, VESSEL_TILE_BATCH_SIZE,
+    INFERENCE_CONCURRENCY, TORCH_THREADS, ADMISSION_MAX_QUEUED, ADMISSION_PER_CLIENT_LIMIT,
+    ADMISSION_CLIENT_HEADER, ADMISSION_RETRY_AFTER, REQUEST_TIMEOUT_SECONDS, FLASK_DEBUG,
+    SERVER_WORKERS, WEIGHT_SHARING, QUALITY_GATE, QUALITY_GATE_THRESHOLDS, UPLOAD_MAX_IMAGE_BYTES,
+    CASCADE_DEPLOYMENT, STAGE_WORKERS, STAGE_WORKER_MAX_BATCH, STAGE_WORKER_TIMEOUT_SECONDS,
+    SPECULATIVE_CASCADE
+)
 
-torch.backends.cudnn.deterministic = True
-torch.backends.cudnn.benchmark = False
+configure_backends(INFERENCE_PROFILE)
 torch.manual_seed(42)
 if torch.cuda.is_available():
     torch.cuda.manual_seed_all(42)
@@ -22,98 +50,561 @@ app = Flask(__name__)
 CORS(app)
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 
-model_manager = ModelManager()
-model_manager.load_all_models()
+vessel_segmenter = VesselSegmenter(
+    working_size=VESSEL_WORKING_SIZE,
+    tile_size=VESSEL_TILE_SIZE,
+    overlap=VESSEL_TILE_OVERLAP,
+    tile_batch_size=VESSEL_TILE_BATCH_SIZE
+)
 
+if CASCADE_DEPLOYMENT not in ('local', 'disaggregated'):
+    raise ValueError(
+        f"Unknown CASCADE_DEPLOYMENT '{CASCADE_DEPLOYMENT}', expected 'local' or 'disaggregated'"
+    )
 
-def encode_image_to_base64(image_rgb):
-    image_bgr = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2BGR)
-    success, buffer = cv2.imencode('.png', image_bgr)
-    if not success:
-        raise ValueError("Failed to encode image")
-    return base64.b64encode(buffer).decode('utf-8')
+stage_workers = None
+if CASCADE_DEPLOYMENT == 'disaggregated':
+    # Fork the stage workers before this process starts any thread; under
+    # gunicorn the master has already started them (see gunicorn.conf.py)
+    stage_workers = stage_worker_pool() or start_stage_workers(
+        STAGE_WORKERS,
+        manager_options={"vessel_input_size": vessel_segmenter.model_input_size},
+        max_batch_size=STAGE_WORKER_MAX_BATCH,
+        response_timeout=STAGE_WORKER_TIMEOUT_SECONDS,
+        warmup=MODEL_WARMUP
+    )
+    # This process only preprocesses and routes; no model is loaded here
+    model_manager = ModelManager(vessel_input_size=vessel_segmenter.model_input_size, device='cpu')
+else:
+    model_manager = ModelManager(vessel_input_size=vessel_segmenter.model_input_size)
+    if MODEL_BACKGROUND_LOAD:
+        model_manager.start_loading(warmup=MODEL_WARMUP)
+    else:
+        model_manager.load_all_models(warmup=MODEL_WARMUP)
+
+
+def models_ready():
+    if stage_workers is not None:
+        return stage_workers.ready()
+    return model_manager.models_loaded()
+
+
+batch_scheduler = None
+if stage_workers is not None:
+    # The stage workers batch requests from every server worker themselves
+    batch_scheduler = stage_workers
+elif BATCH_SCHEDULER_ENABLED:
+    batch_scheduler = MicroBatchScheduler(
+        model_manager,
+        max_batch_size=BATCH_SCHEDULER_MAX_BATCH_SIZE,
+        max_wait_ms=BATCH_SCHEDULER_MAX_WAIT_MS
+    )
+
+prediction_cache = None
+if CACHE_ENABLED:
+    prediction_cache = PredictionCache(
+        # Every setting that changes the predictions for the same upload bytes
+        model_fingerprint(
+            MODEL_PATHS, model_manager.backend, model_manager.precision, INFERENCE_PROFILE,
+            f"pipeline={PIPELINE_VERSION}",
+            f"vessel={VESSEL_WORKING_SIZE}/{VESSEL_TILE_SIZE}/{VESSEL_TILE_OVERLAP}",
+            f"reduced_decode={REDUCED_DECODE}",
+            f"device_preprocessing={DEVICE_PREPROCESSING and model_manager.device.type == 'cuda'}"
+        ),
+        max_entries=CACHE_MAX_ENTRIES,
+        max_bytes=CACHE_MAX_BYTES,
+        disk_dir=CACHE_DIR
+    )
+
+artifact_store = ArtifactStore(max_bytes=ARTIFACT_STORE_MAX_BYTES)
+
+quality_gate = QualityGate(QUALITY_GATE, **QUALITY_GATE_THRESHOLDS)
+
+if SPECULATIVE_CASCADE not in ('off', 'request', 'always'):
+    raise ValueError(
+        f"Unknown SPECULATIVE_CASCADE '{SPECULATIVE_CASCADE}', expected 'off', 'request' or 'always'"
+    )
+speculative_cascade = SpeculativeCascade() if SPECULATIVE_CASCADE != 'off' else None
+
+analyzer = ImageAnalyzer(
+    model_manager,
+    stage1_threshold=STAGE1_THRESHOLD,
+    cascade_batch_size=CASCADE_BATCH_SIZE,
+    batch_scheduler=batch_scheduler,
+    prediction_cache=prediction_cache,
+    cache_artifacts=CACHE_STORE_ARTIFACTS,
+    artifact_store=artifact_store,
+    preview_max_side=ARTIFACT_PREVIEW_MAX_SIDE,
+    preview_format=ARTIFACT_PREVIEW_FORMAT,
+    preview_quality=ARTIFACT_PREVIEW_QUALITY,
+    decode_workers=PIPELINE_DECODE_WORKERS,
+    encode_workers=PIPELINE_ENCODE_WORKERS,
+    queue_size=PIPELINE_QUEUE_SIZE,
+    device_preprocessing=DEVICE_PREPROCESSING and model_manager.device.type == 'cuda',
+    reduced_decode=REDUCED_DECODE,
+    vessel_segmenter=vessel_segmenter,
+    quality_gate=quality_gate,
+    speculative_cascade=speculative_cascade
+)
+
+serving = serving_plan(
+    model_manager.device.type, (os.cpu_count() or 1) // max(1, SERVER_WORKERS),
+    # Disaggregated, enough analyses run at once to keep every stage worker busy
+    INFERENCE_CONCURRENCY or (sum(STAGE_WORKERS.values()) if stage_workers is not None else 0),
+    TORCH_THREADS
+)
+torch.set_num_threads(serving["torch_threads"])
+admission = AdmissionController(
+    max_concurrent=serving["concurrency"],
+    max_queued=ADMISSION_MAX_QUEUED,
+    per_client_limit=ADMISSION_PER_CLIENT_LIMIT,
+    retry_after=ADMISSION_RETRY_AFTER
+)
+
+job_manager = JobManager(
+    analyzer, max_workers=JOB_WORKERS, max_queued=JOB_MAX_QUEUED, ttl_seconds=JOB_TTL_SECONDS,
+    admission=admission
+)
+
+
+def collect_runtime_metrics():
+    """Gauges read at scrape time from state the services already keep"""
+    load_seconds = Gauge(
+        'dr_model_load_duration_seconds', 'Duration of the last load of each model', ['model']
+    )
+    for name, seconds in list(model_manager.load_durations.items()):
+        load_seconds.set(seconds, model=name)
+
+    loaded = Gauge('dr_model_loaded', 'Whether each model is currently resident', ['model'])
+    for name, state in list(model_manager.model_states.items()):
+        loaded.set(1 if state == 'ready' else 0, model=name)
+
+    stage_queued = Gauge('dr_pipeline_queued', 'Images waiting for each pipeline stage', ['stage'])
+    stage_active = Gauge('dr_pipeline_active', 'Work units running in each pipeline stage', ['stage'])
+    for stage, stats in analyzer.pipeline_stats().items():
+        stage_queued.set(stats["queued"], stage=stage)
+        stage_active.set(stats["active"], stage=stage)
+
+    admission_stats = admission.stats()
+    admission_active = Gauge('dr_admission_active', 'Analyses holding an inference slot')
+    admission_active.set(admission_stats["active"])
+    admission_queued = Gauge('dr_admission_queued', 'Requests waiting for an inference slot')
+    admission_queued.set(admission_stats["queued"])
+
+    process_bytes = Gauge(
+        'dr_process_memory_bytes', 'Resident memory of this worker: rss, pss, unique and shared', ['kind']
+    )
+    for kind, value in (process_memory() or {}).items():
+        process_bytes.set(value, kind=kind)
+
+    collected = [
+        load_seconds, loaded, stage_queued, stage_active, admission_active, admission_queued,
+        process_bytes
+    ]
+    if stage_workers is not None:
+        worker_stats = stage_workers.stats()
+        tier_ready = Gauge(
+            'dr_stage_workers_ready', 'Stage worker processes with their models loaded', ['tier']
+        )
+        tier_queued = Gauge(
+            'dr_stage_worker_queued', 'Requests waiting for each stage worker tier', ['tier']
+        )
+        for tier in STAGE_TIERS:
+            stats = worker_stats["tiers"][tier]
+            tier_ready.set(sum(w["state"] == 'ready' for w in stats["workers"]), tier=tier)
+            if stats["queued_requests"] is not None:
+                tier_queued.set(stats["queued_requests"], tier=tier)
+        collected += [tier_ready, tier_queued]
+    return collected
+
+
+REGISTRY.add_collector(collect_runtime_metrics)
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc()
+    if request.content_length:
+        REQUEST_BYTES.observe(request.content_length, endpoint=request.endpoint or 'unknown')
+
+
+@app.after_request
+def count_request(response):
+    REQUESTS.inc(endpoint=request.endpoint or 'unknown', status=response.status_code)
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exception=None):
+    # Runs after streamed bodies finish, so job streams count as in flight
+    started = g.pop('request_started', None)
+    if started is None:
+        return
+    REQUESTS_IN_FLIGHT.dec()
+    REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=request.endpoint or 'unknown')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
 
 
 @app.route('/api/health', methods=['GET'])
 def health():
-    return jsonify({
+    status = {
         "status": "healthy",
-        "models_loaded": model_manager.models_loaded(),
-        "device": str(model_manager.device)
-    })
+        "models_loaded": models_ready(),
+        "cascade_deployment": CASCADE_DEPLOYMENT,
+        "model_states": model_manager.model_states,
+        "load_errors": model_manager.load_errors,
+        "load_durations": model_manager.load_durations,
+        "device": str(model_manager.device),
+        "backend": model_manager.backend,
+        "precision": model_manager.model_precisions,
+        "profile": model_manager.profile,
+        "compiled_models": sorted(model_manager.compiled),
+        "model_residency": model_manager.residency.stats()
+    }
+    if stage_workers is not None:
+        status["stage_workers"] = stage_workers.stats()
+    elif batch_scheduler is not None:
+        status["batch_scheduler"] = batch_scheduler.stats()
+    if prediction_cache is not None:
+        status["prediction_cache"] = prediction_cache.stats()
+    status["pipeline"] = analyzer.pipeline_stats()
+    status["vessel_segmentation"] = {
+        "working_size": vessel_segmenter.working_size,
+        "tile_size": vessel_segmenter.tile_size or None,
+        "tile_overlap": vessel_segmenter.overlap if vessel_segmenter.tile_size else None
+    }
+    status["admission"] = {**admission.stats(), "torch_threads": torch.get_num_threads()}
+    status["memory"] = {
+        "weight_sharing": WEIGHT_SHARING,
+        "preloaded_models": sorted(model_manager.preloaded)
+    }
+    # Walking every mapping in /proc/self/smaps is too slow for each probe
+    if request.args.get('memory', 'false').lower() in ('1', 'true'):
+        status["memory"].update(memory_report(model_manager.resident_models()))
+    status["quality_gate"] = {"mode": quality_gate.mode, **QUALITY_GATE_THRESHOLDS}
+    status["speculative_cascade"] = SPECULATIVE_CASCADE
+    status["jobs"] = job_manager.stats()
+    status["artifact_store"] = artifact_store.stats()
+    return jsonify(status)
+
+
+@app.route('/api/ready', methods=['GET'])
+def ready():
+    if not models_ready():
+        return jsonify({"ready": False, "model_states": model_manager.model_states}), 503
+    return jsonify({"ready": True})
+
+
+def artifact_mode(fields=None):
+    """Return True for compact artifacts, False for full, or None if the value is invalid"""
+    form = request.form if fields is None else fields
+    mode = (form.get('artifacts') or request.args.get('artifacts') or 'full').lower()
+    if mode not in ('full', 'compact'):
+        return None
+    return mode == 'compact'
+
+
+def speculative_mode(fields=None):
+    """Return True to speculate the cascade, False not to, or None if the latency value is invalid"""
+    form = request.form if fields is None else fields
+    latency = (form.get('latency') or request.args.get('latency') or 'normal').lower()
+    if latency not in ('normal', 'low'):
+        return None
+    return SPECULATIVE_CASCADE == 'always' or (SPECULATIVE_CASCADE == 'request' and latency == 'low')
+
+
+def not_ready_response():
+    response = jsonify({"success": False, "error": "Models are still loading"})
+    response.status_code = 503
+    response.headers['Retry-After'] = '5'
+    return response
+
+
+def client_id():
+    """Key for per-client limits: the configured proxy header, else the peer address"""
+    if ADMISSION_CLIENT_HEADER:
+        value = request.headers.get(ADMISSION_CLIENT_HEADER, '')
+        # X-Forwarded-For style lists start with the original client
+        value = value.split(',')[0].strip()
+        if value:
+            return value
+    return request.remote_addr
+
+
+def request_deadline():
+    """Deadline for this request; clients may shorten the server limit with X-Request-Timeout"""
+    seconds = REQUEST_TIMEOUT_SECONDS
+    try:
+        requested = float(request.headers.get('X-Request-Timeout', ''))
+    except ValueError:
+        requested = None
+    if requested is not None and requested > 0:
+        seconds = min(seconds, requested) if seconds else requested
+    return Deadline(seconds, environ=request.environ)
+
+
+def rejected_response(error):
+    response = jsonify({"success": False, "error": str(error), "reason": error.reason})
+    response.status_code = error.status
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
+@app.errorhandler(413)
+def request_too_large(error):
+    limit = app.config['MAX_CONTENT_LENGTH'] / (1024 * 1024)
+    return jsonify({"success": False, "error": f"Request exceeds the {limit:g} MB limit"}), 413
+
+
+def oversized_error():
+    return f"Image exceeds the {UPLOAD_MAX_IMAGE_BYTES / (1024 * 1024):g} MB limit"
+
+
+def abandoned_response(deadline, completed, received):
+    return jsonify({
+        "success": False,
+        "error": f"Request abandoned ({deadline.reason}) after {completed} of {received} images"
+    }), 504
 
 
 @app.route('/api/predict', methods=['POST'])
 def predict():
     start_time = time.time()
 
-    if 'images' not in request.files:
-        return jsonify({"success": False, "error": "No images provided"}), 400
+    if not models_ready():
+        return not_ready_response()
 
-    files = request.files.getlist('images')
-    if len(files) == 0:
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
         return jsonify({"success": False, "error": "No images provided"}), 400
 
-    results = []
-    for idx, file in enumerate(files):
-        try:
-            image_bytes = file.read()
-            nparr = np.frombuffer(image_bytes, np.uint8)
-            image_bgr = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-            if image_bgr is None:
-                results.append({
-                    "image_id": file.filename,
-                    "error": "Failed to decode image"
-                })
-                continue
-
-            image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
-
-            vessel_mask = predict_vessel_segmentation(
-                image_rgb, model_manager.vessel_model, model_manager.device
-            )
-
-            vessel_viz = create_vessel_visualization(image_rgb, vessel_mask)
-            vessel_map_b64 = encode_image_to_base64(vessel_viz)
-
-            vessel_mask_rgb = cv2.cvtColor(vessel_mask * 255, cv2.COLOR_GRAY2RGB)
-            binary_vessel_b64 = encode_image_to_base64(vessel_mask_rgb)
-
-            original_b64 = encode_image_to_base64(image_rgb)
-
-            vessel_input, green_input = preprocess_for_classification(image_rgb, vessel_mask)
-            vessel_input = vessel_input.to(model_manager.device)
-            green_input = green_input.to(model_manager.device)
-
-            classification_result = cascade_classify(
-                vessel_input, green_input, model_manager, stage1_threshold=0.30
-            )
-
-            results.append({
-                "image_id": file.filename,
-                "original_image": original_b64,
-                "vessel_map": vessel_map_b64,
-                "binary_vessel_map": binary_vessel_b64,
-                "classification": classification_result,
-                "processing_time": time.time() - start_time
-            })
-
-        except Exception as e:
-            results.append({
-                "image_id": file.filename,
-                "error": str(e)
-            })
+    # The deadline covers the upload too: the parser stops reading once it expires
+    deadline = request_deadline()
+    # Images are handed to the analyzer as their parts arrive instead of
+    # buffering the whole body; a slot is only taken once the first is complete
+    upload = MultipartImageStream(request.stream, boundary, max_part_bytes=UPLOAD_MAX_IMAGE_BYTES,
+                                  deadline=deadline)
+    if upload.peek() is None:
+        if deadline.reason is not None:
+            return abandoned_response(deadline, 0, 0)
+        error = f"Malformed upload: {upload.error}" if upload.error else "No images provided"
+        return jsonify({"success": False, "error": error}), 400
+
+    compact = artifact_mode(upload.fields)
+    if compact is None:
+        return jsonify({"success": False, "error": "artifacts must be 'full' or 'compact'"}), 400
+    speculative = speculative_mode(upload.fields)
+    if speculative is None:
+        return jsonify({"success": False, "error": "latency must be 'normal' or 'low'"}), 400
+
+    try:
+        with admission.admit(client_id(), deadline) as queue_time:
+            service_started = time.time()
+            # Stops feeding images once the deadline passes or the client goes away
+            results_by_index = dict(analyzer.analyze(
+                deadline.guard(upload), compact=compact, speculative=speculative
+            ))
+            service_time = time.time() - service_started
+    except AdmissionRejected as e:
+        return rejected_response(e)
+
+    if deadline.reason is not None:
+        return abandoned_response(deadline, len(results_by_index), upload.count)
+    if upload.error is not None:
+        return jsonify({"success": False, "error": f"Malformed upload: {upload.error}"}), 400
+
+    for index, filename in upload.oversized.items():
+        results_by_index[index] = {"image_id": filename, "error": oversized_error()}
+    results = [results_by_index[index] for index in sorted(results_by_index)]
 
     total_time = time.time() - start_time
 
-    return jsonify({
+    response = jsonify({
         "success": True,
         "results": results,
         "total_processing_time": total_time,
+        "queue_time": queue_time,
+        "service_time": service_time,
         "num_images": len(results)
     })
+    response.headers['Server-Timing'] = (
+        f"queue;dur={queue_time * 1000:.1f}, service;dur={service_time * 1000:.1f}"
+    )
+    return response
+
+
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    if not models_ready():
+        return not_ready_response()
+
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return jsonify({"success": False, "error": "No images provided"}), 400
+
+    # Same parser as /api/predict; the job runs after this request ends, so
+    # the whole body is read here, within the request's deadline
+    deadline = request_deadline()
+    upload = MultipartImageStream(request.stream, boundary, max_part_bytes=UPLOAD_MAX_IMAGE_BYTES,
+                                  deadline=deadline)
+    images = list(upload)
+    if deadline.reason is not None:
+        return abandoned_response(deadline, 0, upload.count)
+    if upload.error is not None:
+        return jsonify({"success": False, "error": f"Malformed upload: {upload.error}"}), 400
+    if not images:
+        return jsonify({"success": False, "error": "No images provided"}), 400
+
+    compact = artifact_mode(upload.fields)
+    if compact is None:
+        return jsonify({"success": False, "error": "artifacts must be 'full' or 'compact'"}), 400
+
+    try:
+        job = job_manager.submit(images, compact=compact, errors={
+            index: {"image_id": filename, "error": oversized_error()}
+            for index, filename in upload.oversized.items()
+        })
+    except JobQueueFull as e:
+        response = jsonify({"success": False, "error": str(e)})
+        response.status_code = 503
+        response.headers['Retry-After'] = '10'
+        return response
+
+    return jsonify({
+        "success": True,
+        "job_id": job.id,
+        "num_images": job.total,
+        "status_url": url_for('job_status', job_id=job.id),
+        "stream_url": url_for('job_stream', job_id=job.id)
+    }), 202
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Unknown job"}), 404
+
+    status = {"success": True, "job_id": job.id, **job.progress()}
+    if request.args.get('results', 'true').lower() == 'true':
+        status["results"] = job.ordered_results()
+    return jsonify(status)
+
+
+@app.route('/api/jobs/<job_id>/stream', methods=['GET'])
+def job_stream(job_id):
+    """Stream per-image results as NDJSON, or as Server-Sent Events when requested"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Unknown job"}), 404
+
+    use_sse = (request.args.get('format') == 'sse'
+               or 'text/event-stream' in request.headers.get('Accept', ''))
+
+    def format_event(event, payload):
+        data = json.dumps(payload)
+        if use_sse:
+            return f"event: {event}\ndata: {data}\n\n"
+        return json.dumps({"event": event, **payload}) + "\n"
+
+    def generate():
+        offset = 0
+        while True:
+            events, done = job.wait_for_events(offset, timeout=15)
+            for index, result in events:
+                yield format_event("result", {"index": index, "total": job.total, "result": result})
+            offset += len(events)
+            if done and not events:
+                yield format_event("done", {"job_id": job.id, **job.progress()})
+                return
+            if not events:
+                # Keep idle connections from being closed by proxies
+                yield ": keep-alive\n\n" if use_sse else "\n"
+
+    mimetype = 'text/event-stream' if use_sse else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/results/<result_id>/<artifact>', methods=['GET'])
+def result_artifact(result_id, artifact):
+    """Serve a full-resolution artifact of a compact-mode result"""
+    if artifact not in ARTIFACT_NAMES:
+        return jsonify({"success": False, "error": f"Unknown artifact '{artifact}'"}), 404
+
+    # Artifacts of a result never change, so the id doubles as a strong validator
+    etag = f"{result_id}-{artifact}"
+    if etag in request.if_none_match and artifact_store.contains(result_id):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    rendered = artifact_store.render(result_id, artifact)
+    if rendered is None:
+        return jsonify({"success": False, "error": "Unknown or expired result"}), 404
+
+    data, mimetype = rendered
+    response = Response(data, mimetype=mimetype)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, max-age=3600, immutable'
+    return response
+
+
+def require_admin(view):
+    """Allow the request only with the configured admin bearer token; 404 when none is set"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if ADMIN_TOKEN is None:
+            return jsonify({"success": False, "error": "Not found"}), 404
+        header = request.headers.get('Authorization', '')
+        token = header[len('Bearer '):] if header.startswith('Bearer ') else ''
+        if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+            return jsonify({"success": False, "error": "Unauthorized"}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@app.route('/api/admin/profiler', methods=['GET'])
+@require_admin
+def profiler_status():
+    return jsonify({"success": True, **PROFILER.status()})
+
+
+@app.route('/api/admin/profiler', methods=['POST'])
+@require_admin
+def arm_profiler():
+    """Profile the next `requests` analysis requests and/or those starting within `seconds`"""
+    options = request.get_json(silent=True) or {}
+    try:
+        max_requests = int(options['requests']) if options.get('requests') is not None else None
+        seconds = float(options['seconds']) if options.get('seconds') is not None else None
+        top_k = int(options.get('top_k', 30))
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "error": "requests, seconds and top_k must be numbers"}), 400
+
+    try:
+        capture_id = PROFILER.arm(
+            PROFILE_DIR, max_requests=max_requests, seconds=seconds, top_k=top_k,
+            record_shapes=bool(options.get('record_shapes', False))
+        )
+    except ProfilerBusy as e:
+        return jsonify({"success": False, "error": str(e)}), 409
+
+    return jsonify({"success": True, "capture_id": capture_id, **PROFILER.status()}), 202
+
+
+@app.route('/api/admin/profiler', methods=['DELETE'])
+@require_admin
+def disarm_profiler():
+    PROFILER.disarm()
+    return jsonify({"success": True, **PROFILER.status()})
 
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # Development server; production runs under gunicorn -c gunicorn.conf.py app:app
+    app.run(debug=FLASK_DEBUG, threaded=True, host='0.0.0.0', port=5000)
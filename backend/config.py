@@ -33,10 +33,180 @@ if os.path.exists(r'c:\Users\gmaer\Documents\VDMDR'):
         'stage3b': os.path.join(MODELS_DIR, '3b.pth')
     }
 
+# Inference precision on CPU: 'fp32', 'int8' (dynamic INT8 classifiers, static INT8
+# vessel model when calibration images are given) or 'bf16' (autocast, if the CPU supports it)
+MODEL_PRECISION = os.getenv('MODEL_PRECISION', 'fp32')
+QUANT_CALIBRATION_DIR = os.getenv('QUANT_CALIBRATION_DIR') or None
+
+# Inference backend: 'torch' (eager checkpoints), or graphs prebuilt with
+# `python -m tools.export_models`: 'onnx' (ONNX Runtime) or 'torchscript'
+MODEL_BACKEND = os.getenv('MODEL_BACKEND', 'torch')
+EXPORT_DIR = os.getenv('EXPORT_DIR', os.path.join(MODELS_DIR, 'exported'))
+# ONNX Runtime intra-op threads per session; 0 gives each of the SERVER_WORKERS
+# processes an equal share of the cores so they do not oversubscribe the CPU
+ORT_INTRA_OP_THREADS = int(os.getenv('ORT_INTRA_OP_THREADS', '0'))
+ORT_INTER_OP_THREADS = int(os.getenv('ORT_INTER_OP_THREADS', '1'))
+
+# Memory budget (MB) for resident models; least recently used stage 2/3a/3b models
+# are evicted to stay within it (vessel and stage 1 are pinned). 0 disables eviction
+MODEL_MEMORY_BUDGET_MB = float(os.getenv('MODEL_MEMORY_BUDGET_MB', '0'))
+# Checkpoints are converted once to bare state dicts here for fast mmap'd (re)loading
+WEIGHTS_CACHE_DIR = os.getenv('WEIGHTS_CACHE_DIR', os.path.join(MODELS_DIR, 'converted'))
+
+# Startup: load models in the background so health checks answer immediately,
+# and optionally run a dummy batch through each model before reporting ready
+MODEL_BACKGROUND_LOAD = os.getenv('MODEL_BACKGROUND_LOAD', 'true').lower() == 'true'
+MODEL_WARMUP = os.getenv('MODEL_WARMUP', 'false').lower() == 'true'
+
+# Inference profile: 'deterministic' (eager models, deterministic cuDNN; use for
+# audit runs) or 'performance' (channels_last + torch.compile for the fixed
+# 1024x1024 / 288x288 inputs and autotuned cuDNN; every compiled model is warmed
+# before it serves). Compiled kernels are cached in COMPILE_CACHE_DIR. Compare the
+# two with `python -m tools.precision_parity --profile performance`
+INFERENCE_PROFILE = os.getenv('INFERENCE_PROFILE', 'deterministic')
+COMPILE_MODE = os.getenv('COMPILE_MODE', 'default')
+COMPILE_CACHE_DIR = os.getenv('COMPILE_CACHE_DIR', os.path.join(MODELS_DIR, 'compiled'))
+
+# Vessel segmentation memory/latency trade-offs. VESSEL_WORKING_SIZE runs the
+# U-Net below 1024x1024 (e.g. 768 or 512) and upsamples its probabilities, for
+# lower memory and latency on CPU nodes at some mask fidelity. VESSEL_TILE_SIZE
+# (0 = off) segments overlapping tiles, VESSEL_TILE_BATCH_SIZE at a time, which
+# bounds peak activation memory; seams are blended over VESSEL_TILE_OVERLAP px.
+# Sizes must be multiples of 16
+VESSEL_WORKING_SIZE = int(os.getenv('VESSEL_WORKING_SIZE', '1024'))
+VESSEL_TILE_SIZE = int(os.getenv('VESSEL_TILE_SIZE', '0'))
+VESSEL_TILE_OVERLAP = int(os.getenv('VESSEL_TILE_OVERLAP', '64'))
+VESSEL_TILE_BATCH_SIZE = int(os.getenv('VESSEL_TILE_BATCH_SIZE', '4'))
+
+# Production serving (gunicorn -c gunicorn.conf.py app:app) and admission control.
+# At most INFERENCE_CONCURRENCY analyses run at once (0 derives it from the
+# device and cores: 2 on GPU, one per 8 cores on CPU) and TORCH_THREADS (0 =
+# cores / concurrency on CPU) intra-op threads each. Up to ADMISSION_MAX_QUEUED
+# more /api/predict requests wait in arrival order; beyond that, and for
+# clients with ADMISSION_PER_CLIENT_LIMIT requests already running or waiting
+# (0 = no limit), requests are answered 503 / 429 with Retry-After. Clients are
+# keyed by remote address, or by ADMISSION_CLIENT_HEADER behind a proxy.
+# Requests stop at REQUEST_TIMEOUT_SECONDS (a client may ask for less with
+# X-Request-Timeout) or when the client disconnects, whether queued or running
+INFERENCE_CONCURRENCY = int(os.getenv('INFERENCE_CONCURRENCY', '0'))
+TORCH_THREADS = int(os.getenv('TORCH_THREADS', '0'))
+ADMISSION_MAX_QUEUED = int(os.getenv('ADMISSION_MAX_QUEUED', '8'))
+ADMISSION_PER_CLIENT_LIMIT = int(os.getenv('ADMISSION_PER_CLIENT_LIMIT', '2'))
+ADMISSION_CLIENT_HEADER = os.getenv('ADMISSION_CLIENT_HEADER') or None
+ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', '5'))
+REQUEST_TIMEOUT_SECONDS = float(os.getenv('REQUEST_TIMEOUT_SECONDS', '300'))
+# Server worker processes; admission limits and torch threads are per worker,
+# which gets an equal share of the cores. WEIGHT_SHARING decides how workers
+# avoid each holding a private copy of the weights: 'mmap' maps the converted
+# weight files read-only so fp32 eager weights share the page cache; 'preload'
+# has the gunicorn master load every model once before forking, and workers
+# adopt them copy-on-write, which also shares weights that cannot be mapped
+# from the files (int8, fp16, channels_last). Preloading is CPU, torch backend
+# only, and stage models then stay resident whatever MODEL_MEMORY_BUDGET_MB says
+SERVER_WORKERS = int(os.getenv('SERVER_WORKERS', '1'))
+WEIGHT_SHARING = os.getenv('WEIGHT_SHARING', 'mmap')
+# Development server only (python app.py)
+FLASK_DEBUG = os.getenv('FLASK_DEBUG', 'false').lower() == 'true'
+
+# Background jobs (/api/jobs): worker pool size, waiting-job limit and result retention
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '1'))
+JOB_MAX_QUEUED = int(os.getenv('JOB_MAX_QUEUED', '16'))
+JOB_TTL_SECONDS = int(os.getenv('JOB_TTL_SECONDS', '3600'))
+
+# Pipelined analysis: decoding/preprocessing and artifact encoding run on
+# thread pools so they overlap with inference; 0 workers runs a stage inline.
+# The queue size bounds how many images each stage may hold ahead of the next
+PIPELINE_DECODE_WORKERS = int(os.getenv('PIPELINE_DECODE_WORKERS', '2'))
+PIPELINE_ENCODE_WORKERS = int(os.getenv('PIPELINE_ENCODE_WORKERS', '2'))
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '8'))
+# Decode large JPEGs with libjpeg DCT scaling (1/2, 1/4, 1/8) down to the
+# smallest size that still covers the 1024x1024 vessel input; a full decode
+# only happens when full-resolution artifacts are requested. DCT scaling is
+# not the cv2.resize path the models were validated with, so model inputs,
+# and possibly grades, differ for large JPEGs: opt-in only
+REDUCED_DECODE = os.getenv('REDUCED_DECODE', 'false').lower() == 'true'
+# Upload only the green plane (pinned, non-blocking) and resize it on the GPU
+# instead of with OpenCV; inputs stay within one uint8 level of the CPU path.
+# Ignored when no CUDA device is available
+DEVICE_PREPROCESSING = os.getenv('DEVICE_PREPROCESSING', 'false').lower() == 'true'
+
+# Image-quality gate, run on a downscaled copy right after decoding: 'off',
+# 'flag' (results carry a quality assessment) or 'reject' (ungradable images
+# are answered without running any model). An image is ungradable when no
+# round field of view covers enough of the frame or it is off-centre,
+# under/over-exposed or blurred; see services/quality.py for the statistics.
+# Off by default, since 'flag' adds a `quality` field to every result
+QUALITY_GATE = os.getenv('QUALITY_GATE', 'off')
+QUALITY_GATE_THRESHOLDS = {
+    'min_fov_fraction': float(os.getenv('QUALITY_MIN_FOV_FRACTION', '0.25')),
+    'min_circularity': float(os.getenv('QUALITY_MIN_CIRCULARITY', '0.7')),
+    'max_center_offset': float(os.getenv('QUALITY_MAX_CENTER_OFFSET', '0.25')),
+    'min_brightness': float(os.getenv('QUALITY_MIN_BRIGHTNESS', '20')),
+    'max_brightness': float(os.getenv('QUALITY_MAX_BRIGHTNESS', '210')),
+    'max_clipped': float(os.getenv('QUALITY_MAX_CLIPPED', '0.15')),
+    'min_sharpness': float(os.getenv('QUALITY_MIN_SHARPNESS', '3.0'))
+}
+
+# Admin endpoints (/api/admin/*) require `Authorization: Bearer <ADMIN_TOKEN>`
+# and are disabled when no token is set. Profiler captures are written to PROFILE_DIR
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN') or None
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(BASE_DIR, 'profiles'))
+
+# Response artifacts. In compact mode (`artifacts=compact` on a request) the
+# overlay is a lossy preview and full-resolution images are fetched by result id
+ARTIFACT_PREVIEW_MAX_SIDE = int(os.getenv('ARTIFACT_PREVIEW_MAX_SIDE', '1024'))
+ARTIFACT_PREVIEW_FORMAT = os.getenv('ARTIFACT_PREVIEW_FORMAT', 'jpeg')  # jpeg or webp
+ARTIFACT_PREVIEW_QUALITY = int(os.getenv('ARTIFACT_PREVIEW_QUALITY', '85'))
+ARTIFACT_STORE_MAX_BYTES = int(os.getenv('ARTIFACT_STORE_MAX_BYTES', str(256 * 1024 * 1024)))
+
 # Upload configuration
 UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'uploads')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'bmp'}
 MAX_CONTENT_LENGTH = 200 * 1024 * 1024  # 200 MB max file size
+# /api/predict and /api/jobs parse uploads part by part; predict analyzes
+# each image as its part completes and takes an inference slot once the
+# first is in. Image parts over this size are skipped and reported as
+# errors. With the pipeline queue, a predict request holds at most about
+# 2 * PIPELINE_QUEUE_SIZE + 1 decoded images
+UPLOAD_MAX_IMAGE_BYTES = int(os.getenv('UPLOAD_MAX_IMAGE_BYTES', str(50 * 1024 * 1024)))
+
+# Inference configuration
+STAGE1_THRESHOLD = float(os.getenv('STAGE1_THRESHOLD', '0.30'))  # minimum P(DR) to enter stage 2
+CASCADE_BATCH_SIZE = int(os.getenv('CASCADE_BATCH_SIZE', '16'))  # images per cascade forward pass
+# Speculative cascade for urgent single images: stages 1, 2, 3a and 3b start
+# at once (on separate CUDA streams on a GPU) and the unused branches are
+# discarded, trading up to four times the cascade compute for lower latency
+# with the same result. 'off', 'request' (when /api/predict is sent
+# latency=low) or 'always' (every /api/predict image, unbatched)
+SPECULATIVE_CASCADE = os.getenv('SPECULATIVE_CASCADE', 'off')
+
+# Cross-request micro-batching: coalesce concurrent requests into per-model batches
+BATCH_SCHEDULER_ENABLED = os.getenv('BATCH_SCHEDULER_ENABLED', 'false').lower() == 'true'
+BATCH_SCHEDULER_MAX_BATCH_SIZE = int(os.getenv('BATCH_SCHEDULER_MAX_BATCH_SIZE', '8'))
+BATCH_SCHEDULER_MAX_WAIT_MS = float(os.getenv('BATCH_SCHEDULER_MAX_WAIT_MS', '10'))
+
+# Cascade deployment: 'local' runs every model in the server process;
+# 'disaggregated' runs the vessel model, stage 1 and the deeper stages
+# (2, 3a, 3b) in separate local worker processes fed through shared-memory
+# queues, and the server only preprocesses and routes. Size each tier from
+# the routing fractions reported under stage_workers in /api/health
+CASCADE_DEPLOYMENT = os.getenv('CASCADE_DEPLOYMENT', 'local')
+STAGE_WORKERS = {
+    'vessel': int(os.getenv('STAGE_WORKERS_VESSEL', '1')),
+    'stage1': int(os.getenv('STAGE_WORKERS_STAGE1', '1')),
+    'deep': int(os.getenv('STAGE_WORKERS_DEEP', '1'))
+}
+STAGE_WORKER_MAX_BATCH = int(os.getenv('STAGE_WORKER_MAX_BATCH', '8'))
+# A model call that gets no answer from its tier in this time fails the image
+STAGE_WORKER_TIMEOUT_SECONDS = float(os.getenv('STAGE_WORKER_TIMEOUT_SECONDS', '300'))
+
+# Prediction cache: reuse results for re-uploaded images
+CACHE_ENABLED = os.getenv('CACHE_ENABLED', 'true').lower() == 'true'
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '512'))
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', str(256 * 1024 * 1024)))  # in-memory tier budget
+CACHE_DIR = os.getenv('CACHE_DIR') or None  # set to enable the on-disk tier
+# Also cache the bit-packed vessel mask so repeat images skip segmentation
+CACHE_STORE_ARTIFACTS = os.getenv('CACHE_STORE_ARTIFACTS', 'false').lower() == 'true'
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -0,0 +1,104 @@
+"""
+Production server settings, from backend/:
+
+    gunicorn -c gunicorn.conf.py app:app
+
+SERVER_WORKERS processes (one by default) serve requests on threads. Each
+worker has enough threads for every admitted and queued analysis plus the
+light endpoints (health, metrics, job polls and streams, artifact fetches),
+so admission control, not the thread pool, decides what waits and what is
+turned away. With WEIGHT_SHARING=preload the master loads every model before
+forking and the workers share those pages; /api/health?memory=1 reports each
+worker's unique and shared memory. With CASCADE_DEPLOYMENT=disaggregated the master
+starts the stage worker processes first and every server worker sends its
+model calls to them.
+"""
+import os
+
+# Probe CUDA through NVML so the master does not initialize it before forking
+os.environ.setdefault('PYTORCH_NVML_BASED_CUDA_CHECK', '1')
+
+from config import (  # noqa: E402
+    DEVICE, INFERENCE_CONCURRENCY, TORCH_THREADS, ADMISSION_MAX_QUEUED, JOB_WORKERS,
+    REQUEST_TIMEOUT_SECONDS, SERVER_WORKERS, WEIGHT_SHARING, CASCADE_DEPLOYMENT, STAGE_WORKERS,
+    STAGE_WORKER_MAX_BATCH, STAGE_WORKER_TIMEOUT_SECONDS, MODEL_WARMUP, VESSEL_WORKING_SIZE,
+    VESSEL_TILE_SIZE
+)
+from models.model_loader import WEIGHT_SHARING_MODES  # noqa: E402
+from services.admission import serving_plan  # noqa: E402
+
+if WEIGHT_SHARING not in WEIGHT_SHARING_MODES:
+    raise ValueError(f"Unknown WEIGHT_SHARING '{WEIGHT_SHARING}', expected one of {WEIGHT_SHARING_MODES}")
+
+# Same plan as app.py, which sizes admission control with it
+disaggregated = CASCADE_DEPLOYMENT == 'disaggregated'
+plan = serving_plan(
+    'cpu' if disaggregated else DEVICE.split(':')[0], (os.cpu_count() or 1) // max(1, SERVER_WORKERS),
+    INFERENCE_CONCURRENCY or (sum(STAGE_WORKERS.values()) if disaggregated else 0), TORCH_THREADS
+)
+
+bind = os.getenv('BIND', f"0.0.0.0:{os.getenv('PORT', '5000')}")
+workers = max(1, SERVER_WORKERS)
+worker_class = 'gthread'
+threads = int(os.getenv('SERVER_THREADS', '0')) or (
+    plan["concurrency"] + ADMISSION_MAX_QUEUED + JOB_WORKERS + 8
+)
+# The worker's heartbeat runs on its main thread, so long analyses do not trip
+# the timeout; it only has to cover model loading when it is not in the background
+timeout = int(os.getenv('SERVER_TIMEOUT', '300'))
+graceful_timeout = int(REQUEST_TIMEOUT_SECONDS) + 30 if REQUEST_TIMEOUT_SECONDS else 600
+keepalive = 5
+# The app itself is imported by each worker after the fork; only weights are preloaded
+preload_app = False
+accesslog = '-'
+
+
+def on_starting(server):
+    if disaggregated:
+        start_stage_workers(server)
+    elif WEIGHT_SHARING == 'preload':
+        preload_weights(server)
+
+
+def on_exit(server):
+    from services.stage_workers import stage_worker_pool
+
+    pool = stage_worker_pool()
+    if pool is not None:
+        pool.stop()
+
+
+def start_stage_workers(server):
+    from services import stage_workers
+
+    # Server workers find this pool in their inherited copy of the module
+    stage_workers.start_stage_workers(
+        STAGE_WORKERS,
+        # Spatial size of vessel forward passes, as VesselSegmenter.model_input_size
+        manager_options={"vessel_input_size": VESSEL_TILE_SIZE or VESSEL_WORKING_SIZE},
+        response_slots=workers,
+        max_batch_size=STAGE_WORKER_MAX_BATCH,
+        response_timeout=STAGE_WORKER_TIMEOUT_SECONDS,
+        warmup=MODEL_WARMUP
+    )
+    server.log.info("Started stage workers: %s",
+                    ', '.join(f"{tier}={count}" for tier, count in STAGE_WORKERS.items()))
+
+
+def preload_weights(server):
+    import gc
+    import torch
+    from models.model_loader import preload_shared_models
+
+    # Keep the master single-threaded so no OpenMP pool exists when it forks;
+    # workers set their own thread count
+    torch.set_num_threads(1)
+    names = preload_shared_models()
+    if names:
+        server.log.info("Preloaded %s for the workers to share", ', '.join(names))
+    else:
+        server.log.warning("WEIGHT_SHARING=preload needs the torch backend on CPU; "
+                           "workers will load their own models")
+    # Move everything allocated so far out of the collector's reach, so its
+    # bookkeeping writes do not copy the inherited pages into each worker
+    gc.freeze()
@@ -0,0 +1,72 @@
+import os
+
+import torch
+import torch.nn as nn
+
+BACKENDS = ('torch', 'onnx', 'torchscript')
+EXPORT_EXTENSIONS = {'onnx': '.onnx', 'torchscript': '.pt'}
+
+
+def exported_model_path(export_dir, name, backend):
+    return os.path.join(export_dir, f"{name}{EXPORT_EXTENSIONS[backend]}")
+
+
+class OnnxRuntimeModel(nn.Module):
+    """
+    ONNX Runtime session behind the same call signature as the eager model
+
+    Inputs and outputs are torch tensors so callers cannot tell the difference.
+    A single-output graph returns a tensor and a multi-output graph a tuple,
+    matching AttentionUNet and DualStreamConvNeXtModel respectively.
+    """
+    def __init__(self, path, device, intra_op_threads=0, inter_op_threads=1):
+        super().__init__()
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError(
+                "MODEL_BACKEND=onnx requires the onnxruntime package"
+            ) from e
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+
+        providers = ['CPUExecutionProvider']
+        if device.type == 'cuda' and 'CUDAExecutionProvider' in ort.get_available_providers():
+            providers.insert(0, 'CUDAExecutionProvider')
+
+        self.device = device
+        self.nbytes = os.path.getsize(path)
+        self.session = ort.InferenceSession(path, sess_options=options, providers=providers)
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.output_names = [o.name for o in self.session.get_outputs()]
+
+    def forward(self, *inputs):
+        feeds = {
+            name: tensor.detach().float().cpu().numpy()
+            for name, tensor in zip(self.input_names, inputs)
+        }
+        outputs = [
+            torch.from_numpy(output).to(self.device)
+            for output in self.session.run(self.output_names, feeds)
+        ]
+        if len(outputs) == 1:
+            return outputs[0]
+        return tuple(outputs)
+
+
+def load_exported_model(export_dir, name, backend, device, intra_op_threads=0,
+                        inter_op_threads=1):
+    path = exported_model_path(export_dir, name, backend)
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f"Exported model not found: {path} (run `python -m tools.export_models --format {backend}`)"
+        )
+    if backend == 'onnx':
+        return OnnxRuntimeModel(path, device, intra_op_threads, inter_op_threads).eval()
+    if backend == 'torchscript':
+        return torch.jit.load(path, map_location=device).eval()
+    raise ValueError(f"Unknown backend '{backend}', expected one of {BACKENDS[1:]}")
@@ -0,0 +1,110 @@
+import bisect
+import itertools
+import os
+
+_ROLLUP_FIELDS = {
+    'Rss:': 'rss',
+    'Pss:': 'pss',
+    'Shared_Clean:': 'shared',
+    'Shared_Dirty:': 'shared',
+    'Private_Clean:': 'unique',
+    'Private_Dirty:': 'unique',
+    'Swap:': 'swap'
+}
+
+
+def process_memory(pid='self'):
+    """
+    Resident memory of a process, split into unique and shared pages
+
+    `unique` is what only this process maps (and what stopping it would
+    free), `shared` is also mapped by another process such as a sibling
+    worker, the preloading master or the page cache of a mapped weight
+    file, and `pss` charges each shared page to its sharers proportionally.
+    Bytes; None where /proc is unavailable.
+    """
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    usage = {"rss": 0, "pss": 0, "unique": 0, "shared": 0, "swap": 0}
+    for line in lines:
+        fields = line.split()
+        if len(fields) >= 2 and fields[0] in _ROLLUP_FIELDS:
+            usage[_ROLLUP_FIELDS[fields[0]]] += int(fields[1]) * 1024
+    return usage
+
+
+def _mappings(pid='self'):
+    """(start, end, path, shared_bytes, private_bytes) for every mapping, sorted by address"""
+    mappings = []
+    with open(f'/proc/{pid}/smaps') as f:
+        current = None
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            head = fields[0]
+            if not head.endswith(':'):
+                start, end = (int(address, 16) for address in head.split('-'))
+                current = [start, end, ' '.join(fields[5:]), 0, 0]
+                mappings.append(current)
+            elif head in ('Shared_Clean:', 'Shared_Dirty:'):
+                current[3] += int(fields[1]) * 1024
+            elif head in ('Private_Clean:', 'Private_Dirty:'):
+                current[4] += int(fields[1]) * 1024
+    mappings.sort()
+    return mappings
+
+
+def weight_sharing(models, pid='self'):
+    """
+    How each model's CPU weights are held in memory
+
+    For every model: total parameter and buffer bytes, the part mapped from
+    a file (converted weights loaded with mmap) and the resident part that is
+    shared with other processes versus unique to this one. Shared and unique
+    bytes are estimated from the page counts of the mapping each tensor lives
+    in. Returns None where /proc is unavailable.
+    """
+    try:
+        mappings = _mappings(pid)
+    except OSError:
+        return None
+    starts = [mapping[0] for mapping in mappings]
+
+    report = {}
+    seen = set()
+    for name, model in models.items():
+        entry = {"bytes": 0, "file_backed": 0, "shared": 0, "unique": 0}
+        for tensor in itertools.chain(model.parameters(), model.buffers()):
+            if tensor.device.type != 'cpu':
+                continue
+            storage = tensor.untyped_storage()
+            address = storage.data_ptr()
+            if address in seen or not storage.nbytes():
+                continue
+            seen.add(address)
+            nbytes = storage.nbytes()
+            entry["bytes"] += nbytes
+
+            index = bisect.bisect_right(starts, address) - 1
+            if index < 0 or address >= mappings[index][1]:
+                continue
+            start, end, path, shared, private = mappings[index]
+            if path.startswith('/'):
+                entry["file_backed"] += nbytes
+            entry["shared"] += nbytes * shared // (end - start)
+            entry["unique"] += nbytes * private // (end - start)
+        report[name] = entry
+    return report
+
+
+def memory_report(models):
+    """Process and per-model weight memory of this worker, for health checks"""
+    return {
+        "pid": os.getpid(),
+        "process": process_memory(),
+        "weights": weight_sharing(models)
+    }
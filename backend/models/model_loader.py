@@ -1,64 +1,377 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 from models.vessel_model import AttentionUNet
 from models.classification_model import DualStreamConvNeXtModel
-from config import MODEL_PATHS
+from models.quantization import (
+    Bf16Autocast, resolve_precision, quantize_classifier_dynamic, quantize_vessel_static,
+    load_calibration_inputs
+)
+from models.graph_backend import load_exported_model
+from models.performance import PROFILES, enable_compile_cache, optimize_for_inference
+from models.residency import ModelResidency, model_nbytes
+from services.metrics import MODEL_LOADS, MODEL_EVICTIONS
+from models.weights import (
+    converted_weights_path, convert_checkpoint, is_converted, load_state_dict_mmap
+)
+from config import (
+    MODEL_PATHS, MODEL_PRECISION, QUANT_CALIBRATION_DIR, MODEL_BACKEND, EXPORT_DIR,
+    ORT_INTRA_OP_THREADS, ORT_INTER_OP_THREADS, MODEL_MEMORY_BUDGET_MB, WEIGHTS_CACHE_DIR,
+    INFERENCE_PROFILE, COMPILE_MODE, COMPILE_CACHE_DIR, BATCH_SCHEDULER_ENABLED, SERVER_WORKERS
+)
+
+# Model name -> key in MODEL_PATHS
+CHECKPOINT_KEYS = {
+    'vessel': 'vessel',
+    'stage1': 'stage1_cascade',
+    'stage2': 'stage2',
+    'stage3a': 'stage3a',
+    'stage3b': 'stage3b'
+}
+
+# Loaded at startup and never evicted -> ModelManager attribute
+PINNED_ATTRIBUTES = {
+    'vessel': 'vessel_model',
+    'stage1': 'stage1_cascade'
+}
+
+# Lazily loaded, evictable cascade stages -> ModelManager attribute
+STAGE_ATTRIBUTES = {
+    'stage2': 'stage2_model',
+    'stage3a': 'stage3a_model',
+    'stage3b': 'stage3b_model'
+}
+
+WEIGHT_SHARING_MODES = ('mmap', 'preload')
+
+# Model name -> (settings, model, precision, compiled), filled by
+# preload_shared_models in a server master before it forks its workers
+PRELOADED_MODELS = {}
 
 
 class ModelManager:
-    def __init__(self, use_fp16=False):
+    def __init__(self, use_fp16=False, precision=MODEL_PRECISION, backend=MODEL_BACKEND,
+                 memory_budget_mb=MODEL_MEMORY_BUDGET_MB, profile=INFERENCE_PROFILE,
+                 vessel_input_size=1024, device=None, calibration_dir=QUANT_CALIBRATION_DIR):
         self.vessel_model = None
         self.stage1_cascade = None
         self.stage2_model = None
         self.stage3a_model = None
         self.stage3b_model = None
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        self.use_fp16 = use_fp16 and torch.cuda.is_available()
+        self.device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+        self.use_fp16 = use_fp16 and self.device.type == 'cuda'
         self.dtype = torch.float16 if self.use_fp16 else torch.float32
+        self.backend = backend
+        # Exported graphs are fp32; precision modes only apply to eager models
+        self.precision = resolve_precision(precision, self.device) if backend == 'torch' else 'fp32'
+        self.model_precisions = {}
+        # Images that calibrate the vessel model's static INT8 quantization
+        self.calibration_dir = calibration_dir
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown inference profile '{profile}', expected one of {PROFILES}")
+        self.profile = profile
+        # Spatial size of vessel forward passes (smaller with tiled or reduced-resolution segmentation)
+        self.vessel_input_size = vessel_input_size
+        # Names of models wrapped with torch.compile; they are warmed on load
+        self.compiled = set()
+        if profile == 'performance' and backend == 'torch':
+            enable_compile_cache(COMPILE_CACHE_DIR)
+        self.residency = ModelResidency(budget_bytes=int(memory_budget_mb * 1024 * 1024))
+        self._load_lock = threading.Lock()
+        # loading -> warming -> ready (or failed) for pinned models;
+        # deeper stages are not_loaded until first use and evicted when dropped
+        self.model_states = {name: 'not_loaded' for name in CHECKPOINT_KEYS}
+        self.load_errors = {}
+        self.load_durations = {}
+        # Models adopted from the preloading server master rather than loaded here
+        self.preloaded = set()
 
-    def load_all_models(self):
-        self.vessel_model = AttentionUNet(in_channels=1, out_channels=1).to(self.device)
-        checkpoint = torch.load(MODEL_PATHS['vessel'], map_location=self.device, weights_only=False)
-        self.vessel_model.load_state_dict(checkpoint['model_state_dict'])
-        if self.use_fp16:
-            self.vessel_model = self.vessel_model.half()
-        self.vessel_model.eval()
+    def _settings(self):
+        return (self.backend, self.precision, self.profile, self.use_fp16, str(self.device))
+
+    def _adopt_preloaded(self, name):
+        """The master's preloaded copy of a model if it was built with the same settings, else None"""
+        entry = PRELOADED_MODELS.get(name)
+        if entry is None or entry[0] != self._settings():
+            return None
+        _, model, precision, compiled = entry
+        self.model_precisions[name] = precision
+        if compiled:
+            self.compiled.add(name)
+        self.preloaded.add(name)
+        return model
+
+    def _load_exported(self, name):
+        # By default each server worker's sessions get its share of the cores
+        threads = ORT_INTRA_OP_THREADS or max(1, (os.cpu_count() or 1) // max(1, SERVER_WORKERS))
+        model = load_exported_model(
+            EXPORT_DIR, name, self.backend, self.device,
+            intra_op_threads=threads, inter_op_threads=ORT_INTER_OP_THREADS
+        )
+        self.model_precisions[name] = 'fp32'
+        return model
+
+    def _load_state_dict(self, name):
+        """Load weights from the converted state dict, converting the checkpoint on first use"""
+        checkpoint_path = MODEL_PATHS[CHECKPOINT_KEYS[name]]
+        converted_path = converted_weights_path(WEIGHTS_CACHE_DIR, name)
+        if is_converted(checkpoint_path, converted_path):
+            return load_state_dict_mmap(converted_path, self.device)
 
-        self.stage1_cascade = DualStreamConvNeXtModel(num_classes=2).to(self.device)
-        checkpoint = torch.load(MODEL_PATHS['stage1_cascade'], map_location=self.device, weights_only=False)
-        self.stage1_cascade.load_state_dict(checkpoint['model_state_dict'])
+        try:
+            convert_checkpoint(checkpoint_path, converted_path)
+        except OSError:
+            # Read-only deployments can still serve from the original checkpoint
+            checkpoint = torch.load(checkpoint_path, map_location=self.device, weights_only=False)
+            return checkpoint['model_state_dict']
+        return load_state_dict_mmap(converted_path, self.device)
+
+    def _prepare_model(self, name, model):
         if self.use_fp16:
-            self.stage1_cascade = self.stage1_cascade.half()
-        self.stage1_cascade.eval()
+            model = model.half()
+        model.eval()
+
+        precision = self.precision
+        if precision == 'int8':
+            if name == 'vessel':
+                # Static quantization needs representative images to calibrate
+                # activation ranges; without them the U-Net stays in fp32
+                calibration_inputs = []
+                if self.calibration_dir:
+                    calibration_inputs = load_calibration_inputs(self.calibration_dir)
+                if calibration_inputs:
+                    model = quantize_vessel_static(model, calibration_inputs)
+                else:
+                    precision = 'fp32'
+            else:
+                model = quantize_classifier_dynamic(model)
+        elif precision == 'bf16':
+            model = Bf16Autocast(model).eval()
+
+        # Quantized graphs keep their own kernels and are left uncompiled
+        if self.profile == 'performance' and precision != 'int8':
+            model = optimize_for_inference(model, COMPILE_MODE)
+            self.compiled.add(name)
+
+        self.model_precisions[name] = precision
+        return model
+
+    def _load_vessel(self):
+        preloaded = self._adopt_preloaded('vessel')
+        if preloaded is not None:
+            return preloaded
+        if self.backend != 'torch':
+            return self._load_exported('vessel')
+
+        state_dict = self._load_state_dict('vessel')
+        # Build on the meta device and adopt the (memory-mapped) tensors directly
+        # instead of randomly initialising weights only to overwrite them
+        with torch.device('meta'):
+            model = AttentionUNet(in_channels=1, out_channels=1)
+        model.load_state_dict(state_dict, assign=True)
+        return self._prepare_model('vessel', model.to(self.device))
+
+    def _load_classifier(self, name):
+        preloaded = self._adopt_preloaded(name)
+        if preloaded is not None:
+            return preloaded
+        if self.backend != 'torch':
+            return self._load_exported(name)
+
+        state_dict = self._load_state_dict(name)
+        with torch.device('meta'):
+            model = DualStreamConvNeXtModel(num_classes=2)
+        model.load_state_dict(state_dict, assign=True)
+        return self._prepare_model(name, model.to(self.device))
+
+    def _warmup_batch_sizes(self, name):
+        if name not in self.compiled:
+            return (2,) if name != 'vessel' else (1,)
+        # Batch 1 gets its own specialised graph and the second size compiles
+        # the dynamic-batch graph, so live traffic never recompiles. Vessel
+        # batches only vary when the micro-batch scheduler merges them
+        if name == 'vessel' and not BATCH_SCHEDULER_ENABLED:
+            return (1,)
+        return (1, 2)
+
+    def _warmup(self, name, model):
+        """Run dummy batches so allocator, kernel and compile setup happen before the first request"""
+        size = self.vessel_input_size if name == 'vessel' else 288
+        with torch.inference_mode():
+            for batch_size in self._warmup_batch_sizes(name):
+                dummy = torch.zeros(batch_size, 1, size, size, device=self.device, dtype=self.dtype)
+                if name == 'vessel':
+                    model(dummy)
+                else:
+                    model(dummy, dummy)
+
+    def _load_pinned(self, name, warmup):
+        self.model_states[name] = 'loading'
+        start = time.perf_counter()
+        try:
+            model = self._load_vessel() if name == 'vessel' else self._load_classifier(name)
+            if warmup or name in self.compiled:
+                self.model_states[name] = 'warming'
+                self._warmup(name, model)
+        except Exception as e:
+            self.model_states[name] = 'failed'
+            self.load_errors[name] = str(e)
+            raise
+
+        setattr(self, PINNED_ATTRIBUTES[name], model)
+        MODEL_LOADS.inc(model=name)
+        self.residency.add(name, model_nbytes(model))
+        self.load_durations[name] = time.perf_counter() - start
+        self.model_states[name] = 'ready'
+
+    def load_all_models(self, warmup=False):
+        """
+        Load the vessel model and stage 1 concurrently
+
+        In the performance profile without a memory budget the deeper stages
+        are loaded (and so compiled and warmed) right after, instead of on
+        first use.
+        """
+        with ThreadPoolExecutor(max_workers=len(PINNED_ATTRIBUTES)) as pool:
+            futures = [pool.submit(self._load_pinned, name, warmup) for name in PINNED_ATTRIBUTES]
+            for future in futures:
+                future.result()
+
+        if self.compiled and not self.residency.budget_bytes:
+            for name in STAGE_ATTRIBUTES:
+                self._load_stage(name)
+
+    def load_models(self, names, warmup=False):
+        """Load only `names` (e.g. the models of one stage worker tier) and keep them resident"""
+        for name in names:
+            if name in PINNED_ATTRIBUTES:
+                self._load_pinned(name, warmup)
+            else:
+                model = self._load_stage(name)
+                if warmup and name not in self.compiled:
+                    self._warmup(name, model)
+
+    def start_loading(self, warmup=False):
+        """Load the pinned models in the background so the server can answer health checks meanwhile"""
+        def run():
+            try:
+                self.load_all_models(warmup=warmup)
+            except Exception:
+                # Failures are recorded in model_states / load_errors
+                pass
+
+        thread = threading.Thread(target=run, name="model-loader", daemon=True)
+        thread.start()
+        return thread
+
+    def _load_stage(self, name):
+        attribute = STAGE_ATTRIBUTES[name]
+        model = getattr(self, attribute)
+        if model is not None:
+            self.residency.record_hit(name)
+            return model
+
+        with self._load_lock:
+            model = getattr(self, attribute)
+            if model is not None:
+                self.residency.record_hit(name)
+                return model
+            self.residency.record_miss(name)
+
+            # Make room before loading so peak memory stays within the budget
+            victims = self.residency.select_evictions(name, self.residency.estimated_size(name))
+            for victim in victims:
+                setattr(self, STAGE_ATTRIBUTES[victim], None)
+                self.model_precisions.pop(victim, None)
+                self.compiled.discard(victim)
+                self.residency.remove(victim, evicted=True)
+                self.model_states[victim] = 'evicted'
+                MODEL_EVICTIONS.inc(model=victim)
+            if victims and self.device.type == 'cuda':
+                torch.cuda.empty_cache()
+
+            self.model_states[name] = 'loading'
+            start = time.perf_counter()
+            try:
+                model = self._load_classifier(name)
+                if name in self.compiled:
+                    self._warmup(name, model)
+            except Exception as e:
+                self.model_states[name] = 'failed'
+                self.load_errors[name] = str(e)
+                raise
+            setattr(self, attribute, model)
+            MODEL_LOADS.inc(model=name)
+            self.residency.add(name, model_nbytes(model))
+            self.load_durations[name] = time.perf_counter() - start
+            self.model_states[name] = 'ready'
+            return model
 
     def load_stage2(self):
-        if self.stage2_model is None:
-            self.stage2_model = DualStreamConvNeXtModel(num_classes=2).to(self.device)
-            checkpoint = torch.load(MODEL_PATHS['stage2'], map_location=self.device, weights_only=False)
-            self.stage2_model.load_state_dict(checkpoint['model_state_dict'])
-            if self.use_fp16:
-                self.stage2_model = self.stage2_model.half()
-            self.stage2_model.eval()
+        self._load_stage('stage2')
 
     def load_stage3a(self):
-        if self.stage3a_model is None:
-            self.stage3a_model = DualStreamConvNeXtModel(num_classes=2).to(self.device)
-            checkpoint = torch.load(MODEL_PATHS['stage3a'], map_location=self.device, weights_only=False)
-            self.stage3a_model.load_state_dict(checkpoint['model_state_dict'])
-            if self.use_fp16:
-                self.stage3a_model = self.stage3a_model.half()
-            self.stage3a_model.eval()
+        self._load_stage('stage3a')
 
     def load_stage3b(self):
-        if self.stage3b_model is None:
-            self.stage3b_model = DualStreamConvNeXtModel(num_classes=2).to(self.device)
-            checkpoint = torch.load(MODEL_PATHS['stage3b'], map_location=self.device, weights_only=False)
-            self.stage3b_model.load_state_dict(checkpoint['model_state_dict'])
-            if self.use_fp16:
-                self.stage3b_model = self.stage3b_model.half()
-            self.stage3b_model.eval()
+        self._load_stage('stage3b')
+
+    def get_model(self, name):
+        """Return the model registered under `name`, lazily loading the deeper cascade stages"""
+        if name == 'vessel':
+            return self.vessel_model
+        if name == 'stage1':
+            return self.stage1_cascade
+        if name in STAGE_ATTRIBUTES:
+            return self._load_stage(name)
+        raise KeyError(f"Unknown model: {name}")
+
+    def unload_model(self, name):
+        """Drop a deeper cascade stage so its memory can be reclaimed; it reloads on next use"""
+        if name not in STAGE_ATTRIBUTES:
+            raise KeyError(f"Model cannot be unloaded: {name}")
+        with self._load_lock:
+            setattr(self, STAGE_ATTRIBUTES[name], None)
+            self.model_precisions.pop(name, None)
+            self.compiled.discard(name)
+            self.residency.remove(name, evicted=False)
+            self.model_states[name] = 'not_loaded'
+
+    def resident_models(self):
+        """Name -> model for every model currently loaded"""
+        attributes = {**PINNED_ATTRIBUTES, **STAGE_ATTRIBUTES}
+        models = {name: getattr(self, attribute) for name, attribute in attributes.items()}
+        return {name: model for name, model in models.items() if model is not None}
 
     def models_loaded(self):
         return all([
             self.vessel_model is not None,
             self.stage1_cascade is not None
         ])
+
+
+def preload_shared_models(**manager_options):
+    """
+    Load every model once in a server master, before it forks its workers
+
+    Workers adopt these models instead of loading their own copies; inference
+    never writes to weights, so the forked pages stay shared copy-on-write.
+    Nothing is warmed or compiled here, so no intra-op or compiler threads
+    exist at fork time. Only eager models on CPU are preloaded: CUDA contexts
+    and exported-graph runtime sessions do not survive fork.
+
+    Returns the names of the preloaded models.
+    """
+    manager = ModelManager(**manager_options)
+    if manager.backend != 'torch' or manager.device.type != 'cpu':
+        return []
+    for name in CHECKPOINT_KEYS:
+        model = manager._load_vessel() if name == 'vessel' else manager._load_classifier(name)
+        PRELOADED_MODELS[name] = (
+            manager._settings(), model, manager.model_precisions[name], name in manager.compiled
+        )
+    return list(PRELOADED_MODELS)
+
@@ -0,0 +1,41 @@
+import os
+
+import torch
+
+PROFILES = ('deterministic', 'performance')
+COMPILE_MODES = ('default', 'reduce-overhead', 'max-autotune')
+
+
+def configure_backends(profile):
+    """
+    Apply the process-wide backend flags for an inference profile
+
+    'deterministic' pins cuDNN to deterministic algorithms for reproducible
+    audit runs; 'performance' lets cuDNN autotune convolution algorithms for
+    the fixed input shapes.
+    """
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown inference profile '{profile}', expected one of {PROFILES}")
+    performance = profile == 'performance'
+    torch.backends.cudnn.deterministic = not performance
+    torch.backends.cudnn.benchmark = performance
+
+
+def enable_compile_cache(cache_dir):
+    """Persist compiled kernels across restarts so only the first start pays for codegen"""
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', cache_dir)
+    try:
+        import torch._inductor.config as inductor_config
+    except ImportError:
+        return
+    if hasattr(inductor_config, 'fx_graph_cache'):
+        inductor_config.fx_graph_cache = True
+
+
+def optimize_for_inference(model, compile_mode='default'):
+    """Convert a model to channels_last and compile it with torch.compile"""
+    if compile_mode not in COMPILE_MODES:
+        raise ValueError(f"Unknown compile mode '{compile_mode}', expected one of {COMPILE_MODES}")
+    model = model.to(memory_format=torch.channels_last)
+    return torch.compile(model, mode=compile_mode)
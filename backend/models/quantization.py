@@ -0,0 +1,183 @@
+import copy
+import math
+import os
+
+import cv2
+import torch
+import torch.nn as nn
+
+PRECISIONS = ('fp32', 'int8', 'bf16')
+
+
+def cpu_supports_bf16():
+    """True when oneDNN can run bf16 kernels natively on this CPU"""
+    try:
+        return bool(torch.backends.mkldnn.is_available()
+                    and torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def resolve_precision(precision, device):
+    """Return the precision that will actually be used on `device`"""
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}', expected one of {PRECISIONS}")
+    if device.type != 'cpu':
+        return 'fp32'
+    if precision == 'bf16' and not cpu_supports_bf16():
+        return 'fp32'
+    return precision
+
+
+class Bf16Autocast(nn.Module):
+    """Runs the wrapped model under CPU bf16 autocast and returns fp32 outputs"""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, *inputs):
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            outputs = self.model(*inputs)
+        if isinstance(outputs, tuple):
+            return tuple(o.float() if torch.is_tensor(o) else o for o in outputs)
+        return outputs.float()
+
+
+class QuantizableAttention(nn.Module):
+    """
+    Inference-only nn.MultiheadAttention with its projections as nn.Linear
+
+    MultiheadAttention keeps the q/k/v projections in one packed parameter
+    and its output projection is excluded from dynamic quantization, so
+    quantize_dynamic leaves the whole layer in fp32. This module holds the
+    same weights as four nn.Linear layers and computes the same outputs
+    (without attention dropout), including the head-averaged weights.
+    """
+    def __init__(self, attention):
+        super().__init__()
+        embed_dim = attention.embed_dim
+        self.num_heads = attention.num_heads
+        self.head_dim = attention.head_dim
+        self.batch_first = attention.batch_first
+        has_bias = attention.in_proj_bias is not None
+        weights = attention.in_proj_weight.detach().chunk(3)
+        biases = attention.in_proj_bias.detach().chunk(3) if has_bias else (None,) * 3
+        self.q_proj, self.k_proj, self.v_proj = (
+            self._linear(weight, bias, embed_dim) for weight, bias in zip(weights, biases)
+        )
+        out_bias = attention.out_proj.bias
+        self.out_proj = self._linear(
+            attention.out_proj.weight.detach(), None if out_bias is None else out_bias.detach(),
+            embed_dim
+        )
+
+    @staticmethod
+    def _linear(weight, bias, embed_dim):
+        linear = nn.Linear(embed_dim, embed_dim, bias=bias is not None,
+                           device=weight.device, dtype=weight.dtype)
+        linear.weight = nn.Parameter(weight.clone(), requires_grad=False)
+        if bias is not None:
+            linear.bias = nn.Parameter(bias.clone(), requires_grad=False)
+        return linear
+
+    @staticmethod
+    def supports(attention):
+        # Separate key/value sizes and bias_k/bias_v are not used by these models
+        return attention._qkv_same_embed_dim and attention.bias_k is None and not attention.add_zero_attn
+
+    def _heads(self, x):
+        batch, length, _ = x.shape
+        return x.view(batch, length, self.num_heads, self.head_dim).transpose(1, 2)
+
+    def forward(self, query, key, value, need_weights=True):
+        if not self.batch_first:
+            query, key, value = (x.transpose(0, 1) for x in (query, key, value))
+        batch, length, embed_dim = query.shape
+        q = self._heads(self.q_proj(query))
+        k = self._heads(self.k_proj(key))
+        v = self._heads(self.v_proj(value))
+
+        weights = torch.softmax(q @ k.transpose(-2, -1) / math.sqrt(self.head_dim), dim=-1)
+        output = (weights @ v).transpose(1, 2).reshape(batch, length, embed_dim)
+        output = self.out_proj(output)
+        if not self.batch_first:
+            output = output.transpose(0, 1)
+        return output, weights.mean(dim=1) if need_weights else None
+
+
+def _replace_attention(module):
+    for name, child in module.named_children():
+        if isinstance(child, nn.MultiheadAttention) and QuantizableAttention.supports(child):
+            setattr(module, name, QuantizableAttention(child))
+        else:
+            _replace_attention(child)
+
+
+def quantize_classifier_dynamic(model):
+    """
+    Dynamic INT8 quantization of a DualStreamConvNeXtModel
+
+    Quantizes every nn.Linear: the pointwise MLPs inside both ConvNeXt
+    backbones (where most of their FLOPs are), the fusion MLP, the
+    classifier head and, once rebuilt as QuantizableAttention, the q/k/v and
+    output projections of the attention layers. Weights are stored as int8
+    and activations are quantized per batch, so no calibration data is
+    needed.
+    """
+    model = copy.deepcopy(model)
+    _replace_attention(model)
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def int8_coverage(model):
+    """Count of Linear layers (attention projections included) held in int8 and in fp32"""
+    counts = {"int8": 0, "fp32": 0}
+    for module in model.modules():
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            counts["int8"] += 1
+        elif isinstance(module, nn.Linear):
+            counts["fp32"] += 1
+        elif isinstance(module, nn.MultiheadAttention):
+            # Packed q/k/v projection; out_proj is counted as a Linear above
+            counts["fp32"] += 1
+    return counts
+
+
+def quantize_vessel_static(model, calibration_inputs):
+    """
+    Static INT8 quantization of AttentionUNet with FX graph mode
+
+    Args:
+        model: fp32 AttentionUNet in eval mode
+        calibration_inputs: list of (1, 1, H, W) tensors used to observe activation ranges
+
+    Returns:
+        quantized GraphModule with fp32 inputs and outputs
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    example_inputs = (calibration_inputs[0],)
+    prepared = prepare_fx(copy.deepcopy(model).eval(), get_default_qconfig_mapping('x86'),
+                          example_inputs)
+    with torch.no_grad():
+        for input_tensor in calibration_inputs:
+            prepared(input_tensor)
+    return convert_fx(prepared)
+
+
+def load_calibration_inputs(directory, limit=16):
+    """Load up to `limit` fundus images from `directory` as vessel model inputs"""
+    from services.preprocessing import preprocess_for_vessel
+
+    inputs = []
+    for filename in sorted(os.listdir(directory)):
+        image_bgr = cv2.imread(os.path.join(directory, filename), cv2.IMREAD_COLOR)
+        if image_bgr is None:
+            continue
+        image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+        input_tensor, _ = preprocess_for_vessel(image_rgb)
+        inputs.append(input_tensor)
+        if len(inputs) >= limit:
+            break
+    return inputs
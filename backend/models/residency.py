@@ -0,0 +1,101 @@
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def model_nbytes(model):
+    """Bytes held by a model's parameters and buffers, including packed quantized weights"""
+    def tensor_bytes(value):
+        if torch.is_tensor(value):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(tensor_bytes(v) for v in value)
+        return 0
+
+    total = sum(tensor_bytes(value) for value in model.state_dict().values())
+    return total or getattr(model, 'nbytes', 0)
+
+
+class ModelResidency:
+    """
+    Tracks which models are resident and picks LRU stage models to evict
+
+    Pinned models (the vessel model and stage 1) are never evicted. A budget of
+    0 disables eviction. The requested model is always allowed to load, even
+    if that means it alone exceeds the budget.
+    """
+    def __init__(self, budget_bytes=0, pinned=('vessel', 'stage1')):
+        self.budget_bytes = budget_bytes
+        self.pinned = set(pinned)
+        self.lock = threading.Lock()
+        self.resident = OrderedDict()
+        self.sizes = {}
+        self.hits = {}
+        self.misses = {}
+        self.evictions = {}
+
+    def record_hit(self, name):
+        with self.lock:
+            self.hits[name] = self.hits.get(name, 0) + 1
+            if name in self.resident:
+                self.resident.move_to_end(name)
+
+    def record_miss(self, name):
+        with self.lock:
+            self.misses[name] = self.misses.get(name, 0) + 1
+
+    def estimated_size(self, name):
+        with self.lock:
+            if name in self.sizes:
+                return self.sizes[name]
+            return max(self.sizes.values(), default=0)
+
+    def select_evictions(self, name, incoming_bytes):
+        """Return the LRU unpinned models that must go for `name` to fit in the budget"""
+        with self.lock:
+            if not self.budget_bytes:
+                return []
+            total = sum(self.resident.values()) + incoming_bytes
+            victims = []
+            for candidate, size in self.resident.items():
+                if total <= self.budget_bytes:
+                    break
+                if candidate in self.pinned or candidate == name:
+                    continue
+                victims.append(candidate)
+                total -= size
+            return victims
+
+    def add(self, name, nbytes):
+        with self.lock:
+            self.resident[name] = nbytes
+            self.resident.move_to_end(name)
+            self.sizes[name] = nbytes
+
+    def remove(self, name, evicted=True):
+        with self.lock:
+            if self.resident.pop(name, None) is not None and evicted:
+                self.evictions[name] = self.evictions.get(name, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            per_model = {}
+            for name in sorted(set(self.hits) | set(self.misses) | set(self.resident)):
+                hits = self.hits.get(name, 0)
+                misses = self.misses.get(name, 0)
+                per_model[name] = {
+                    "resident": name in self.resident,
+                    "pinned": name in self.pinned,
+                    "bytes": self.sizes.get(name, 0),
+                    "hits": hits,
+                    "misses": misses,
+                    "evictions": self.evictions.get(name, 0),
+                    "hit_rate": hits / (hits + misses) if hits + misses else 0.0
+                }
+            return {
+                "budget_bytes": self.budget_bytes,
+                "resident_bytes": sum(self.resident.values()),
+                "resident": list(self.resident),
+                "models": per_model
+            }
@@ -0,0 +1,51 @@
+import os
+import tempfile
+
+import torch
+
+
+def converted_weights_path(weights_dir, name):
+    return os.path.join(weights_dir, f"{name}.pt")
+
+
+def convert_checkpoint(checkpoint_path, output_path):
+    """
+    Re-save a training checkpoint as a bare state dict
+
+    Training checkpoints are pickles that also carry optimizer state and
+    metadata. The converted file holds only tensors in torch's zipfile format,
+    so it can be loaded with `weights_only=True` and memory-mapped.
+    """
+    checkpoint = torch.load(checkpoint_path, map_location='cpu', weights_only=False)
+    state_dict = checkpoint.get('model_state_dict', checkpoint)
+
+    directory = os.path.dirname(output_path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    # A private temporary file per writer: server workers may convert the
+    # same checkpoint at once, and each replace must install a complete file
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            torch.save(state_dict, f)
+        # mkstemp creates the file private to its owner
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return state_dict
+
+
+def is_converted(checkpoint_path, output_path):
+    """True when `output_path` exists and is newer than the source checkpoint"""
+    if not os.path.exists(output_path):
+        return False
+    if not os.path.exists(checkpoint_path):
+        return True
+    return os.path.getmtime(output_path) >= os.path.getmtime(checkpoint_path)
+
+
+def load_state_dict_mmap(path, device):
+    """Load a converted state dict; on CPU the tensors are backed by the mapped file"""
+    return torch.load(path, map_location=device, mmap=True, weights_only=True)
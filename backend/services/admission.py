@@ -0,0 +1,197 @@
+import socket
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+from services.metrics import ADMISSION_WAIT_SECONDS, SERVICE_SECONDS, ADMISSION_REJECTIONS
+
+
+def serving_plan(device_type, cpu_count, concurrency=0, torch_threads=0):
+    """
+    Inference concurrency and torch intra-op threads for the hardware
+
+    A forward pass on CPU already spreads over every intra-op thread, so one
+    analysis runs per 8 cores and each gets its share of the cores. On GPU
+    two analyses overlap one's host-side work (decode, encode) with the
+    other's device work. Non-zero arguments override the derived values.
+    """
+    cpu_count = max(1, cpu_count or 1)
+    if not concurrency:
+        concurrency = 2 if device_type == 'cuda' else max(1, cpu_count // 8)
+    if not torch_threads:
+        torch_threads = min(4, cpu_count) if device_type == 'cuda' else max(1, cpu_count // concurrency)
+    return {"concurrency": concurrency, "torch_threads": torch_threads}
+
+
+def client_disconnected(environ):
+    """True once the client has closed its connection, probed without blocking or consuming data"""
+    sock = environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+    if sock is None:
+        return False
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+    except (BlockingIOError, InterruptedError):
+        return False
+    except ValueError:
+        # TLS sockets cannot peek; assume the client is still there
+        return False
+    except OSError:
+        return True
+
+
+class Deadline:
+    """
+    A request's time budget plus a probe for the client going away
+
+    Checked while the request waits for admission and between images once
+    it runs; `reason` records why it expired.
+    """
+    def __init__(self, seconds=None, environ=None):
+        self.expires_at = time.monotonic() + seconds if seconds else None
+        self.environ = environ
+        self.reason = None
+
+    def remaining(self):
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        if self.reason is None:
+            if self.expires_at is not None and time.monotonic() >= self.expires_at:
+                self.reason = 'deadline'
+            elif self.environ is not None and client_disconnected(self.environ):
+                self.reason = 'client_disconnected'
+        return self.reason is not None
+
+    def guard(self, images):
+        """Stop feeding images once expired; images already in the pipeline still finish"""
+        for item in images:
+            if self.expired():
+                return
+            yield item
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is not admitted; carries the HTTP status and Retry-After seconds"""
+    def __init__(self, message, reason, status, retry_after):
+        super().__init__(message)
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Bounds concurrent inference across request threads and job workers
+
+    At most `max_concurrent` analyses hold a slot; up to `max_queued` more
+    wait in arrival order and anything beyond is rejected with 503. Each
+    client may have `per_client_limit` requests admitted or waiting (429
+    beyond, 0 for no limit). A waiting request gives up when its Deadline
+    expires. Time spent waiting and time holding a slot are recorded
+    separately.
+    """
+    POLL_SECONDS = 0.5
+
+    def __init__(self, max_concurrent, max_queued, per_client_limit=0, retry_after=5):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queued = max_queued
+        self.per_client_limit = per_client_limit
+        self.retry_after = retry_after
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = deque()
+        self.clients = Counter()
+        self.admitted = 0
+        self.rejected = Counter()
+
+    @contextmanager
+    def admit(self, client=None, deadline=None, bounded=True, endpoint='predict'):
+        """
+        Hold one inference slot for the duration of the block; yields the queue wait in seconds
+
+        `bounded=False` waits regardless of the queue limit (for work that is
+        already bounded elsewhere, such as background jobs).
+        """
+        started = time.perf_counter()
+        self._acquire(client, deadline, bounded)
+        admitted = time.perf_counter()
+        queue_seconds = admitted - started
+        ADMISSION_WAIT_SECONDS.observe(queue_seconds, endpoint=endpoint)
+        try:
+            yield queue_seconds
+        finally:
+            SERVICE_SECONDS.observe(time.perf_counter() - admitted, endpoint=endpoint)
+            self._release(client)
+
+    def _reject(self, message, reason, status):
+        self.rejected[reason] += 1
+        ADMISSION_REJECTIONS.inc(reason=reason)
+        raise AdmissionRejected(message, reason, status, self.retry_after)
+
+    def _acquire(self, client, deadline, bounded):
+        with self.condition:
+            if self.per_client_limit and client is not None \
+                    and self.clients[client] >= self.per_client_limit:
+                self._reject("Too many requests in flight for this client", 'client_limit', 429)
+            if self.active < self.max_concurrent and not self.waiting:
+                self._admitted(client)
+                return
+            if bounded and len(self.waiting) >= self.max_queued:
+                self._reject("Server is at capacity, retry later", 'queue_full', 503)
+
+            ticket = object()
+            self.waiting.append(ticket)
+            self.clients[client] += 1
+            try:
+                while self.waiting[0] is not ticket or self.active >= self.max_concurrent:
+                    timeout = self.POLL_SECONDS
+                    if deadline is not None:
+                        if deadline.expired():
+                            self._reject(f"Gave up waiting for capacity: {deadline.reason}",
+                                         deadline.reason, 503)
+                        remaining = deadline.remaining()
+                        if remaining is not None:
+                            timeout = min(timeout, remaining)
+                    self.condition.wait(timeout)
+            except BaseException:
+                self.waiting.remove(ticket)
+                self._forget(client)
+                self.condition.notify_all()
+                raise
+            self.waiting.popleft()
+            self.clients[client] -= 1
+            self._admitted(client)
+            # The next ticket may fit as well
+            self.condition.notify_all()
+
+    def _admitted(self, client):
+        self.active += 1
+        self.admitted += 1
+        self.clients[client] += 1
+
+    def _forget(self, client):
+        self.clients[client] -= 1
+        if self.clients[client] <= 0:
+            del self.clients[client]
+
+    def _release(self, client):
+        with self.condition:
+            self.active -= 1
+            self._forget(client)
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "max_concurrent": self.max_concurrent,
+                "max_queued": self.max_queued,
+                "per_client_limit": self.per_client_limit,
+                "active": self.active,
+                "queued": len(self.waiting),
+                "clients": len(self.clients),
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected)
+            }
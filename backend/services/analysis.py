@@ -0,0 +1,485 @@
+import base64
+import time
+from collections import deque
+
+import cv2
+import torch
+
+from services.decoding import decode_image, decode_image_reduced
+from services.vessel_inference import VesselSegmentation, segment_vessel_input
+from services.cascade_inference import cascade_classify_batch
+from services.preprocessing import (
+    preprocess_for_vessel, classifier_inputs_from_vessel, create_vessel_visualization, resize_mask
+)
+from services.device_preprocessing import classifier_inputs_for_batch, preprocess_on_device_for_vessel
+from services.pipeline import StagePool, StageStats
+from services.metrics import (
+    STEP_SECONDS, IMAGE_SECONDS, IMAGES, CASCADE_EXITS, QUALITY_GATE_IMAGES, QUALITY_GATE_ISSUES,
+    QUALITY_GATE_SKIPPED_PASSES, QUALITY_GATE_SAVED_SECONDS
+)
+from services.profiling import PROFILER, annotate
+from services.artifacts import (
+    ARTIFACT_NAMES, PREVIEW_FORMATS, encode_image_to_base64, encode_binary_mask_png,
+    encode_overlay_preview, pack_mask, unpack_mask, preview_size
+)
+
+# Part of the prediction cache fingerprint: bump whenever preprocessing changes
+# the model inputs for the same decoded image, so older entries are not reused.
+# 2: classifier inputs resampled from the 1024x1024 vessel input on the device
+PIPELINE_VERSION = 2
+
+
+def exit_node(classification_result):
+    """Name of the cascade node that produced the final grade"""
+    if not classification_result["has_dr"]:
+        return 'stage1'
+    return 'stage3a' if classification_result["grade"] in (1, 2) else 'stage3b'
+
+
+def quality_issues_message(assessment):
+    return "Ungradable image: " + ", ".join(issue.replace('_', ' ') for issue in assessment["issues"])
+
+
+class _PendingImage:
+    """An image between vessel segmentation and its final result"""
+    def __init__(self, index, image_id, cache_key, started, artifacts, quality=None):
+        self.index = index
+        self.image_id = image_id
+        self.cache_key = cache_key
+        self.started = started
+        self.quality = quality
+        # Future of the rendered artifact fields, filled by the encode stage
+        self.artifacts = artifacts
+        self.classifier_inputs = None
+        # Kept instead of classifier_inputs when the whole chunk is preprocessed on the device
+        self.vessel_input = None
+        self.mask = None
+        self.segmentation = None
+        self.classification = None
+        self.cache_hit = False
+        self.speculation = None
+        self.error = None
+
+
+class ImageAnalyzer:
+    """
+    Runs vessel segmentation and the cascade over a sequence of uploaded images
+
+    Shared by the synchronous /api/predict endpoint and the background job
+    workers. Classification is batched across images, and results are yielded
+    as soon as each image is finished.
+
+    Work is pipelined: decoding and preprocessing run ahead on the decode
+    pool, the calling thread runs the models, and overlays and PNGs are
+    encoded on the encode pool, so image N+1 is prepared while image N is
+    being segmented. Per-stage occupancy is reported by `pipeline_stats`.
+
+    Masks stay at the vessel input's 1024x1024 resolution: the classifier
+    inputs are resampled from them on the model device, and the
+    original-size mask is only materialized for full-resolution artifacts.
+    `vessel_segmenter` can run the U-Net itself at a lower resolution or
+    over overlapping tiles. With `reduced_decode`, large JPEGs are decoded
+    at a reduced scale that still covers the model input, and decoded again
+    in full only for full-resolution artifacts. With `device_preprocessing`
+    the green plane is uploaded once and resized on the model device, and
+    the classifier inputs of each cascade batch are built there in one pass.
+
+    In compact mode the echoed original is left out, and the overlay and
+    binary mask are sent at preview size (a lossy image and a 1-bit PNG);
+    the full-resolution artifacts are rendered from `artifact_store` on
+    request by result id.
+
+    A `quality_gate` checks each decoded image on the decode pool; results
+    carry its assessment, and in reject mode ungradable images are answered
+    with an error before any model runs.
+
+    With a `speculative_cascade`, `analyze(..., speculative=True)` classifies
+    each image on its own as soon as it is segmented, starting every cascade
+    stage at once; results then carry the latency and discarded compute of
+    the speculation.
+    """
+    def __init__(self, model_manager, stage1_threshold, cascade_batch_size,
+                 batch_scheduler=None, prediction_cache=None, cache_artifacts=False,
+                 artifact_store=None, preview_max_side=1024, preview_format='jpeg',
+                 preview_quality=85, decode_workers=0, encode_workers=0, queue_size=8,
+                 device_preprocessing=False, reduced_decode=False, vessel_segmenter=None,
+                 quality_gate=None, speculative_cascade=None):
+        self.model_manager = model_manager
+        self.stage1_threshold = stage1_threshold
+        self.cascade_batch_size = cascade_batch_size
+        self.batch_scheduler = batch_scheduler
+        self.prediction_cache = prediction_cache
+        self.cache_artifacts = cache_artifacts
+        self.artifact_store = artifact_store
+        self.preview_max_side = preview_max_side
+        self.preview_format = preview_format
+        self.preview_quality = preview_quality
+        self.queue_size = queue_size
+        self.device_preprocessing = device_preprocessing
+        self.vessel_segmenter = vessel_segmenter
+        self.quality_gate = quality_gate if quality_gate is not None and quality_gate.enabled else None
+        self.speculative_cascade = speculative_cascade
+        # Recent per-image model time, to estimate what the quality gate saves
+        self.model_seconds = {"vessel": 0.0, "cascade": 0.0}
+        # Smallest side a reduced decode may produce: the vessel input size,
+        # or the preview size if that is larger
+        self.decode_min_side = max(1024, preview_max_side) if reduced_decode else None
+        self.decode_pool = StagePool('decode', decode_workers, queue_size)
+        self.vessel_stage = StageStats('vessel', 1)
+        self.cascade_stage = StageStats('cascade', 1)
+        self.encode_pool = StagePool('encode', encode_workers, queue_size)
+
+    def pipeline_stats(self):
+        return {
+            "decode": self.decode_pool.stats(),
+            "vessel": self.vessel_stage.stats(),
+            "cascade": self.cascade_stage.stats(),
+            "encode": self.encode_pool.stats()
+        }
+
+    def analyze(self, images, compact=False, render_artifacts=None, speculative=False):
+        """
+        Analyze an iterable of (image_id, image_bytes) pairs
+
+        Yields (index, result) pairs. Images waiting for classification are
+        held until a cascade batch fills up, so results can arrive out of
+        input order; `index` is the position in `images`. Each result's
+        `processing_time` covers that image only, from being picked up to
+        its result being ready.
+
+        `render_artifacts(image_id, image_bytes, image_rgb, segmentation,
+        compact)` replaces the built-in artifact encoding on the encode pool
+        and returns the result fields, e.g. to write masks to disk instead.
+
+        `speculative` trades compute for latency when the analyzer has a
+        speculative cascade: images are not batched, and each runs all
+        cascade stages at once. Classifications are the same either way.
+        """
+        # Runs under torch.profiler only while an admin capture is armed
+        session = PROFILER.begin()
+        try:
+            speculative = speculative and self.speculative_cascade is not None
+            for index, result in self._analyze(images, compact, render_artifacts, speculative):
+                if result.get("quality_rejected"):
+                    IMAGES.inc(outcome='quality_rejected')
+                elif "error" in result:
+                    IMAGES.inc(outcome='error')
+                elif result.get("cache_hit"):
+                    IMAGES.inc(outcome='cache_hit')
+                else:
+                    IMAGES.inc(outcome='analyzed')
+                yield index, result
+        finally:
+            if session is not None:
+                PROFILER.end(session)
+
+    def _analyze(self, images, compact, render_artifacts, speculative):
+        # A speculated image is classified alone rather than waiting for a batch
+        batch_size = 1 if speculative else self.cascade_batch_size
+        pending = []
+        # Classified images whose artifacts are still being encoded
+        encoding = deque()
+        # Identical files within one upload are only computed once: `finished`
+        # maps cache keys to completed results, `waiting` to duplicates whose
+        # original is still in flight
+        finished = {}
+        waiting = {}
+
+        for index, image_id, image_bytes, started, prepared in self._prefetch(images):
+            registered = None
+            try:
+                prepared = prepared.result()
+                if prepared is None:
+                    yield index, {"image_id": image_id, "error": "Failed to decode image"}
+                    continue
+                self.vessel_stage.dequeue()
+                image_rgb, cache_key, vessel_input, original_size, quality = prepared
+                if vessel_input is None:
+                    yield index, self._rejected(image_id, quality, started)
+                    continue
+
+                cached = None
+                if cache_key is not None:
+                    if cache_key in finished:
+                        yield index, {**finished[cache_key], "image_id": image_id}
+                        continue
+                    if cache_key in waiting:
+                        waiting[cache_key].append((index, image_id))
+                        continue
+                    cached = self.prediction_cache.get(cache_key)
+
+                if cached is not None and "mask" in cached:
+                    segmentation = VesselSegmentation(unpack_mask(cached["mask"]), original_size)
+                else:
+                    segmentation = self._segment(vessel_input, original_size)
+
+                item = _PendingImage(
+                    index, image_id, cache_key, started,
+                    self.encode_pool.submit(
+                        self._render_artifacts, render_artifacts or self._encode_artifacts,
+                        image_id, image_bytes, image_rgb, segmentation, compact
+                    ),
+                    quality=quality
+                )
+                # Duplicates from here on wait for this image; if it fails
+                # before producing a result they get its error below
+                if cache_key is not None:
+                    waiting[cache_key] = []
+                    registered = cache_key
+
+                if cached is not None:
+                    item.classification = dict(cached["classification"])
+                    item.cache_hit = True
+                    encoding.append(item)
+                else:
+                    if self.device_preprocessing:
+                        item.vessel_input, item.mask = vessel_input, segmentation.mask
+                    else:
+                        item.classifier_inputs = self._classifier_inputs(vessel_input, segmentation)
+                    if self.cache_artifacts:
+                        item.segmentation = segmentation
+                    pending.append(item)
+                    self.cascade_stage.enqueue()
+
+                    if len(pending) >= batch_size:
+                        self._classify(pending, encoding, speculative)
+                        pending = []
+
+            except Exception as e:
+                error = {"image_id": image_id, "error": str(e)}
+                yield index, error
+                # Duplicates that arrived while this image was in flight get its error too
+                if registered is not None:
+                    for duplicate_index, duplicate_id in waiting.pop(registered, []):
+                        yield duplicate_index, {**error, "image_id": duplicate_id}
+
+            yield from self._drain(encoding, finished, waiting, block=False)
+
+        if pending:
+            self._classify(pending, encoding, speculative)
+        yield from self._drain(encoding, finished, waiting, block=True)
+
+    def _prefetch(self, images):
+        """Decode up to `queue_size` images ahead of the inference stage"""
+        in_flight = deque()
+        for index, (image_id, image_bytes) in enumerate(images):
+            started = time.perf_counter()
+            prepared = self.decode_pool.submit(self._prepare, image_bytes)
+            prepared.add_done_callback(self._decoded)
+            in_flight.append((index, image_id, image_bytes, started, prepared))
+            if len(in_flight) > self.queue_size:
+                yield in_flight.popleft()
+        while in_flight:
+            yield in_flight.popleft()
+
+    def _decoded(self, prepared):
+        if prepared.exception() is None and prepared.result() is not None:
+            self.vessel_stage.enqueue()
+
+    def _prepare(self, image_bytes):
+        with STEP_SECONDS.time(step='decode'), annotate('pipeline/decode'):
+            if self.decode_min_side is not None:
+                image_rgb, original_size = decode_image_reduced(image_bytes, self.decode_min_side)
+            else:
+                image_rgb = decode_image(image_bytes)
+                original_size = image_rgb.shape[:2] if image_rgb is not None else None
+        if image_rgb is None:
+            return None
+        quality = None
+        if self.quality_gate is not None:
+            with STEP_SECONDS.time(step='quality_gate'), annotate('pipeline/quality_gate'):
+                quality = self.quality_gate.assess(image_rgb)
+            self._count_quality(quality)
+            if self.quality_gate.rejects(quality):
+                return image_rgb, None, None, original_size, quality
+        cache_key = None
+        if self.prediction_cache is not None:
+            cache_key = self.prediction_cache.key(image_rgb, self.stage1_threshold)
+        with STEP_SECONDS.time(step='preprocess_vessel'), annotate('pipeline/preprocess_vessel'):
+            if self.device_preprocessing:
+                vessel_input, _ = preprocess_on_device_for_vessel(image_rgb, self.model_manager.device)
+            else:
+                vessel_input, _ = preprocess_for_vessel(image_rgb)
+        return image_rgb, cache_key, vessel_input, original_size, quality
+
+    def _count_quality(self, quality):
+        if quality["gradable"]:
+            outcome = 'passed'
+        else:
+            outcome = 'rejected' if self.quality_gate.rejects(quality) else 'flagged'
+        QUALITY_GATE_IMAGES.inc(outcome=outcome)
+        for issue in quality["issues"]:
+            QUALITY_GATE_ISSUES.inc(issue=issue)
+
+    def _rejected(self, image_id, quality, started):
+        """Result for an image the quality gate kept away from the models"""
+        QUALITY_GATE_SKIPPED_PASSES.inc(model='vessel')
+        QUALITY_GATE_SKIPPED_PASSES.inc(model='stage1')
+        QUALITY_GATE_SAVED_SECONDS.inc(self.model_seconds["vessel"] + self.model_seconds["cascade"])
+        return {
+            "image_id": image_id,
+            "error": quality_issues_message(quality),
+            "quality": quality,
+            "quality_rejected": True,
+            "processing_time": time.perf_counter() - started
+        }
+
+    def _record_model_seconds(self, model, seconds):
+        # Exponential moving average, seeded by the first measurement
+        previous = self.model_seconds[model]
+        self.model_seconds[model] = seconds if not previous else 0.9 * previous + 0.1 * seconds
+
+    def _classifier_inputs(self, vessel_input, segmentation):
+        with STEP_SECONDS.time(step='preprocess_classification'), \
+                annotate('pipeline/preprocess_classification'):
+            return classifier_inputs_from_vessel(
+                vessel_input, segmentation.mask, self.model_manager.device
+            )
+
+    def _batch_classifier_inputs(self, chunk):
+        with STEP_SECONDS.time(step='preprocess_classification'), \
+                annotate('pipeline/preprocess_classification'):
+            inputs = classifier_inputs_for_batch(
+                [item.vessel_input for item in chunk], [item.mask for item in chunk],
+                self.model_manager.device
+            )
+        for item in chunk:
+            item.vessel_input = item.mask = None
+        return inputs
+
+    def _segment(self, vessel_input, original_size):
+        run_vessel = self.batch_scheduler.run_vessel if self.batch_scheduler is not None else None
+        start = time.perf_counter()
+        with self.vessel_stage.running():
+            segmentation = segment_vessel_input(
+                vessel_input, original_size, self.model_manager.vessel_model,
+                self.model_manager.device, run_model=run_vessel, segmenter=self.vessel_segmenter
+            )
+        self._record_model_seconds('vessel', time.perf_counter() - start)
+        return segmentation
+
+    def _render_artifacts(self, render, image_id, image_bytes, image_rgb, segmentation, compact):
+        with STEP_SECONDS.time(step='encode'), annotate('pipeline/encode'):
+            return render(image_id, image_bytes, image_rgb, segmentation, compact)
+
+    def _encode_artifacts(self, image_id, image_bytes, image_rgb, segmentation, compact):
+        if not compact:
+            if image_rgb.shape[:2] != segmentation.original_size:
+                # Analysis ran on a reduced decode; full artifacts need every pixel
+                image_rgb = decode_image(image_bytes)
+            vessel_mask = segmentation.full_mask()
+            vessel_viz = create_vessel_visualization(image_rgb, vessel_mask)
+            vessel_mask_rgb = cv2.cvtColor(vessel_mask * 255, cv2.COLOR_GRAY2RGB)
+            return {
+                "image_id": image_id,
+                "original_image": encode_image_to_base64(image_rgb),
+                "vessel_map": encode_image_to_base64(vessel_viz),
+                "binary_vessel_map": encode_image_to_base64(vessel_mask_rgb)
+            }
+
+        preview = encode_overlay_preview(
+            image_rgb, segmentation.mask, self.preview_max_side,
+            image_format=self.preview_format, quality=self.preview_quality
+        )
+        preview_mask = resize_mask(
+            segmentation.mask, preview_size(image_rgb.shape[:2], self.preview_max_side)
+        )
+        result = {
+            "image_id": image_id,
+            "vessel_map": base64.b64encode(preview).decode('utf-8'),
+            "binary_vessel_map": base64.b64encode(encode_binary_mask_png(preview_mask)).decode('utf-8'),
+            "artifact_types": {
+                "vessel_map": PREVIEW_FORMATS[self.preview_format][1],
+                "binary_vessel_map": "image/png"
+            }
+        }
+        if self.artifact_store is not None:
+            result_id = self.artifact_store.put(
+                image_bytes, segmentation.mask, segmentation.original_size
+            )
+            result["result_id"] = result_id
+            result["artifact_urls"] = {
+                name: f"/api/results/{result_id}/{name}"
+                for name in ARTIFACT_NAMES
+            }
+        return result
+
+    def _classify(self, chunk, encoding, speculative=False):
+        # Stage 1 runs on the whole chunk and the deeper stages only on the
+        # images routed to them
+        run_stage = self.batch_scheduler.run_stage if self.batch_scheduler is not None else None
+        device = self.model_manager.device
+        self.cascade_stage.dequeue(len(chunk))
+        try:
+            if self.device_preprocessing:
+                vessel_batch, green_batch = self._batch_classifier_inputs(chunk)
+            else:
+                inputs = [item.classifier_inputs for item in chunk]
+                vessel_batch = torch.cat([vessel_input for vessel_input, _ in inputs]).to(device)
+                green_batch = torch.cat([green_input for _, green_input in inputs]).to(device)
+
+            start = time.perf_counter()
+            speculation = None
+            with self.cascade_stage.running(len(chunk)):
+                if speculative:
+                    classification_results, speculation = self.speculative_cascade.classify(
+                        vessel_batch, green_batch, self.model_manager,
+                        stage1_threshold=self.stage1_threshold, run_stage=run_stage
+                    )
+                else:
+                    classification_results = cascade_classify_batch(
+                        vessel_batch, green_batch, self.model_manager,
+                        stage1_threshold=self.stage1_threshold, run_stage=run_stage
+                    )
+            self._record_model_seconds('cascade', (time.perf_counter() - start) / len(chunk))
+        except Exception as e:
+            for item in chunk:
+                item.error = str(e)
+                encoding.append(item)
+            return
+
+        for item, classification_result in zip(chunk, classification_results):
+            item.classification = classification_result
+            item.speculation = speculation
+            CASCADE_EXITS.inc(
+                node=exit_node(classification_result), grade=classification_result["grade"]
+            )
+            if item.cache_key is not None:
+                entry = {"classification": classification_result}
+                if self.cache_artifacts:
+                    entry["mask"] = pack_mask(item.segmentation.mask)
+                self.prediction_cache.put(item.cache_key, entry)
+            item.segmentation = None
+            encoding.append(item)
+
+    def _drain(self, encoding, finished, waiting, block):
+        """Yield classified images in order once their artifacts are encoded"""
+        while encoding and (block or encoding[0].error is not None or encoding[0].artifacts.done()
+                            or len(encoding) > self.queue_size):
+            item = encoding.popleft()
+            if item.error is None:
+                try:
+                    result = item.artifacts.result()
+                except Exception as e:
+                    item.error = str(e)
+            if item.error is not None:
+                result = {"image_id": item.image_id, "error": item.error}
+            else:
+                result["classification"] = item.classification
+                result["processing_time"] = time.perf_counter() - item.started
+                IMAGE_SECONDS.observe(result["processing_time"])
+                if item.cache_hit:
+                    result["cache_hit"] = True
+            if item.quality is not None:
+                result["quality"] = item.quality
+            if item.speculation is not None and item.error is None:
+                result["speculation"] = item.speculation
+            yield from self._finish(item.index, result, item.cache_key, finished, waiting)
+
+    def _finish(self, index, result, cache_key, finished, waiting):
+        yield index, result
+        if cache_key is None:
+            return
+        finished[cache_key] = result
+        for duplicate_index, duplicate_id in waiting.pop(cache_key, []):
+            yield duplicate_index, {**result, "image_id": duplicate_id}
@@ -0,0 +1,143 @@
+import base64
+import threading
+import uuid
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from services.preprocessing import create_vessel_visualization, resize_mask
+
+ARTIFACT_NAMES = ('original', 'vessel_map', 'binary_vessel_map')
+PREVIEW_FORMATS = {
+    'jpeg': ('.jpg', 'image/jpeg', cv2.IMWRITE_JPEG_QUALITY),
+    'webp': ('.webp', 'image/webp', cv2.IMWRITE_WEBP_QUALITY)
+}
+
+
+def encode_image_to_base64(image_rgb):
+    image_bgr = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2BGR)
+    success, buffer = cv2.imencode('.png', image_bgr)
+    if not success:
+        raise ValueError("Failed to encode image")
+    return base64.b64encode(buffer).decode('utf-8')
+
+
+def encode_binary_mask_png(vessel_mask):
+    """Encode a 0/1 mask as a 1-bit grayscale PNG"""
+    success, buffer = cv2.imencode('.png', vessel_mask * 255, [cv2.IMWRITE_PNG_BILEVEL, 1])
+    if not success:
+        raise ValueError("Failed to encode mask")
+    return buffer.tobytes()
+
+
+def preview_size(original_size, max_side):
+    """(height, width) of a preview with its longest side capped at `max_side`"""
+    height, width = original_size
+    scale = min(1.0, max_side / max(height, width))
+    return max(1, round(height * scale)), max(1, round(width * scale))
+
+
+def encode_overlay_preview(image_rgb, vessel_mask, max_side, image_format='jpeg', quality=85):
+    """
+    Render the vessel overlay with its longest side capped at `max_side` as a lossy image
+
+    `vessel_mask` may be at any resolution (e.g. the 1024x1024 working mask);
+    it is resampled straight to the preview size.
+    """
+    size = preview_size(image_rgb.shape[:2], max_side)
+    if size != image_rgb.shape[:2]:
+        image_rgb = cv2.resize(image_rgb, (size[1], size[0]), interpolation=cv2.INTER_AREA)
+    vessel_mask = resize_mask(vessel_mask, size)
+
+    extension, _, quality_flag = PREVIEW_FORMATS[image_format]
+    overlay_bgr = cv2.cvtColor(create_vessel_visualization(image_rgb, vessel_mask), cv2.COLOR_RGB2BGR)
+    success, buffer = cv2.imencode(extension, overlay_bgr, [quality_flag, quality])
+    if not success:
+        raise ValueError("Failed to encode preview")
+    return buffer.tobytes()
+
+
+def pack_mask(vessel_mask):
+    """Bit-pack a 0/1 mask into a JSON-serialisable dict (1 bit per pixel)"""
+    return {
+        "shape": list(vessel_mask.shape),
+        "bits": base64.b64encode(np.packbits(vessel_mask.astype(bool))).decode('ascii')
+    }
+
+
+def unpack_mask(packed):
+    height, width = packed["shape"]
+    bits = np.frombuffer(base64.b64decode(packed["bits"]), dtype=np.uint8)
+    return np.unpackbits(bits, count=height * width).reshape(height, width)
+
+
+def sniff_image_type(image_bytes):
+    if image_bytes.startswith(b'\x89PNG'):
+        return 'image/png'
+    if image_bytes.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if image_bytes.startswith(b'BM'):
+        return 'image/bmp'
+    return 'application/octet-stream'
+
+
+class ArtifactStore:
+    """
+    In-memory LRU of the inputs needed to render full-resolution artifacts
+
+    Stores the uploaded bytes and the bit-packed 1024x1024 working mask
+    rather than encoded images, so an entry costs roughly the upload size plus
+    128 KB. Artifacts are rendered on request, upsampling the mask to the
+    original resolution only then.
+    """
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+
+    def put(self, image_bytes, vessel_mask, original_size):
+        result_id = uuid.uuid4().hex
+        packed = np.packbits(vessel_mask.astype(bool))
+        size = len(image_bytes) + packed.nbytes
+        with self.lock:
+            self.entries[result_id] = (image_bytes, packed, vessel_mask.shape, original_size, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and len(self.entries) > 1:
+                _, (_, _, _, _, evicted_size) = self.entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+        return result_id
+
+    def contains(self, result_id):
+        with self.lock:
+            return result_id in self.entries
+
+    def render(self, result_id, artifact):
+        """Return (bytes, mimetype) for one artifact, or None if the result has expired"""
+        with self.lock:
+            entry = self.entries.get(result_id)
+            if entry is None:
+                return None
+            self.entries.move_to_end(result_id)
+        image_bytes, packed, shape, original_size, _ = entry
+
+        if artifact == 'original':
+            return image_bytes, sniff_image_type(image_bytes)
+
+        vessel_mask = np.unpackbits(packed, count=shape[0] * shape[1]).reshape(shape)
+        vessel_mask = resize_mask(vessel_mask, original_size)
+        if artifact == 'binary_vessel_map':
+            return encode_binary_mask_png(vessel_mask), 'image/png'
+
+        image_bgr = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+        image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+        overlay_bgr = cv2.cvtColor(create_vessel_visualization(image_rgb, vessel_mask), cv2.COLOR_RGB2BGR)
+        success, buffer = cv2.imencode('.png', overlay_bgr)
+        if not success:
+            raise ValueError("Failed to encode image")
+        return buffer.tobytes(), 'image/png'
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.current_bytes}
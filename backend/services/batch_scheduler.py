@@ -0,0 +1,141 @@
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+
+import torch
+
+from services.cascade_inference import run_cascade_stage
+from services.vessel_inference import run_vessel_model
+
+SCHEDULED_MODELS = ('vessel', 'stage1', 'stage2', 'stage3a', 'stage3b')
+
+
+class _PendingItem:
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.rows = inputs[0].shape[0]
+        self.enqueued_at = time.monotonic()
+        self.future = Future()
+
+
+class _ModelQueue:
+    """Queue for one model that flushes on max batch size or max wait time"""
+    def __init__(self, name, run_batch, max_batch_size, max_wait_ms):
+        self.name = name
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        self.condition = threading.Condition()
+        self.items = deque()
+        self.pending_rows = 0
+
+        self.batch_size_histogram = Counter()
+        self.num_batches = 0
+        self.num_rows = 0
+
+        self.thread = threading.Thread(
+            target=self._worker, name=f"batch-scheduler-{name}", daemon=True
+        )
+        self.thread.start()
+
+    def submit(self, *inputs):
+        item = _PendingItem(inputs)
+        with self.condition:
+            self.items.append(item)
+            self.pending_rows += item.rows
+            self.condition.notify()
+        return item.future
+
+    def _next_batch(self):
+        with self.condition:
+            while not self.items:
+                self.condition.wait()
+
+            deadline = self.items[0].enqueued_at + self.max_wait
+            while self.pending_rows < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            batch = [self.items.popleft()]
+            rows = batch[0].rows
+            while self.items and rows + self.items[0].rows <= self.max_batch_size:
+                item = self.items.popleft()
+                batch.append(item)
+                rows += item.rows
+            self.pending_rows -= rows
+            return batch, rows
+
+    def _worker(self):
+        while True:
+            batch, rows = self._next_batch()
+            self.batch_size_histogram[rows] += 1
+            self.num_batches += 1
+            self.num_rows += rows
+
+            try:
+                inputs = [
+                    torch.cat([item.inputs[i] for item in batch])
+                    for i in range(len(batch[0].inputs))
+                ]
+                outputs = self.run_batch(*inputs)
+                splits = torch.split(outputs, [item.rows for item in batch])
+                for item, output in zip(batch, splits):
+                    item.future.set_result(output)
+            except Exception as e:
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_exception(e)
+
+    def stats(self):
+        with self.condition:
+            queue_depth = self.pending_rows
+        return {
+            "queue_depth": queue_depth,
+            "batches": self.num_batches,
+            "images": self.num_rows,
+            "batch_size_histogram": {
+                str(size): count for size, count in sorted(self.batch_size_histogram.items())
+            }
+        }
+
+
+class MicroBatchScheduler:
+    """
+    Coalesces concurrent requests into per-model batches in front of a ModelManager
+
+    Each model (vessel, stage1, stage2, stage3a, stage3b) has its own queue and
+    worker thread. A queue is flushed as one forward pass once it holds
+    `max_batch_size` images or its oldest entry has waited `max_wait_ms`.
+    Callers block on their own slice of the batched output.
+    """
+    def __init__(self, model_manager, max_batch_size=8, max_wait_ms=10):
+        self.model_manager = model_manager
+        self.queues = {
+            'vessel': _ModelQueue(
+                'vessel',
+                lambda x: run_vessel_model(model_manager.get_model('vessel'), x),
+                max_batch_size, max_wait_ms
+            )
+        }
+        for stage in SCHEDULED_MODELS[1:]:
+            self.queues[stage] = _ModelQueue(
+                stage, self._stage_runner(stage), max_batch_size, max_wait_ms
+            )
+
+    def _stage_runner(self, stage):
+        def run(vessel, green):
+            return run_cascade_stage(self.model_manager, stage, vessel, green)
+        return run
+
+    def run_vessel(self, input_tensor):
+        return self.queues['vessel'].submit(input_tensor).result()
+
+    def run_stage(self, stage, vessel_input, green_input):
+        return self.queues[stage].submit(vessel_input, green_input).result()
+
+    def stats(self):
+        return {name: queue.stats() for name, queue in self.queues.items()}
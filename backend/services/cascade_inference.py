@@ -1,15 +1,16 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 import torch.nn.functional as F
 
+from services.metrics import STEP_SECONDS, SPECULATIVE_CASCADES, SPECULATIVE_STAGE_SECONDS
+from services.profiling import annotate
 
-def cascade_classify(vessel_input, green_input, model_manager, stage1_threshold=0.35):
-    if model_manager.use_fp16:
-        vessel_input = vessel_input.half()
-        green_input = green_input.half()
-
-    model_manager.stage1_cascade.eval()
 
-    results = {
+def _empty_result():
+    return {
         "has_dr": False,
         "severity": "No DR",
         "grade": 0,
@@ -19,70 +20,225 @@ def cascade_classify(vessel_input, green_input, model_manager, stage1_threshold=
         "stage3_result": None
     }
 
-    with torch.no_grad():
-        cascade_logits, _, _, _ = model_manager.stage1_cascade(vessel_input, green_input)
-        cascade_probs = F.softmax(cascade_logits, dim=1)
-        prob_no_dr = cascade_probs[0, 0].item()
-        prob_dr = cascade_probs[0, 1].item()
-        has_dr = prob_dr >= stage1_threshold
-
-    if not has_dr:
-        results["has_dr"] = False
-        results["severity"] = "No DR"
-        results["grade"] = 0
-        results["confidence"] = prob_no_dr
-        results["stage1_result"] = f"No DR (P(DR)={prob_dr:.3f})"
-        return results
 
-    results["has_dr"] = True
-    results["stage1_result"] = "DR (Ensemble)"
+def run_cascade_stage(model_manager, stage, vessel_input, green_input):
+    """Run one cascade stage on a batch and return its softmax probabilities on the CPU"""
+    model = model_manager.get_model(stage)
+    with STEP_SECONDS.time(step=stage), annotate(f'cascade/{stage}'), torch.inference_mode():
+        main_logits, _, _, _ = model(vessel_input, green_input)
+        probs = F.softmax(main_logits, dim=1).float().cpu()
+    return probs
 
-    model_manager.load_stage2()
 
-    with torch.no_grad():
-        main_logits, _, _, _ = model_manager.stage2_model(vessel_input, green_input)
-        probs = F.softmax(main_logits, dim=1)
-        pred = torch.argmax(probs, dim=1).item()
-        stage2_confidence = probs[0, pred].item()
+def _select(tensor, indices):
+    if len(indices) == tensor.shape[0]:
+        return tensor
+    index_tensor = torch.tensor(indices, dtype=torch.long, device=tensor.device)
+    return tensor.index_select(0, index_tensor)
 
-    if pred == 0:
-        results["stage2_result"] = "Early DR"
-        model_manager.load_stage3a()
 
-        with torch.no_grad():
-            main_logits, _, _, _ = model_manager.stage3a_model(vessel_input, green_input)
-            probs = F.softmax(main_logits, dim=1)
-            pred = torch.argmax(probs, dim=1).item()
-            confidence = probs[0, pred].item()
+def cascade_classify_batch(vessel_input, green_input, model_manager, stage1_threshold=0.35,
+                           run_stage=None):
+    """
+    Run the 4-stage cascade on a batch of images
 
-        if pred == 0:
-            results["severity"] = "Grade 1"
-            results["grade"] = 1
-            results["stage3_result"] = "Grade 1"
+    Stage 1 sees the whole batch; stage 2 only the rows predicted as DR, and
+    stage 3a/3b only the rows routed to them by stage 2.
+
+    Args:
+        vessel_input: tensor of shape (N, 1, 288, 288) on the model device
+        green_input: tensor of shape (N, 1, 288, 288) on the model device
+        model_manager: ModelManager holding the cascade models
+        stage1_threshold: minimum P(DR) for an image to be treated as DR
+        run_stage: optional callable (stage, vessel, green) -> probabilities used
+            instead of calling the models directly, e.g. a batch scheduler
+
+    Returns:
+        list of N result dicts, in the same order as the input rows
+    """
+    if model_manager.use_fp16:
+        vessel_input = vessel_input.half()
+        green_input = green_input.half()
+
+    if run_stage is None:
+        def run_stage(stage, vessel, green):
+            return run_cascade_stage(model_manager, stage, vessel, green)
+
+    num_images = vessel_input.shape[0]
+    results = [_empty_result() for _ in range(num_images)]
+    if num_images == 0:
+        return results
+
+    cascade_probs = run_stage('stage1', vessel_input, green_input).tolist()
+
+    dr_indices = []
+    for idx, (prob_no_dr, prob_dr) in enumerate(cascade_probs):
+        if prob_dr >= stage1_threshold:
+            results[idx]["has_dr"] = True
+            results[idx]["stage1_result"] = "DR (Ensemble)"
+            dr_indices.append(idx)
         else:
-            results["severity"] = "Grade 2"
-            results["grade"] = 2
-            results["stage3_result"] = "Grade 2"
-        results["confidence"] = confidence
+            results[idx]["confidence"] = prob_no_dr
+            results[idx]["stage1_result"] = f"No DR (P(DR)={prob_dr:.3f})"
 
-    else:
-        results["stage2_result"] = "Advanced DR"
-        model_manager.load_stage3b()
+    if not dr_indices:
+        return results
 
-        with torch.no_grad():
-            main_logits, _, _, _ = model_manager.stage3b_model(vessel_input, green_input)
-            probs = F.softmax(main_logits, dim=1)
-            pred = torch.argmax(probs, dim=1).item()
-            confidence = probs[0, pred].item()
+    stage2_probs = run_stage(
+        'stage2', _select(vessel_input, dr_indices), _select(green_input, dr_indices)
+    )
+    stage2_preds = torch.argmax(stage2_probs, dim=1).tolist()
 
+    early_indices = []
+    advanced_indices = []
+    for idx, pred in zip(dr_indices, stage2_preds):
         if pred == 0:
-            results["severity"] = "Grade 3"
-            results["grade"] = 3
-            results["stage3_result"] = "Grade 3"
+            results[idx]["stage2_result"] = "Early DR"
+            early_indices.append(idx)
         else:
-            results["severity"] = "Grade 4"
-            results["grade"] = 4
-            results["stage3_result"] = "Grade 4"
-        results["confidence"] = confidence
+            results[idx]["stage2_result"] = "Advanced DR"
+            advanced_indices.append(idx)
+
+    if early_indices:
+        _apply_stage3(results, run_stage, 'stage3a', vessel_input, green_input,
+                      early_indices, grades=(1, 2))
+
+    if advanced_indices:
+        _apply_stage3(results, run_stage, 'stage3b', vessel_input, green_input,
+                      advanced_indices, grades=(3, 4))
 
     return results
+
+
+def _apply_stage3(results, run_stage, stage, vessel_input, green_input, indices, grades):
+    probs = run_stage(stage, _select(vessel_input, indices), _select(green_input, indices))
+    confidences, preds = torch.max(probs, dim=1)
+    for idx, pred, confidence in zip(indices, preds.tolist(), confidences.tolist()):
+        grade = grades[pred]
+        results[idx]["severity"] = f"Grade {grade}"
+        results[idx]["grade"] = grade
+        results[idx]["stage3_result"] = f"Grade {grade}"
+        results[idx]["confidence"] = confidence
+
+
+def cascade_classify(vessel_input, green_input, model_manager, stage1_threshold=0.35,
+                     run_stage=None):
+    return cascade_classify_batch(
+        vessel_input, green_input, model_manager, stage1_threshold=stage1_threshold,
+        run_stage=run_stage
+    )[0]
+
+
+class SpeculativeCascade:
+    """
+    Low-latency cascade for a single image: every stage starts at once
+
+    The serial cascade runs stage 1, reads its routing back, then runs
+    stage 2, reads it back, then stage 3a or 3b. Here stage 1 runs on the
+    calling thread while stages 2, 3a and 3b run on a thread pool with the
+    same inputs, each on its own CUDA stream when the models are on a GPU.
+    The routing is then resolved from the finished outputs, and branches it
+    does not reach are discarded (a failed one only matters if it is
+    reached).
+
+    Only batches of one image are speculated: every stage then sees exactly
+    the tensor the serial path would give it, so the result is identical.
+    Larger batches run serially. Latency drops towards that of the slowest
+    stage, at the cost of running stages whose output is thrown away;
+    `classify` reports both for each speculated image.
+    """
+    BRANCHES = ('stage2', 'stage3a', 'stage3b')
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(
+            max_workers=len(self.BRANCHES), thread_name_prefix='speculative'
+        )
+        self.streams = {}
+        self._lock = threading.Lock()
+
+    def _stream(self, stage, device):
+        with self._lock:
+            if stage not in self.streams:
+                self.streams[stage] = torch.cuda.Stream(device=device)
+            return self.streams[stage]
+
+    @staticmethod
+    def _run(run_stage, stage, vessel_input, green_input, stream=None):
+        start = time.perf_counter()
+        try:
+            if stream is None:
+                probs = run_stage(stage, vessel_input, green_input)
+            else:
+                with torch.cuda.stream(stream):
+                    probs = run_stage(stage, vessel_input, green_input)
+            error = None
+        except Exception as e:
+            probs, error = None, e
+        return probs, error, time.perf_counter() - start
+
+    def classify(self, vessel_input, green_input, model_manager, stage1_threshold=0.35,
+                 run_stage=None):
+        """
+        Returns:
+            (results, report): results as from cascade_classify_batch; for a
+            speculated image, report holds latency_seconds, compute_seconds
+            (all four stages), discarded_seconds and the stages used and
+            discarded. report is None when the batch ran serially.
+        """
+        if vessel_input.shape[0] != 1:
+            return cascade_classify_batch(
+                vessel_input, green_input, model_manager, stage1_threshold=stage1_threshold,
+                run_stage=run_stage
+            ), None
+
+        if model_manager.use_fp16:
+            vessel_input = vessel_input.half()
+            green_input = green_input.half()
+        # Streams only matter when the models run here rather than behind a scheduler
+        use_streams = run_stage is None and vessel_input.device.type == 'cuda'
+        if run_stage is None:
+            def run_stage(stage, vessel, green):
+                return run_cascade_stage(model_manager, stage, vessel, green)
+
+        start = time.perf_counter()
+        futures = {}
+        for stage in self.BRANCHES:
+            stream = None
+            if use_streams:
+                stream = self._stream(stage, vessel_input.device)
+                # The inputs were produced on the current stream
+                stream.wait_stream(torch.cuda.current_stream(vessel_input.device))
+            futures[stage] = self.executor.submit(
+                self._run, run_stage, stage, vessel_input, green_input, stream
+            )
+        outputs = {'stage1': self._run(run_stage, 'stage1', vessel_input, green_input)}
+        outputs.update({stage: future.result() for stage, future in futures.items()})
+
+        used = []
+
+        def resolved_stage(stage, vessel, green):
+            probs, error, _ = outputs[stage]
+            used.append(stage)
+            if error is not None:
+                raise error
+            return probs
+
+        results = cascade_classify_batch(
+            vessel_input, green_input, model_manager, stage1_threshold=stage1_threshold,
+            run_stage=resolved_stage
+        )
+        latency = time.perf_counter() - start
+
+        discarded = [stage for stage in outputs if stage not in used]
+        used_seconds = sum(outputs[stage][2] for stage in used)
+        discarded_seconds = sum(outputs[stage][2] for stage in discarded)
+        SPECULATIVE_CASCADES.inc()
+        SPECULATIVE_STAGE_SECONDS.inc(used_seconds, outcome='used')
+        SPECULATIVE_STAGE_SECONDS.inc(discarded_seconds, outcome='discarded')
+        return results, {
+            "latency_seconds": latency,
+            "compute_seconds": used_seconds + discarded_seconds,
+            "discarded_seconds": discarded_seconds,
+            "stages_used": used,
+            "stages_discarded": discarded
+        }
@@ -0,0 +1,95 @@
+import struct
+
+import cv2
+import numpy as np
+
+# DCT-domain downscaling factors libjpeg can apply while decoding
+REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2)
+)
+
+# Start-of-frame markers carry the frame size; C4, C8 and CC share the
+# range but are DHT, JPG and DAC segments
+_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def jpeg_dimensions(image_bytes):
+    """(height, width) from a JPEG's frame header, or None if it is not a readable JPEG"""
+    if not image_bytes.startswith(b'\xff\xd8'):
+        return None
+    offset = 2
+    length = len(image_bytes)
+    while offset + 4 <= length:
+        if image_bytes[offset] != 0xFF:
+            return None
+        marker = image_bytes[offset + 1]
+        if marker == 0xFF:
+            # Fill byte
+            offset += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            # Standalone markers have no length field
+            offset += 2
+            continue
+        if marker in (0xD9, 0xDA):
+            # End of image or start of scan before any frame header
+            return None
+        segment_length = struct.unpack('>H', image_bytes[offset + 2:offset + 4])[0]
+        if marker in _SOF_MARKERS:
+            if offset + 9 > length:
+                return None
+            height, width = struct.unpack('>HH', image_bytes[offset + 5:offset + 9])
+            return (height, width) if height and width else None
+        offset += 2 + segment_length
+    return None
+
+
+def reduced_decode_factor(size, min_side):
+    """Largest libjpeg scale factor that keeps both sides of `size` at least `min_side`"""
+    height, width = size
+    for factor, flag in REDUCED_DECODE_FLAGS:
+        # libjpeg rounds scaled dimensions up
+        if min(-(-height // factor), -(-width // factor)) >= min_side:
+            return factor, flag
+    return 1, cv2.IMREAD_COLOR
+
+
+def decode_image(image_bytes):
+    """Decode uploaded bytes to an RGB array, or None if they are not an image"""
+    nparr = np.frombuffer(image_bytes, np.uint8)
+    image_bgr = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    if image_bgr is None:
+        return None
+    return cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+
+
+def decode_image_reduced(image_bytes, min_side=1024):
+    """
+    Decode an upload at the lowest resolution that still covers `min_side`
+
+    Large JPEGs are decoded with libjpeg's DCT scaling (1/2, 1/4 or 1/8),
+    which skips most of the inverse DCT work and never allocates the
+    full-resolution buffer. Other formats, and JPEGs too small to scale,
+    are decoded in full.
+
+    Returns:
+        image_rgb: numpy array in RGB format, possibly downscaled, or None
+            if the bytes are not an image
+        original_size: (height, width) of the image at full resolution
+    """
+    dimensions = jpeg_dimensions(image_bytes)
+    factor, flag = reduced_decode_factor(dimensions, min_side) if dimensions else (1, None)
+    if factor == 1:
+        image_rgb = decode_image(image_bytes)
+        return image_rgb, image_rgb.shape[:2] if image_rgb is not None else None
+
+    image_bgr = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), flag)
+    if image_bgr is None:
+        return None, None
+    height, width = dimensions
+    # The frame header is stored before EXIF orientation is applied
+    if image_bgr.shape[:2] != (-(-height // factor), -(-width // factor)):
+        height, width = width, height
+    return cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB), (height, width)
@@ -0,0 +1,142 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+
+class JobQueueFull(Exception):
+    """Raised when too many jobs are already waiting for a worker"""
+
+
+class Job:
+    def __init__(self, images, compact=False, errors=None):
+        self.id = uuid.uuid4().hex
+        self.images = images
+        self.compact = compact
+        self.total = len(images)
+        # Results decided at upload (e.g. oversized parts); those images are not analyzed
+        self.errors = errors or {}
+        self.status = 'queued'
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # (index, result) in completion order; streams replay it from any offset
+        self.events = sorted(self.errors.items())
+        self.condition = threading.Condition()
+
+    @property
+    def done(self):
+        return self.status in ('completed', 'failed')
+
+    def add_result(self, index, result):
+        with self.condition:
+            self.events.append((index, result))
+            self.condition.notify_all()
+
+    def set_status(self, status, error=None):
+        with self.condition:
+            self.status = status
+            self.error = error
+            if status == 'running':
+                self.started_at = time.time()
+            elif self.done:
+                self.finished_at = time.time()
+                self.images = None
+            self.condition.notify_all()
+
+    def wait_for_events(self, offset, timeout):
+        """Return events after `offset`, blocking up to `timeout` seconds for new ones"""
+        with self.condition:
+            if len(self.events) <= offset and not self.done:
+                self.condition.wait(timeout)
+            return self.events[offset:], self.done
+
+    def progress(self):
+        with self.condition:
+            return {
+                "status": self.status,
+                "completed": len(self.events),
+                "total": self.total,
+                "error": self.error,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at
+            }
+
+    def ordered_results(self):
+        with self.condition:
+            return [
+                {"index": index, **result}
+                for index, result in sorted(self.events, key=lambda event: event[0])
+            ]
+
+
+class JobManager:
+    """
+    Runs analysis jobs on a bounded pool of background workers
+
+    At most `max_workers` jobs run at once and at most `max_queued` wait for a
+    worker; submissions beyond that raise JobQueueFull. Finished jobs are kept
+    for `ttl_seconds` so clients can poll or re-read their results. With an
+    AdmissionController, a worker also waits for an inference slot before its
+    job starts running, so jobs and synchronous requests share one limit.
+    """
+    def __init__(self, analyzer, max_workers=1, max_queued=16, ttl_seconds=3600, admission=None):
+        self.analyzer = analyzer
+        self.admission = admission
+        self.max_queued = max_queued
+        self.ttl_seconds = ttl_seconds
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job-worker")
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+
+    def submit(self, images, compact=False, errors=None):
+        """Queue a job for a list of (image_id, image_bytes) pairs, with results already known by index"""
+        with self.lock:
+            self._expire()
+            queued = sum(1 for job in self.jobs.values() if job.status == 'queued')
+            if queued >= self.max_queued:
+                raise JobQueueFull(f"{queued} jobs are already queued")
+            job = Job(images, compact=compact, errors=errors)
+            self.jobs[job.id] = job
+
+        self.executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _run(self, job):
+        # Jobs are already bounded by max_queued, so they skip the admission queue limit
+        slot = self.admission.admit(bounded=False, endpoint='jobs') if self.admission else nullcontext()
+        try:
+            with slot:
+                job.set_status('running')
+                indices = [index for index in range(job.total) if index not in job.errors]
+                images = (job.images[index] for index in indices)
+                for position, result in self.analyzer.analyze(images, compact=job.compact):
+                    job.add_result(indices[position], result)
+        except Exception as e:
+            job.set_status('failed', error=str(e))
+            return
+        job.set_status('completed')
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl_seconds
+        expired = [
+            job_id for job_id, job in self.jobs.items()
+            if job.done and job.finished_at < cutoff
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def stats(self):
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return counts
@@ -0,0 +1,218 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BYTE_BUCKETS = tuple(64 * 1024 * 4 ** i for i in range(8))  # 64 KB .. 1 GB
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple((name, str(labels[name])) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted(self.values.items())
+        lines.extend(self._render_samples(items))
+        return lines
+
+    def _render_samples(self, items):
+        return [f"{self.name}{_format_labels(key)} {_format_value(value)}" for key, value in items]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(key, (None, 0.0))
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_samples(self, items):
+        lines = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = key + (('le', _format_value(bound)),)
+                lines.append(f"{self.name}_bucket{_format_labels(labels)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Minimal Prometheus text-format registry
+
+    Metrics are updated in place under a per-metric lock, so recording a
+    sample costs a dict lookup and an addition. Collectors are callables run
+    at scrape time that return extra metrics, for state that already lives
+    elsewhere (model load durations, queue occupancy).
+    """
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            for metric in collector():
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+STEP_SECONDS = REGISTRY.histogram(
+    'dr_step_duration_seconds',
+    'Time spent in each pipeline step (model steps are per forward call)',
+    ['step']
+)
+IMAGE_SECONDS = REGISTRY.histogram(
+    'dr_image_processing_seconds', 'Time from picking up an image to its result being ready'
+)
+IMAGES = REGISTRY.counter(
+    'dr_images_processed_total', 'Images analyzed, by outcome', ['outcome']
+)
+CASCADE_EXITS = REGISTRY.counter(
+    'dr_cascade_exits_total', 'Images leaving the cascade at each node', ['node', 'grade']
+)
+MODEL_LOADS = REGISTRY.counter(
+    'dr_model_loads_total', 'Model loads; deeper cascade stages load lazily on first use', ['model']
+)
+MODEL_EVICTIONS = REGISTRY.counter(
+    'dr_model_evictions_total', 'Cascade stages dropped to stay within the memory budget', ['model']
+)
+REQUESTS = REGISTRY.counter(
+    'dr_http_requests_total', 'HTTP requests handled', ['endpoint', 'status']
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    'dr_http_request_duration_seconds', 'HTTP request latency, including streamed bodies', ['endpoint']
+)
+REQUESTS_IN_FLIGHT = REGISTRY.gauge(
+    'dr_http_requests_in_flight', 'HTTP requests currently being handled'
+)
+REQUEST_BYTES = REGISTRY.histogram(
+    'dr_http_request_payload_bytes', 'Request body sizes', ['endpoint'], buckets=BYTE_BUCKETS
+)
+ADMISSION_WAIT_SECONDS = REGISTRY.histogram(
+    'dr_admission_wait_seconds', 'Time spent waiting for an inference slot', ['endpoint']
+)
+SERVICE_SECONDS = REGISTRY.histogram(
+    'dr_inference_service_seconds', 'Time holding an inference slot, excluding the wait', ['endpoint']
+)
+ADMISSION_REJECTIONS = REGISTRY.counter(
+    'dr_admission_rejections_total', 'Requests turned away or abandoned before admission', ['reason']
+)
+QUALITY_GATE_IMAGES = REGISTRY.counter(
+    'dr_quality_gate_images_total', 'Images checked by the quality gate, by outcome', ['outcome']
+)
+QUALITY_GATE_ISSUES = REGISTRY.counter(
+    'dr_quality_gate_issues_total', 'Quality problems found by the gate', ['issue']
+)
+QUALITY_GATE_SKIPPED_PASSES = REGISTRY.counter(
+    'dr_quality_gate_skipped_passes_total', 'Per-image model passes skipped for rejected images', ['model']
+)
+QUALITY_GATE_SAVED_SECONDS = REGISTRY.counter(
+    'dr_quality_gate_saved_seconds_total',
+    'Model time saved by rejected images, estimated from the recent per-image average'
+)
+SPECULATIVE_CASCADES = REGISTRY.counter(
+    'dr_speculative_cascades_total', 'Cascades run with every stage started at once'
+)
+SPECULATIVE_STAGE_SECONDS = REGISTRY.counter(
+    'dr_speculative_stage_seconds_total',
+    'Stage time spent by speculative cascades, by whether the routing used the stage',
+    ['outcome']
+)
@@ -0,0 +1,105 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+class StageStats:
+    """
+    Occupancy counters for one pipeline stage
+
+    `queued` items are waiting for the stage, `active` units of work are
+    running in it. A stage that is always full while the next one is idle is
+    the bottleneck.
+    """
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.max_queued = 0
+        self.active = 0
+        self.completed = 0
+        self.busy_seconds = 0.0
+        self.created_at = time.perf_counter()
+
+    def enqueue(self, count=1):
+        with self.lock:
+            self.queued += count
+            self.max_queued = max(self.max_queued, self.queued)
+
+    def dequeue(self, count=1):
+        with self.lock:
+            self.queued -= count
+
+    @contextmanager
+    def running(self, count=1):
+        """Account for one unit of work processing `count` items"""
+        with self.lock:
+            self.active += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.active -= 1
+                self.completed += count
+                self.busy_seconds += elapsed
+
+    def stats(self):
+        with self.lock:
+            uptime = time.perf_counter() - self.created_at
+            return {
+                "workers": self.workers,
+                "queued": self.queued,
+                "max_queued": self.max_queued,
+                "active": self.active,
+                "completed": self.completed,
+                "busy_seconds": self.busy_seconds,
+                "utilization": self.busy_seconds / (uptime * max(self.workers, 1)) if uptime > 0 else 0.0
+            }
+
+
+class StagePool:
+    """
+    Thread pool for one pipeline stage with a bounded backlog
+
+    `submit` blocks once `workers + queue_size` items are in the stage, which
+    applies backpressure to the producer. With zero workers the work runs
+    inline on the caller's thread and an already-completed future is returned.
+    """
+    def __init__(self, name, workers, queue_size):
+        self.name = name
+        self.counters = StageStats(name, workers)
+        self.executor = None
+        self.slots = None
+        if workers > 0:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{name}-stage")
+            self.slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def submit(self, fn, *args):
+        if self.executor is None:
+            future = Future()
+            try:
+                with self.counters.running():
+                    future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        self.slots.acquire()
+        self.counters.enqueue()
+
+        def run():
+            self.counters.dequeue()
+            try:
+                with self.counters.running():
+                    return fn(*args)
+            finally:
+                self.slots.release()
+
+        return self.executor.submit(run)
+
+    def stats(self):
+        return self.counters.stats()
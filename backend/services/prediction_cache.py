@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def model_fingerprint(model_paths, *settings):
+    """Identify the loaded checkpoints by path, size and modification time, plus any
+    settings (e.g. inference precision) that change the predictions"""
+    digest = hashlib.sha256()
+    for setting in settings:
+        digest.update(f"{setting}:".encode('utf-8'))
+    for name in sorted(model_paths):
+        path = model_paths[name]
+        try:
+            stat = os.stat(path)
+            identity = f"{name}:{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        except OSError:
+            identity = f"{name}:{os.path.abspath(path)}:missing"
+        digest.update(identity.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    """
+    Content-addressed cache of /api/predict results
+
+    Entries are keyed by a hash of the decoded image pixels, the checkpoint
+    fingerprint and the stage 1 threshold. The in-memory tier is an LRU bounded
+    by entry count and serialized size; the optional on-disk tier stores one
+    JSON file per entry and survives restarts.
+    """
+    def __init__(self, fingerprint, max_entries=512, max_bytes=256 * 1024 * 1024,
+                 disk_dir=None):
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, image_rgb, stage1_threshold):
+        digest = hashlib.sha256()
+        digest.update(self.fingerprint.encode('utf-8'))
+        digest.update(f"{stage1_threshold:.6f}:{image_rgb.shape}:{image_rgb.dtype}".encode('utf-8'))
+        digest.update(np.ascontiguousarray(image_rgb))
+        return digest.hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(key), 'r', encoding='utf-8') as f:
+                    payload = f.read()
+                value = json.loads(payload)
+            except (OSError, ValueError):
+                value = None
+            if value is not None:
+                with self.lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                    self._insert(key, value, len(payload))
+                return value
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        payload = json.dumps(value)
+        with self.lock:
+            self._insert(key, value, len(payload))
+
+        if self.disk_dir:
+            path = self._disk_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(payload)
+                os.replace(tmp_path, path)
+            except OSError:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def _insert(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.current_bytes -= previous[1]
+        self.entries[key] = (value, size)
+        self.current_bytes += size
+
+        while len(self.entries) > self.max_entries or self.current_bytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.current_bytes -= evicted_size
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.current_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
@@ -1,6 +1,7 @@
 import cv2
 import numpy as np
 import torch
+import torch.nn.functional as F
 
 
 def preprocess_for_vessel(image_rgb):
@@ -70,6 +71,41 @@ def preprocess_for_classification(image_rgb, vessel_mask):
     return vessel_tensor, green_tensor
 
 
+def classifier_inputs_from_vessel(vessel_input, vessel_mask, device):
+    """
+    Build the cascade inputs from the vessel model's working-resolution tensors
+
+    Serving counterpart of preprocess_for_classification: resamples the
+    1024x1024 green plane and mask on `device` instead of going through the
+    original-size image and mask, so the green values differ slightly from
+    resizing the original image directly.
+
+    Args:
+        vessel_input: tensor of shape (1, 1, 1024, 1024) from preprocess_for_vessel
+        vessel_mask: numpy array of shape (1024, 1024) with values 0 or 1
+        device: device to build the tensors on
+
+    Returns:
+        vessel_tensor: preprocessed vessel tensor of shape (1, 1, 288, 288)
+        green_tensor: preprocessed green tensor of shape (1, 1, 288, 288)
+    """
+    mask = torch.from_numpy(vessel_mask).to(device=device, dtype=torch.float32)
+    vessel_resized = F.interpolate(mask[None, None], size=(288, 288), mode='nearest')
+    green_resized = F.interpolate(vessel_input.to(device).float(), size=(288, 288),
+                                  mode='bilinear', align_corners=False)
+
+    # Both planes are already in [0, 1]; normalize to [-1, 1]
+    return (vessel_resized - 0.5) / 0.5, (green_resized - 0.5) / 0.5
+
+
+def resize_mask(vessel_mask, size):
+    """Nearest-neighbour resize of a 0/1 mask to (height, width)"""
+    height, width = size
+    if vessel_mask.shape == (height, width):
+        return vessel_mask
+    return cv2.resize(vessel_mask, (width, height), interpolation=cv2.INTER_NEAREST)
+
+
 def create_vessel_visualization(original_rgb, vessel_mask):
     """
     Create visualization of vessel segmentation overlaid on original image
@@ -0,0 +1,163 @@
+import itertools
+import os
+import threading
+import time
+import uuid
+from contextlib import nullcontext
+
+import torch
+from torch.profiler import ProfilerActivity, profile, record_function
+
+# True only while a capture is running; checked before creating any
+# record_function range so annotations cost nothing when the profiler is off
+_recording = False
+
+
+def annotate(name):
+    """record_function range while a capture is running, otherwise a no-op"""
+    if not _recording:
+        return nullcontext()
+    return record_function(name)
+
+
+def _experimental_config():
+    # Newer torch can record every thread (pool workers, the micro-batch
+    # scheduler); older releases only record the thread that started the capture
+    try:
+        from torch._C._profiler import _ExperimentalConfig
+        return _ExperimentalConfig(profile_all_threads=True), True
+    except (ImportError, TypeError):
+        return None, False
+
+
+class ProfilerBusy(Exception):
+    """Raised when arming while a previous capture is still armed"""
+
+
+class ProfilerController:
+    """
+    Captures torch.profiler traces for the next N analysis requests or T seconds
+
+    Arming only sets counters; each analysis request checks them on entry and,
+    while armed, runs under its own profiler session (one at a time, started
+    and stopped on the request's thread). When a session ends a Chrome trace
+    and a top-K operator table are written to `output_dir`.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.armed = False
+        self.capture_id = None
+        self.output_dir = None
+        self.remaining_requests = None
+        self.deadline = None
+        self.top_k = 30
+        self.record_shapes = False
+        self.session_running = False
+        self.captures = []
+        # File name suffix of each session; `captures` only keeps the last 20,
+        # so counting it would reuse names and overwrite earlier traces
+        self.sequence = itertools.count()
+
+    def arm(self, output_dir, max_requests=None, seconds=None, top_k=30, record_shapes=False):
+        if max_requests is None and seconds is None:
+            max_requests = 1
+        with self.lock:
+            if self.armed:
+                raise ProfilerBusy(f"Capture {self.capture_id} is still armed")
+            os.makedirs(output_dir, exist_ok=True)
+            self.capture_id = time.strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:6]
+            self.output_dir = output_dir
+            self.remaining_requests = max_requests
+            self.deadline = time.time() + seconds if seconds is not None else None
+            self.top_k = top_k
+            self.record_shapes = record_shapes
+            self.armed = True
+            return self.capture_id
+
+    def disarm(self):
+        with self.lock:
+            self.armed = False
+
+    def begin(self):
+        """Start a session for the calling request if armed; returns the session or None"""
+        if not self.armed:
+            return None
+        with self.lock:
+            if not self.armed or self.session_running:
+                return None
+            if self.deadline is not None and time.time() > self.deadline:
+                self.armed = False
+                return None
+            self.session_running = True
+            sequence = next(self.sequence)
+            capture_id, output_dir = self.capture_id, self.output_dir
+            top_k, record_shapes = self.top_k, self.record_shapes
+
+        global _recording
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        config, all_threads = _experimental_config()
+        kwargs = {"experimental_config": config} if config is not None else {}
+        session = profile(activities=activities, record_shapes=record_shapes, **kwargs)
+        try:
+            session.start()
+        except Exception:
+            with self.lock:
+                self.session_running = False
+            raise
+        _recording = True
+        return {
+            "profiler": session,
+            "capture_id": capture_id,
+            "path": os.path.join(output_dir, f"{capture_id}-{sequence}"),
+            "top_k": top_k,
+            "all_threads": all_threads,
+            "started_at": time.time()
+        }
+
+    def end(self, session):
+        """Stop a session, write its trace and op table, and update the remaining budget"""
+        global _recording
+        _recording = False
+        profiler = session["profiler"]
+        try:
+            profiler.stop()
+            trace_path = session["path"] + ".trace.json"
+            table_path = session["path"] + ".ops.txt"
+            profiler.export_chrome_trace(trace_path)
+            sort_by = 'self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total'
+            with open(table_path, 'w') as f:
+                f.write(profiler.key_averages().table(sort_by=sort_by, row_limit=session["top_k"]))
+            record = {"trace": trace_path, "ops": table_path}
+        except Exception as e:
+            record = {"error": str(e)}
+
+        record.update({
+            "capture_id": session["capture_id"],
+            "all_threads": session["all_threads"],
+            "seconds": time.time() - session["started_at"]
+        })
+        with self.lock:
+            self.session_running = False
+            self.captures = (self.captures + [record])[-20:]
+            if self.capture_id == session["capture_id"] and self.remaining_requests is not None:
+                self.remaining_requests -= 1
+                if self.remaining_requests <= 0:
+                    self.armed = False
+            if self.deadline is not None and time.time() > self.deadline:
+                self.armed = False
+        return record
+
+    def status(self):
+        with self.lock:
+            return {
+                "armed": self.armed,
+                "capture_id": self.capture_id,
+                "remaining_requests": self.remaining_requests,
+                "deadline": self.deadline,
+                "captures": list(self.captures)
+            }
+
+
+PROFILER = ProfilerController()
@@ -0,0 +1,130 @@
+import math
+
+import cv2
+import numpy as np
+
+QUALITY_GATE_MODES = ('off', 'flag', 'reject')
+
+
+class QualityGate:
+    """
+    Millisecond quality check of a fundus photograph, run before any model
+
+    All statistics come from a copy downscaled to `size` on its long side:
+
+    - field of view: fundus cameras image the retina as a bright disc on a
+      black surround. The largest region whose red channel exceeds
+      `fov_threshold` must cover `min_fov_fraction` of the frame, fill
+      `min_circularity` of its enclosing circle (a full-frame photo of
+      anything else fills about 0.6) and have its centre within
+      `max_center_offset` of the image centre, as a fraction of half the
+      shorter side.
+    - exposure: mean luminance inside the field of view between
+      `min_brightness` and `max_brightness`, with at most `max_clipped` of
+      its pixels saturated.
+    - sharpness: standard deviation of the Laplacian of the green plane,
+      where vessels have the most contrast, inside the field of view minus
+      its rim, as a percentage of the mean green level so that darker but
+      sharp images are not mistaken for blurred ones.
+
+    In 'flag' mode every result carries the assessment; in 'reject' mode
+    ungradable images are returned without running any model.
+    """
+    def __init__(self, mode='flag', size=512, fov_threshold=15, min_fov_fraction=0.25,
+                 min_circularity=0.7, max_center_offset=0.25, min_brightness=20,
+                 max_brightness=210, max_clipped=0.15, min_sharpness=3.0):
+        if mode not in QUALITY_GATE_MODES:
+            raise ValueError(f"Unknown quality gate mode '{mode}', expected one of {QUALITY_GATE_MODES}")
+        self.mode = mode
+        self.size = size
+        self.fov_threshold = fov_threshold
+        self.min_fov_fraction = min_fov_fraction
+        self.min_circularity = min_circularity
+        self.max_center_offset = max_center_offset
+        self.min_brightness = min_brightness
+        self.max_brightness = max_brightness
+        self.max_clipped = max_clipped
+        self.min_sharpness = min_sharpness
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    def rejects(self, assessment):
+        return self.mode == 'reject' and not assessment["gradable"]
+
+    def _downscale(self, image_rgb):
+        height, width = image_rgb.shape[:2]
+        scale = self.size / max(height, width)
+        if scale >= 1:
+            return image_rgb
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        return cv2.resize(image_rgb, size, interpolation=cv2.INTER_AREA)
+
+    def assess(self, image_rgb):
+        """
+        Returns:
+            {"gradable": bool, "issues": [...], "metrics": {...}}; issues are
+            any of no_field_of_view, not_fundus, off_center, underexposed,
+            overexposed and blurred
+        """
+        image_rgb = self._downscale(image_rgb)
+        height, width = image_rgb.shape[:2]
+
+        bright = (image_rgb[..., 0] > self.fov_threshold).astype(np.uint8)
+        contours, _ = cv2.findContours(bright, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        contour = max(contours, key=cv2.contourArea) if contours else None
+        area = cv2.contourArea(contour) if contour is not None else 0.0
+        fov_fraction = area / (height * width)
+        if fov_fraction < self.min_fov_fraction:
+            return {
+                "gradable": False,
+                "issues": ['no_field_of_view'],
+                "metrics": {"fov_fraction": round(fov_fraction, 4)}
+            }
+
+        (center_x, center_y), radius = cv2.minEnclosingCircle(contour)
+        circularity = area / (math.pi * radius ** 2)
+        center_offset = math.hypot(center_x - width / 2, center_y - height / 2) / (min(height, width) / 2)
+
+        # Holes inside the outline (dark lesions, an underexposed macula) still belong to the field
+        field = np.zeros((height, width), np.uint8)
+        cv2.drawContours(field, [contour], -1, 1, thickness=cv2.FILLED)
+        inside = field.astype(bool)
+        gray = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2GRAY)[inside]
+        brightness = float(gray.mean())
+        clipped = float(np.count_nonzero(gray >= 250)) / gray.size
+
+        # The rim is a strong edge in every image; leave it out of the sharpness estimate
+        rim = max(3, round(min(height, width) * 0.03)) | 1
+        interior = cv2.erode(field, np.ones((rim, rim), np.uint8)).astype(bool)
+        sharpness = 0.0
+        if interior.any():
+            green = image_rgb[..., 1]
+            laplacian = cv2.Laplacian(green, cv2.CV_32F)[interior]
+            sharpness = 100 * float(laplacian.std()) / max(1.0, float(green[interior].mean()))
+
+        issues = []
+        if circularity < self.min_circularity:
+            issues.append('not_fundus')
+        if center_offset > self.max_center_offset:
+            issues.append('off_center')
+        if brightness < self.min_brightness:
+            issues.append('underexposed')
+        elif brightness > self.max_brightness or clipped > self.max_clipped:
+            issues.append('overexposed')
+        if sharpness < self.min_sharpness:
+            issues.append('blurred')
+
+        return {
+            "gradable": not issues,
+            "issues": issues,
+            "metrics": {
+                "fov_fraction": round(fov_fraction, 4),
+                "circularity": round(circularity, 4),
+                "center_offset": round(center_offset, 4),
+                "brightness": round(brightness, 2),
+                "clipped_fraction": round(clipped, 4),
+                "sharpness": round(sharpness, 2)
+            }
+        }
@@ -0,0 +1,303 @@
+import itertools
+import os
+import queue
+import threading
+import time
+import traceback
+from collections import Counter
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+import torch
+import torch.multiprocessing as multiprocessing
+
+from services.cascade_inference import run_cascade_stage
+from services.vessel_inference import run_vessel_model
+
+# Worker tier -> models it serves. Most images leave the cascade after stage 1,
+# so the deeper stages share one tier that can be scaled separately
+STAGE_TIERS = {
+    'vessel': ('vessel',),
+    'stage1': ('stage1',),
+    'deep': ('stage2', 'stage3a', 'stage3b')
+}
+MODEL_TIERS = {model: tier for tier, models in STAGE_TIERS.items() for model in models}
+
+_LOADING, _READY, _FAILED = 0, 1, -1
+
+
+def _process_alive(pid):
+    """True while `pid` runs; exited children the master has not reaped yet count as dead"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (OSError, IndexError):
+        return False
+
+
+def _respond(responses, slot, message):
+    _, writer, lock = responses[slot]
+    with lock:
+        writer.send(message)
+
+
+def _serve(tier, position, requests, responses, status, served, manager_options, threads,
+           max_batch_size, warmup):
+    """Tier worker process: load the tier's models, then answer requests in micro-batches"""
+    from models.model_loader import ModelManager
+
+    torch.set_num_threads(threads)
+    try:
+        manager = ModelManager(**manager_options)
+        manager.load_models(STAGE_TIERS[tier], warmup=warmup)
+    except Exception:
+        traceback.print_exc()
+        status[position] = _FAILED
+        return
+    status[position] = _READY
+
+    while True:
+        batch = [requests.get()]
+        if batch[0] is None:
+            return
+        # Take whatever else is already waiting, up to the batch size
+        rows = batch[0][3][0].shape[0]
+        while rows < max_batch_size:
+            try:
+                message = requests.get_nowait()
+            except queue.Empty:
+                break
+            if message is None:
+                requests.put(None)
+                break
+            batch.append(message)
+            rows += message[3][0].shape[0]
+
+        for model in {message[2] for message in batch}:
+            group = [message for message in batch if message[2] == model]
+            try:
+                inputs = [
+                    torch.cat([message[3][i] for message in group]).to(manager.device)
+                    for i in range(len(group[0][3]))
+                ]
+                if model == 'vessel':
+                    outputs = run_vessel_model(manager.vessel_model, *inputs)
+                else:
+                    if manager.use_fp16:
+                        inputs = [x.half() for x in inputs]
+                    outputs = run_cascade_stage(manager, model, *inputs)
+                splits = torch.split(outputs, [message[3][0].shape[0] for message in group])
+                for (request_id, slot, _, _), output in zip(group, splits):
+                    _respond(responses, slot, (request_id, output.clone(), None))
+            except Exception as e:
+                for request_id, slot, _, _ in group:
+                    _respond(responses, slot, (request_id, None, f"{model} worker failed: {e}"))
+            with served.get_lock():
+                served[position] += sum(message[3][0].shape[0] for message in group)
+
+
+class StageWorkerPool:
+    """
+    Runs the vessel model, stage 1 and the deeper stages in separate local worker processes
+
+    Each tier (see STAGE_TIERS) has `counts[tier]` forked processes sharing
+    one request queue, so a tier is scaled by adding processes; each worker
+    batches whatever requests are waiting when it becomes free. Tensors
+    travel through torch.multiprocessing queues as shared memory. The web
+    process only preprocesses and routes: the pool stands in for a
+    MicroBatchScheduler (`run_vessel`, `run_stage`) in front of the analyzer.
+
+    Responses come back on one pipe per client process. A server master can
+    start the pool before forking `response_slots` web workers; each claims a
+    free slot on first use, and a slot whose owner has exited is reused. The
+    single owner reads its pipe without a lock, so an owner killed while
+    waiting does not leave the slot locked for the next one. Workers are not
+    restarted: one that exits takes its tier out of service, since it may
+    have died holding its tier's queue, and calls for that tier fail. Rows
+    sent to each model are counted, so the routing fractions through the
+    cascade can be compared with the tier sizes. A call that gets no answer
+    within `response_timeout` seconds fails rather than waiting forever.
+    """
+    def __init__(self, counts, manager_options=None, response_slots=1, max_batch_size=8,
+                 threads_per_worker=0, warmup=False, response_timeout=300):
+        context = multiprocessing.get_context('fork')
+        self.counts = {tier: max(1, counts.get(tier, 1)) for tier in STAGE_TIERS}
+        self.requests = {tier: context.Queue() for tier in STAGE_TIERS}
+        self.responses = [
+            (*context.Pipe(duplex=False), context.Lock()) for _ in range(response_slots)
+        ]
+        self.slot_owners = context.Array('i', response_slots)
+        total = sum(self.counts.values())
+        # By default the workers split the cores evenly
+        threads = threads_per_worker or max(1, (os.cpu_count() or 1) // total)
+        self.status = context.Array('i', total)
+        self.served = context.Array('q', total)
+        self.workers = []
+        for tier, count in self.counts.items():
+            for _ in range(count):
+                position = len(self.workers)
+                process = context.Process(
+                    target=_serve, name=f"stage-worker-{tier}", daemon=True,
+                    args=(tier, position, self.requests[tier], self.responses, self.status,
+                          self.served, manager_options or {}, threads, max_batch_size,
+                          warmup)
+                )
+                process.start()
+                self.workers.append((tier, process.pid))
+
+        self.response_timeout = response_timeout
+        self.lock = threading.Lock()
+        self.owner_pid = None
+        self.slot = None
+        self.pending = {}
+        self.rows = Counter()
+        self.ids = itertools.count()
+
+    def _attach(self):
+        """Claim a response slot and start reading it, once per client process"""
+        if self.owner_pid == os.getpid():
+            return
+        with self.lock:
+            if self.owner_pid == os.getpid():
+                return
+            with self.slot_owners.get_lock():
+                for slot, owner in enumerate(self.slot_owners):
+                    if owner == 0 or not _process_alive(owner):
+                        self.slot_owners[slot] = os.getpid()
+                        break
+                else:
+                    raise RuntimeError("Every stage worker response slot is taken; "
+                                       "start the pool with one slot per server worker")
+            self.slot = slot
+            self.pending = {}
+            self.rows = Counter()
+            self.owner_pid = os.getpid()
+            threading.Thread(target=self._dispatch, name="stage-worker-responses", daemon=True).start()
+
+    def _dispatch(self):
+        reader = self.responses[self.slot][0]
+        # Answers still buffered for a previous owner of this slot are dropped below
+        checked = time.monotonic()
+        while True:
+            # Nothing may end this thread: every later answer would be lost
+            try:
+                if time.monotonic() - checked >= 1.0:
+                    self._fail_dead_tiers()
+                    checked = time.monotonic()
+                if not reader.poll(1.0):
+                    continue
+                request_id, output, error = reader.recv()
+                with self.lock:
+                    entry = self.pending.pop(request_id, None)
+                if entry is None:
+                    # Answer to a request of a previous owner of this slot, or one that timed out
+                    continue
+                _, future = entry
+                if error is None:
+                    future.set_result(output)
+                else:
+                    future.set_exception(RuntimeError(error))
+            except Exception:
+                traceback.print_exc()
+                time.sleep(0.1)
+
+    def _fail_dead_tiers(self):
+        dead = [tier for tier in STAGE_TIERS if not self._tier_alive(tier)]
+        if not dead:
+            return
+        with self.lock:
+            failed = [(request_id, tier, future) for request_id, (tier, future) in self.pending.items()
+                      if tier in dead]
+            for request_id, _, _ in failed:
+                del self.pending[request_id]
+        for _, tier, future in failed:
+            future.set_exception(RuntimeError(self._unavailable(tier)))
+
+    def _tier_alive(self, tier):
+        return all(
+            self.status[position] != _FAILED and _process_alive(pid)
+            for position, (worker_tier, pid) in enumerate(self.workers) if worker_tier == tier
+        )
+
+    def _unavailable(self, tier):
+        return f"A {tier} stage worker failed or exited; restart the server to recover"
+
+    def _call(self, model, *inputs):
+        self._attach()
+        tier = MODEL_TIERS[model]
+        if not self._tier_alive(tier):
+            raise RuntimeError(self._unavailable(tier))
+        request_id = (os.getpid(), next(self.ids))
+        future = Future()
+        with self.lock:
+            self.pending[request_id] = (tier, future)
+            self.rows[model] += inputs[0].shape[0]
+        self.requests[tier].put((request_id, self.slot, model, [x.cpu() for x in inputs]))
+        try:
+            return future.result(timeout=self.response_timeout)
+        except FutureTimeout:
+            with self.lock:
+                self.pending.pop(request_id, None)
+            raise RuntimeError(
+                f"No answer from the {tier} stage workers within {self.response_timeout:g}s"
+            ) from None
+
+    def run_vessel(self, input_tensor):
+        return self._call('vessel', input_tensor)
+
+    def run_stage(self, stage, vessel_input, green_input):
+        return self._call(stage, vessel_input, green_input)
+
+    def ready(self):
+        """True once every worker has loaded its models and none has exited"""
+        return all(
+            self.status[position] == _READY and _process_alive(pid)
+            for position, (_, pid) in enumerate(self.workers)
+        )
+
+    def stop(self):
+        for tier, count in self.counts.items():
+            for _ in range(count):
+                self.requests[tier].put(None)
+
+    def stats(self):
+        states = {_LOADING: 'loading', _READY: 'ready', _FAILED: 'failed'}
+        tiers = {}
+        for position, (tier, pid) in enumerate(self.workers):
+            entry = tiers.setdefault(tier, {"models": list(STAGE_TIERS[tier]), "workers": []})
+            entry["workers"].append({
+                "pid": pid,
+                "state": states[self.status[position]] if _process_alive(pid) else 'exited',
+                "rows_served": self.served[position]
+            })
+        for tier, entry in tiers.items():
+            try:
+                entry["queued_requests"] = self.requests[tier].qsize()
+            except NotImplementedError:
+                entry["queued_requests"] = None
+        with self.lock:
+            rows = dict(self.rows)
+        stage1_rows = rows.get('stage1', 0)
+        return {
+            "tiers": tiers,
+            "rows_sent": rows,
+            # Share of stage-1 rows that continue to each deeper stage
+            "routing": {
+                model: round(rows.get(model, 0) / stage1_rows, 4) if stage1_rows else None
+                for model in STAGE_TIERS['deep']
+            }
+        }
+
+
+_POOL = None
+
+
+def start_stage_workers(counts, **options):
+    """Start the process-wide pool (e.g. in a server master before it forks web workers)"""
+    global _POOL
+    if _POOL is None:
+        _POOL = StageWorkerPool(counts, **options)
+    return _POOL
+
+
+def stage_worker_pool():
+    return _POOL
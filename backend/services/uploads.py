@@ -0,0 +1,115 @@
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+
+class MultipartImageStream:
+    """
+    Incremental multipart/form-data parser for image uploads
+
+    Iterating yields each file part of `field` as (filename, bytes) as soon
+    as its last byte has been read from `stream`, so the first images are
+    decoded and analyzed while the rest are still uploading, and only the
+    part being received is buffered here. How many yielded images are held
+    at once is up to the consumer (the analyzer keeps a bounded number in
+    flight).
+
+    With a `deadline`, reading stops once it expires (checked before every
+    chunk), so a slow upload cannot outlast the request's time budget; the
+    caller finds out from `deadline.reason`.
+
+    A part larger than `max_part_bytes` is not buffered: its data is
+    skipped, it is yielded with empty bytes and its position is recorded in
+    `oversized`. Other form fields are collected in `fields`; only those sent
+    before the first image are known by the time it is yielded. A malformed
+    or truncated body stops the iteration and is recorded in `error`; a body
+    over the request size limit raises RequestEntityTooLarge.
+    """
+    def __init__(self, stream, boundary, field='images', max_part_bytes=None, chunk_size=64 * 1024,
+                 deadline=None):
+        self.stream = stream
+        if isinstance(boundary, str):
+            boundary = boundary.encode()
+        # Non-file fields are small options; the decoder refuses larger ones
+        self.decoder = MultipartDecoder(boundary, max_form_memory_size=1024 * 1024)
+        self.field = field
+        self.max_part_bytes = max_part_bytes
+        self.chunk_size = chunk_size
+        self.fields = {}
+        self.oversized = {}
+        self.error = None
+        self.count = 0
+        self.deadline = deadline
+        self._parts = self._parse()
+        self._peeked = None
+
+    def _events(self):
+        while True:
+            event = self.decoder.next_event()
+            if isinstance(event, NeedData):
+                if self.deadline is not None and self.deadline.expired():
+                    return
+                chunk = self.stream.read(self.chunk_size)
+                self.decoder.receive_data(chunk or None)
+            elif isinstance(event, Epilogue):
+                return
+            else:
+                yield event
+
+    def _parse(self):
+        part = None
+        buffer = None
+        size = 0
+        for event in self._events():
+            if isinstance(event, File) and event.name == self.field:
+                part, buffer, size = event, bytearray(), 0
+            elif isinstance(event, (File, Field)):
+                part, buffer, size = event, (bytearray() if isinstance(event, Field) else None), 0
+            elif isinstance(event, Data):
+                size += len(event.data)
+                if buffer is not None:
+                    if isinstance(part, File) and self.max_part_bytes and size > self.max_part_bytes:
+                        buffer = None
+                    else:
+                        buffer += event.data
+                if event.more_data:
+                    continue
+                if isinstance(part, Field):
+                    self.fields[part.name] = buffer.decode('utf-8', 'replace')
+                elif isinstance(part, File) and part.name == self.field:
+                    index = self.count
+                    self.count += 1
+                    if buffer is None:
+                        self.oversized[index] = part.filename
+                        yield part.filename, b''
+                    else:
+                        yield part.filename, bytes(buffer)
+                part, buffer = None, None
+
+    def _next_part(self):
+        try:
+            return next(self._parts)
+        except StopIteration:
+            return None
+        except RequestEntityTooLarge:
+            raise
+        except Exception as e:
+            # Malformed multipart, or the client disconnected mid-upload
+            self.error = str(e) or e.__class__.__name__
+            return None
+
+    def peek(self):
+        """The first image part, read ahead so fields sent before it are known; None if there is none"""
+        if self._peeked is None:
+            self._peeked = self._next_part()
+        return self._peeked
+
+    def __iter__(self):
+        first = self.peek()
+        if first is None:
+            return
+        yield first
+        while True:
+            part = self._next_part()
+            if part is None:
+                return
+            yield part
@@ -1,27 +1,175 @@
-import cv2
 import numpy as np
 import torch
-from services.preprocessing import preprocess_for_vessel
+import torch.nn.functional as F
+from services.preprocessing import preprocess_for_vessel, resize_mask
+from services.metrics import STEP_SECONDS
+from services.profiling import annotate
 
 
-def predict_vessel_segmentation(image_rgb, model, device):
-    original_h, original_w = image_rgb.shape[:2]
-
-    input_tensor, _ = preprocess_for_vessel(image_rgb)
-    input_tensor = input_tensor.to(device)
-
-    if next(model.parameters()).dtype == torch.float16:
+def run_vessel_model(model, input_tensor):
+    """Run the vessel model on a batch and return sigmoid probabilities on the CPU"""
+    # Quantized graphs hold packed weights rather than parameters
+    param = next(model.parameters(), None)
+    if param is not None and param.dtype == torch.float16:
         input_tensor = input_tensor.half()
 
-    with torch.no_grad():
+    with STEP_SECONDS.time(step='vessel'), annotate('pipeline/vessel'), torch.inference_mode():
         pred_logits = model(input_tensor)
         pred_prob = torch.sigmoid(pred_logits)
+        pred_prob = pred_prob.float().cpu()
+
+    return pred_prob
+
+
+# The U-Net pools four times, so every spatial size it sees must be a multiple of 16
+VESSEL_SIZE_MULTIPLE = 16
+
+
+def _tile_starts(length, tile_size, stride):
+    starts = list(range(0, length - tile_size + 1, stride))
+    if starts[-1] != length - tile_size:
+        starts.append(length - tile_size)
+    return starts
+
+
+def _blend_window(tile_size, overlap):
+    """Separable linear ramp over the overlap, so each tile fades out where its neighbour fades in"""
+    if overlap == 0:
+        return torch.ones(tile_size, tile_size)
+    position = torch.arange(tile_size, dtype=torch.float32) + 0.5
+    ramp = torch.minimum(position, tile_size - position) / overlap
+    # Kept above zero so image borders, covered by a single tile, still normalise
+    ramp = ramp.clamp(1e-3, 1.0)
+    return ramp[:, None] * ramp[None, :]
+
+
+class VesselSegmenter:
+    """
+    Runs the vessel model at a chosen working resolution, optionally tile by tile
+
+    The (N, 1, 1024, 1024) input is area-downsampled to `working_size` and
+    the probabilities are upsampled back, so the masks handed to the rest of
+    the pipeline are always 1024x1024. With `tile_size` set below the
+    working size the input is cut into overlapping tiles that are run in
+    batches of `tile_batch_size` and blended with a linear ramp over the
+    overlap, bounding the U-Net's full-resolution activations to
+    `tile_batch_size` tiles at a time (per image, or per micro-batch when the
+    scheduler merges tiles across requests).
+    """
+    def __init__(self, working_size=1024, tile_size=0, overlap=64, tile_batch_size=4):
+        if working_size % VESSEL_SIZE_MULTIPLE or working_size <= 0:
+            raise ValueError(f"Vessel working size must be a positive multiple of {VESSEL_SIZE_MULTIPLE}")
+        if tile_size >= working_size:
+            tile_size = 0
+        if tile_size:
+            if tile_size % VESSEL_SIZE_MULTIPLE:
+                raise ValueError(f"Vessel tile size must be a multiple of {VESSEL_SIZE_MULTIPLE}")
+            if not 0 <= overlap < tile_size:
+                raise ValueError("Vessel tile overlap must be at least 0 and smaller than the tile size")
+        self.working_size = working_size
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.tile_batch_size = max(1, tile_batch_size)
+        self.window = _blend_window(tile_size, overlap) if tile_size else None
+
+    @property
+    def model_input_size(self):
+        """Spatial size of each forward pass, for warmup"""
+        return self.tile_size or self.working_size
+
+    def run(self, input_tensor, run_model):
+        """Return (N, 1, H, W) probabilities on the CPU for an (N, 1, H, W) input"""
+        size = tuple(input_tensor.shape[-2:])
+        working = (self.working_size, self.working_size)
+        if size != working:
+            input_tensor = F.interpolate(input_tensor, size=working, mode='area')
+
+        if self.tile_size:
+            pred_prob = self._run_tiled(input_tensor, run_model)
+        else:
+            pred_prob = run_model(input_tensor)
+
+        if size != working:
+            pred_prob = F.interpolate(pred_prob, size=size, mode='bilinear', align_corners=False)
+        return pred_prob
+
+    def _run_tiled(self, input_tensor, run_model):
+        batch, _, height, width = input_tensor.shape
+        tile, stride = self.tile_size, self.tile_size - self.overlap
+        boxes = [
+            (top, left)
+            for top in _tile_starts(height, tile, stride)
+            for left in _tile_starts(width, tile, stride)
+        ]
+
+        total = torch.zeros(batch, 1, height, width)
+        weights = torch.zeros(1, 1, height, width)
+        for start in range(0, len(boxes), self.tile_batch_size):
+            chunk = boxes[start:start + self.tile_batch_size]
+            tiles = torch.cat([
+                input_tensor[:, :, top:top + tile, left:left + tile] for top, left in chunk
+            ])
+            pred_prob = run_model(tiles).float().cpu()
+            for index, (top, left) in enumerate(chunk):
+                rows = pred_prob[index * batch:(index + 1) * batch]
+                total[:, :, top:top + tile, left:left + tile] += rows * self.window
+                weights[:, :, top:top + tile, left:left + tile] += self.window
+        return total / weights
+
+
+class VesselSegmentation:
+    """
+    Vessel mask kept at the model's 1024x1024 working resolution
+
+    The classifier inputs and previews are derived from `mask` directly; the
+    original-size mask is only upsampled when a full-resolution artifact asks
+    for it, and is then kept for further callers.
+    """
+    def __init__(self, mask, original_size):
+        self.mask = mask
+        self.original_size = original_size
+        self._full_mask = None
+
+    def full_mask(self):
+        if self._full_mask is None:
+            self._full_mask = resize_mask(self.mask, self.original_size)
+        return self._full_mask
+
+
+def threshold_vessel_prediction(pred_prob, original_size):
+    """Threshold sigmoid probabilities into a working-resolution segmentation"""
+    prob_map = pred_prob.numpy().squeeze()
+    return VesselSegmentation((prob_map > 0.5).astype(np.uint8), original_size)
+
+
+def postprocess_vessel_prediction(pred_prob, original_size):
+    """Threshold sigmoid probabilities and resize the mask back to the input resolution"""
+    return threshold_vessel_prediction(pred_prob, original_size).full_mask()
+
+
+def segment_vessel_input(input_tensor, original_size, model, device, run_model=None, segmenter=None):
+    """
+    Segment an already preprocessed (1, 1, 1024, 1024) input into a VesselSegmentation
+
+    `segmenter` (a VesselSegmenter) selects a lower working resolution and/or
+    tiled inference; without it the model runs once on the whole input.
+    """
+    input_tensor = input_tensor.to(device)
+
+    if run_model is None:
+        run_model = lambda batch: run_vessel_model(model, batch)
+
+    if segmenter is None:
+        pred_prob = run_model(input_tensor)
+    else:
+        pred_prob = segmenter.run(input_tensor, run_model)
 
-    prob_map = pred_prob.cpu().numpy().squeeze()
-    binary_mask = (prob_map > 0.5).astype(np.uint8)
+    return threshold_vessel_prediction(pred_prob, original_size)
 
-    if original_h != 1024 or original_w != 1024:
-        binary_mask = cv2.resize(binary_mask, (original_w, original_h),
-                                 interpolation=cv2.INTER_NEAREST)
 
-    return binary_mask
+def predict_vessel_segmentation(image_rgb, model, device, run_model=None, segmenter=None):
+    input_tensor, original_size = preprocess_for_vessel(image_rgb)
+    segmentation = segment_vessel_input(
+        input_tensor, original_size, model, device, run_model=run_model, segmenter=segmenter
+    )
+    return segmentation.full_mask()
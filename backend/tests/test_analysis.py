@@ -0,0 +1,86 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import cv2
+import numpy as np
+import torch
+
+from services import analysis
+from services.analysis import ImageAnalyzer
+from services.vessel_inference import VesselSegmentation
+
+
+def jpeg(seed):
+    pixels = (np.random.default_rng(seed).random((64, 80, 3)) * 255).astype(np.uint8)
+    return cv2.imencode('.jpg', pixels)[1].tobytes()
+
+
+def render(image_id, image_bytes, image_rgb, segmentation, compact):
+    return {"image_id": image_id}
+
+
+def stub_models(test_case):
+    """Replace the vessel model and the cascade for the test; returns the cascade batch sizes"""
+    batches = []
+
+    def classify(vessel_batch, green_batch, model_manager, **kwargs):
+        batches.append(vessel_batch.shape[0])
+        return [{"has_dr": False, "grade": 0} for _ in range(vessel_batch.shape[0])]
+
+    def segment(analyzer, vessel_input, original_size):
+        return VesselSegmentation(np.zeros((1024, 1024), np.uint8), original_size)
+
+    patches = [
+        mock.patch.object(analysis, 'cascade_classify_batch', classify),
+        mock.patch.object(ImageAnalyzer, '_segment', segment)
+    ]
+    for patch in patches:
+        patch.start()
+        test_case.addCleanup(patch.stop)
+    return SimpleNamespace(device=torch.device('cpu')), batches
+
+
+class AnalyzerBatchingTest(unittest.TestCase):
+    """Cascade batches are bounded and results stream while input is still arriving"""
+
+    def setUp(self):
+        self.manager, self.batches = stub_models(self)
+
+    def analyze(self, analyzer, count):
+        consumed = []
+
+        def images():
+            for i in range(count):
+                consumed.append(i)
+                yield f"image-{i}", jpeg(i)
+
+        first_result_after = None
+        results = []
+        for index, result in analyzer.analyze(images(), render_artifacts=render):
+            if first_result_after is None:
+                first_result_after = len(consumed)
+            results.append((index, result))
+        return results, first_result_after
+
+    def test_batches_are_bounded_without_a_prediction_cache(self):
+        analyzer = ImageAnalyzer(self.manager, stage1_threshold=0.5, cascade_batch_size=4,
+                                 queue_size=2)
+        results, first_result_after = self.analyze(analyzer, 20)
+
+        self.assertEqual(sorted(index for index, _ in results), list(range(20)))
+        self.assertTrue(all("error" not in result for _, result in results))
+        self.assertEqual(self.batches, [4] * 5)
+        self.assertLess(first_result_after, 20)
+
+    def test_device_preprocessing_builds_classifier_inputs_per_batch(self):
+        analyzer = ImageAnalyzer(self.manager, stage1_threshold=0.5, cascade_batch_size=4,
+                                 queue_size=2, device_preprocessing=True)
+        results, _ = self.analyze(analyzer, 10)
+
+        self.assertTrue(all("error" not in result for _, result in results))
+        self.assertEqual(self.batches, [4, 4, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
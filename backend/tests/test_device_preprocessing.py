@@ -0,0 +1,51 @@
+import unittest
+
+import numpy as np
+import torch
+
+from services.device_preprocessing import (
+    CLASSIFIER_INPUT_TOLERANCE, VESSEL_INPUT_TOLERANCE, classifier_inputs_for_batch,
+    preprocess_on_device_for_vessel, upload_green_plane
+)
+from services.preprocessing import classifier_inputs_from_vessel, preprocess_for_vessel
+
+
+def image(height, width, seed):
+    return (np.random.default_rng(seed).random((height, width, 3)) * 255).astype(np.uint8)
+
+
+class DevicePreprocessingParityTest(unittest.TestCase):
+    """The on-device path matches the CPU functions within the stated tolerances"""
+
+    def test_vessel_input_matches_preprocess_for_vessel(self):
+        for seed, (height, width) in enumerate([(1024, 1024), (600, 700), (1536, 2048), (2000, 1500)]):
+            image_rgb = image(height, width, seed)
+            expected, expected_size = preprocess_for_vessel(image_rgb)
+            actual, size = preprocess_on_device_for_vessel(image_rgb, 'cpu')
+            self.assertEqual(size, expected_size)
+            self.assertEqual(actual.shape, expected.shape)
+            self.assertLessEqual((actual - expected).abs().max().item(), VESSEL_INPUT_TOLERANCE + 1e-6)
+
+    def test_batched_classifier_inputs_match_per_image(self):
+        rng = np.random.default_rng(0)
+        vessel_inputs = [preprocess_for_vessel(image(800, 900, seed))[0] for seed in range(3)]
+        masks = [(rng.random((1024, 1024)) > 0.8).astype(np.uint8) for _ in range(3)]
+
+        vessel_batch, green_batch = classifier_inputs_for_batch(vessel_inputs, masks, 'cpu')
+        for index, (vessel_input, mask) in enumerate(zip(vessel_inputs, masks)):
+            vessel_tensor, green_tensor = classifier_inputs_from_vessel(vessel_input, mask, 'cpu')
+            self.assertTrue(torch.equal(vessel_batch[index:index + 1], vessel_tensor))
+            difference = (green_batch[index:index + 1] - green_tensor).abs().max().item()
+            self.assertLessEqual(difference, CLASSIFIER_INPUT_TOLERANCE)
+
+    @unittest.skipUnless(torch.cuda.is_available(), "needs CUDA for pinned uploads")
+    def test_reused_staging_buffer_keeps_earlier_uploads(self):
+        first, second = image(300, 400, 1), image(200, 100, 2)
+        first_plane = upload_green_plane(first, 'cuda')
+        second_plane = upload_green_plane(second, 'cuda')
+        self.assertTrue(np.array_equal(first_plane.cpu().numpy()[0, 0], first[:, :, 1]))
+        self.assertTrue(np.array_equal(second_plane.cpu().numpy()[0, 0], second[:, :, 1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+
+from services.analysis import ImageAnalyzer
+from tests.test_analysis import jpeg, stub_models
+from tools.screen import CsvWriter, Progress, Screening, mask_renderer
+
+
+def line_count(path):
+    with open(path) as f:
+        return sum(1 for _ in f)
+
+
+class ScreeningCheckpointTest(unittest.TestCase):
+    """Rows and checkpoint lines are written while the source is still being read"""
+
+    def setUp(self):
+        self.manager, _ = stub_models(self)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.csv_path = os.path.join(directory.name, 'results.csv')
+        self.progress_path = self.csv_path + '.progress'
+
+    def test_rows_are_checkpointed_before_the_source_is_used_up(self):
+        count = 20
+        written_at_end_of_input = []
+
+        def source():
+            for i in range(count):
+                yield f"image-{i}.jpg", jpeg(i)
+            written_at_end_of_input.append(
+                (line_count(self.csv_path), line_count(self.progress_path))
+            )
+
+        progress = Progress(self.progress_path)
+        writer = CsvWriter(self.csv_path)
+        screening = Screening(source(), progress, writer, flush_every=4)
+        analyzer = ImageAnalyzer(self.manager, stage1_threshold=0.5, cascade_batch_size=4,
+                                 queue_size=2)
+        for _, result in analyzer.analyze(screening.images(), render_artifacts=mask_renderer(None)):
+            screening.add(result)
+        screening.flush()
+        writer.close()
+        progress.close()
+
+        rows, checkpoints = written_at_end_of_input[0]
+        # Header plus at least one flush of rows, and their hashes
+        self.assertGreater(rows, 1)
+        self.assertGreater(checkpoints, 0)
+        self.assertEqual(line_count(self.csv_path), count + 1)
+        self.assertEqual(line_count(self.progress_path), count)
+
+
+if __name__ == '__main__':
+    unittest.main()
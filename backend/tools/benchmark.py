@@ -0,0 +1,461 @@
+"""
+Reproducible latency benchmark for the vessel + cascade pipeline
+
+Times each pipeline step on synthetic fundus-like images: decode (full and
+reduced-resolution, with the savings summarised per resolution),
+preprocess_for_vessel, vessel inference, mask thresholding and upsampling,
+classifier input resampling, the on-device preprocessing counterparts
+(on the benchmark device), every cascade stage and artifact encoding.
+Each step is reported with latency percentiles, images/sec and peak RSS/VRAM.
+Models use the real checkpoints when they are all present and random weights
+otherwise, so the benchmark runs offline on a CPU-only machine.
+
+Cascade routing is forced per branch mix (all No DR, all early DR, all
+advanced DR, or an even mix) so each branch's cost can be measured with
+random weights too.
+
+Usage (from backend/):
+    python -m tools.benchmark --output bench.json
+    python -m tools.benchmark --baseline bench.json --tolerance 0.15
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from models.model_loader import ModelManager, CHECKPOINT_KEYS
+from models.performance import PROFILES, configure_backends
+from models.vessel_model import AttentionUNet
+from models.classification_model import DualStreamConvNeXtModel
+from services.decoding import decode_image, decode_image_reduced, reduced_decode_factor
+from services.artifacts import (
+    encode_image_to_base64, encode_binary_mask_png, encode_overlay_preview, preview_size
+)
+from services.cascade_inference import cascade_classify_batch, run_cascade_stage
+from services.preprocessing import (
+    preprocess_for_vessel, classifier_inputs_from_vessel, create_vessel_visualization, resize_mask
+)
+from services.device_preprocessing import classifier_inputs_for_batch, preprocess_on_device_for_vessel
+from services.vessel_inference import (
+    VesselSegmenter, run_vessel_model, threshold_vessel_prediction
+)
+from config import MODEL_PATHS, MODEL_PRECISION, INFERENCE_PROFILE
+
+# Route of each image through the cascade; rows cycle through the tuple
+BRANCH_MIXES = {
+    'no_dr': ('no_dr',),
+    'early': ('early',),
+    'advanced': ('advanced',),
+    'mixed': ('no_dr', 'early', 'advanced')
+}
+
+
+class RandomWeightsModelManager(ModelManager):
+    """ModelManager that builds every model with seeded random weights instead of reading checkpoints"""
+    def _load_state_dict(self, name):
+        torch.manual_seed(sorted(CHECKPOINT_KEYS).index(name))
+        if name == 'vessel':
+            return AttentionUNet(in_channels=1, out_channels=1).state_dict()
+        return DualStreamConvNeXtModel(num_classes=2).state_dict()
+
+
+def checkpoints_present():
+    return all(os.path.exists(MODEL_PATHS[key]) for key in CHECKPOINT_KEYS.values())
+
+
+def synthetic_fundus(size, rng):
+    """Return a fundus-like RGB image (dark surround, orange retina, optic disc, vessel tree) and its vessel mask"""
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float32)
+    center = size / 2
+    radius = size * 0.45
+    distance = np.sqrt((xx - center) ** 2 + (yy - center) ** 2) / radius
+    falloff = np.clip(1.0 - 0.45 * distance ** 2, 0.0, 1.0)
+
+    image = np.zeros((size, size, 3), np.float32)
+    for channel, level in enumerate((205.0, 95.0, 45.0)):
+        image[..., channel] = level * falloff
+
+    disc = (int(center + radius * 0.45), int(center))
+    cv2.circle(image, disc, int(radius * 0.12), (250.0, 215.0, 160.0), -1)
+
+    mask = np.zeros((size, size), np.uint8)
+    step = size / 60
+    for _ in range(14):
+        x, y = disc
+        angle = rng.uniform(0, 2 * np.pi)
+        thickness = max(1, int(size / 250 * rng.uniform(0.5, 1.5)))
+        for _ in range(45):
+            angle += rng.normal(0, 0.2)
+            next_x, next_y = x + step * np.cos(angle), y + step * np.sin(angle)
+            cv2.line(mask, (int(x), int(y)), (int(next_x), int(next_y)), 1, thickness)
+            x, y = next_x, next_y
+    mask[distance > 1.0] = 0
+
+    image[mask > 0] *= 0.55
+    image[distance > 1.0] = 0
+    image = cv2.GaussianBlur(image, (0, 0), max(size / 1024, 0.5))
+    image += rng.normal(0, 3, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8), mask
+
+
+def encode_jpeg(image_rgb, quality=95):
+    success, buffer = cv2.imencode('.jpg', cv2.cvtColor(image_rgb, cv2.COLOR_RGB2BGR),
+                                   [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not success:
+        raise ValueError("Failed to encode image")
+    return buffer.tobytes()
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def reset_peaks(device):
+    # Writing 5 to clear_refs resets the kernel's RSS high-water mark (Linux)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def peak_vram_mb(device):
+    if device.type != 'cuda':
+        return None
+    return torch.cuda.max_memory_allocated() / (1024 * 1024)
+
+
+def summarize(seconds, items, device):
+    """Latency percentiles per call and throughput over all calls"""
+    ms = np.array(seconds) * 1000
+    return {
+        "count": len(seconds),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p90_ms": float(np.percentile(ms, 90)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "images_per_sec": float(sum(items) / sum(seconds)) if sum(seconds) > 0 else None,
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_vram_mb": peak_vram_mb(device)
+    }
+
+
+def measure(fn, inputs, device, warmup, batch_size=1):
+    """Call fn on each input after `warmup` untimed calls; return a summary"""
+    for value in inputs[:warmup]:
+        fn(value)
+    synchronize(device)
+    reset_peaks(device)
+
+    seconds = []
+    for value in inputs:
+        start = time.perf_counter()
+        fn(value)
+        synchronize(device)
+        seconds.append(time.perf_counter() - start)
+    return summarize(seconds, [batch_size] * len(seconds), device)
+
+
+def bench_cpu_steps(resolution, iterations, warmup, seed, preview_max_side, device):
+    """Decode, preprocessing and encoding at one input resolution"""
+    rng = np.random.default_rng(seed)
+    samples = [synthetic_fundus(resolution, rng) for _ in range(iterations)]
+    jpegs = [encode_jpeg(image_rgb) for image_rgb, _ in samples]
+    probabilities = [
+        torch.from_numpy(cv2.resize(mask.astype(np.float32), (1024, 1024))).view(1, 1, 1024, 1024)
+        for _, mask in samples
+    ]
+    original_size = (resolution, resolution)
+    segmentations = [threshold_vessel_prediction(prob, original_size) for prob in probabilities]
+    working = [
+        (preprocess_for_vessel(image_rgb)[0], segmentation.mask)
+        for (image_rgb, _), segmentation in zip(samples, segmentations)
+    ]
+    compact_samples = [
+        (image_rgb, segmentation.mask)
+        for (image_rgb, _), segmentation in zip(samples, segmentations)
+    ]
+
+    def encode_full(sample):
+        image_rgb, mask = sample
+        vessel_viz = create_vessel_visualization(image_rgb, mask)
+        mask_rgb = cv2.cvtColor(mask * 255, cv2.COLOR_GRAY2RGB)
+        for image in (image_rgb, vessel_viz, mask_rgb):
+            encode_image_to_base64(image)
+
+    def encode_compact(sample):
+        image_rgb, mask = sample
+        encode_overlay_preview(image_rgb, mask, preview_max_side)
+        encode_binary_mask_png(resize_mask(mask, preview_size(image_rgb.shape[:2], preview_max_side)))
+
+    suffix = f"{resolution}px"
+    return {
+        f"decode/{suffix}": measure(decode_image, jpegs, device, warmup),
+        f"decode_reduced/{suffix}": measure(
+            lambda data: decode_image_reduced(data, 1024), jpegs, device, warmup),
+        f"preprocess_for_vessel/{suffix}": measure(
+            preprocess_for_vessel, [image for image, _ in samples], device, warmup),
+        f"device_preprocess_vessel/{suffix}": measure(
+            lambda image_rgb: preprocess_on_device_for_vessel(image_rgb, device),
+            [image for image, _ in samples], device, warmup),
+        f"vessel_threshold/{suffix}": measure(
+            lambda prob: threshold_vessel_prediction(prob, original_size), probabilities,
+            device, warmup),
+        f"mask_upsample/{suffix}": measure(
+            lambda segmentation: resize_mask(segmentation.mask, original_size), segmentations,
+            device, warmup),
+        f"classifier_inputs/{suffix}": measure(
+            lambda sample: classifier_inputs_from_vessel(*sample, device), working, device, warmup),
+        # Every sample as one cascade batch; compare images_per_sec with classifier_inputs
+        f"device_classifier_inputs_batch/{suffix}": measure(
+            lambda batch: classifier_inputs_for_batch(*zip(*batch), device), [working] * (warmup + 1),
+            device, warmup, batch_size=len(working)),
+        f"encode_full/{suffix}": measure(encode_full, samples, device, warmup),
+        f"encode_compact/{suffix}": measure(encode_compact, compact_samples, device, warmup)
+    }
+
+
+def decode_savings(results, resolutions):
+    """Latency and peak-RSS difference of the reduced decode against a full decode"""
+    savings = {}
+    for resolution in resolutions:
+        full = results.get(f"decode/{resolution}px")
+        reduced = results.get(f"decode_reduced/{resolution}px")
+        if full is None or reduced is None:
+            continue
+        savings[f"{resolution}px"] = {
+            "scale_factor": reduced_decode_factor((resolution, resolution), 1024)[0],
+            "p50_speedup": full["p50_ms"] / reduced["p50_ms"] if reduced["p50_ms"] else None,
+            "peak_rss_saved_mb": full["peak_rss_mb"] - reduced["peak_rss_mb"]
+        }
+    return savings
+
+
+def bench_vessel(model_manager, batch_size, iterations, warmup, seed, segmenter):
+    """Vessel inference through a VesselSegmenter; peak RSS/VRAM shows the activation memory"""
+    torch.manual_seed(seed)
+    device = model_manager.device
+    batches = [torch.rand(batch_size, 1, 1024, 1024, device=device) for _ in range(iterations)]
+    run_model = lambda batch: run_vessel_model(model_manager.vessel_model, batch)
+    summary = measure(
+        lambda batch: segmenter.run(batch, run_model),
+        batches, device, warmup, batch_size=batch_size
+    )
+    mode = f"working{segmenter.working_size}"
+    if segmenter.tile_size:
+        mode += f"-tile{segmenter.tile_size}"
+    return {f"vessel_inference/batch{batch_size}/{mode}": summary}
+
+
+def forced_routing(model_manager, routes):
+    """
+    Build a run_stage hook that runs the real models but overrides the
+    probabilities that decide routing, so every row follows `routes`
+    """
+    dr_routes = [route for route in routes if route != 'no_dr']
+    timings = {}
+
+    def run_stage(stage, vessel, green):
+        start = time.perf_counter()
+        probs = run_cascade_stage(model_manager, stage, vessel, green)
+        timings.setdefault(stage, []).append((time.perf_counter() - start, vessel.shape[0]))
+
+        if stage == 'stage1':
+            dr = torch.tensor([route != 'no_dr' for route in routes], dtype=torch.float32)
+            probs = torch.stack([1 - dr, dr], dim=1)
+        elif stage == 'stage2':
+            advanced = torch.tensor([route == 'advanced' for route in dr_routes], dtype=torch.float32)
+            probs = torch.stack([1 - advanced, advanced], dim=1)
+        return probs
+
+    return run_stage, timings
+
+
+def bench_cascade(model_manager, mix, batch_size, iterations, warmup, seed):
+    device = model_manager.device
+    torch.manual_seed(seed)
+    routes = [BRANCH_MIXES[mix][row % len(BRANCH_MIXES[mix])] for row in range(batch_size)]
+    batches = [
+        (torch.rand(batch_size, 1, 288, 288, device=device) * 2 - 1,
+         torch.rand(batch_size, 1, 288, 288, device=device) * 2 - 1)
+        for _ in range(iterations)
+    ]
+
+    for vessel, green in batches[:warmup]:
+        run_stage, _ = forced_routing(model_manager, routes)
+        cascade_classify_batch(vessel, green, model_manager, run_stage=run_stage)
+    synchronize(device)
+    reset_peaks(device)
+
+    run_stage, timings = forced_routing(model_manager, routes)
+    totals = []
+    for vessel, green in batches:
+        start = time.perf_counter()
+        cascade_classify_batch(vessel, green, model_manager, run_stage=run_stage)
+        synchronize(device)
+        totals.append(time.perf_counter() - start)
+
+    prefix = f"cascade/{mix}/batch{batch_size}"
+    results = {f"{prefix}/total": summarize(totals, [batch_size] * len(totals), device)}
+    for stage, calls in timings.items():
+        results[f"{prefix}/{stage}"] = summarize(
+            [seconds for seconds, _ in calls], [rows for _, rows in calls], device
+        )
+    return results
+
+
+def compare(results, baseline, tolerance, min_delta_ms):
+    """Return p50 regressions of `results` against a baseline report"""
+    regressions = []
+    for name, summary in results.items():
+        reference = baseline.get("results", {}).get(name)
+        if reference is None:
+            continue
+        current, previous = summary["p50_ms"], reference["p50_ms"]
+        if current > previous * (1 + tolerance) and current - previous > min_delta_ms:
+            regressions.append({
+                "name": name,
+                "baseline_p50_ms": previous,
+                "p50_ms": current,
+                "ratio": current / previous if previous > 0 else None
+            })
+    return regressions
+
+
+def parse_ints(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--resolutions', type=parse_ints, default=[1024, 2048, 3072],
+                        help="comma-separated square input sizes for the CPU steps")
+    parser.add_argument('--vessel-batch-sizes', type=parse_ints, default=[1, 4])
+    parser.add_argument('--vessel-working-sizes', type=parse_ints, default=[1024],
+                        help="vessel segmentation working resolutions")
+    parser.add_argument('--vessel-tile-sizes', type=parse_ints, default=[0],
+                        help="vessel tile sizes (0 runs the whole image)")
+    parser.add_argument('--vessel-tile-overlap', type=int, default=64)
+    parser.add_argument('--batch-sizes', type=parse_ints, default=[1, 8, 16],
+                        help="cascade batch sizes")
+    parser.add_argument('--mixes', default=','.join(BRANCH_MIXES),
+                        help=f"cascade branch mixes ({', '.join(BRANCH_MIXES)})")
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--precision', default=MODEL_PRECISION)
+    parser.add_argument('--profile', default=INFERENCE_PROFILE, choices=PROFILES,
+                        help="inference profile (performance compiles the models)")
+    parser.add_argument('--threads', type=int, help="torch intra-op threads")
+    parser.add_argument('--random-weights', action='store_true',
+                        help="use random weights even if checkpoints are present")
+    parser.add_argument('--preview-max-side', type=int, default=1024)
+    parser.add_argument('--skip-models', action='store_true', help="only time the CPU steps")
+    parser.add_argument('--output', help="path for the JSON report")
+    parser.add_argument('--baseline', help="JSON report to compare p50 latencies against")
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help="allowed fractional p50 slowdown before failing")
+    parser.add_argument('--min-delta-ms', type=float, default=1.0,
+                        help="ignore slowdowns smaller than this")
+    args = parser.parse_args()
+
+    mixes = [mix for mix in args.mixes.split(',') if mix]
+    unknown = set(mixes) - set(BRANCH_MIXES)
+    if unknown:
+        sys.exit(f"Unknown branch mix: {', '.join(sorted(unknown))}")
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+    configure_backends(args.profile)
+
+    random_weights = args.random_weights or not checkpoints_present()
+    manager_class = RandomWeightsModelManager if random_weights else ModelManager
+    # Exported graphs need real weights; random weights always run eager
+    model_manager = manager_class(precision=args.precision, backend='torch', profile=args.profile)
+    device = model_manager.device
+
+    results = {}
+    for resolution in args.resolutions:
+        print(f"CPU steps at {resolution}px", file=sys.stderr)
+        results.update(bench_cpu_steps(resolution, args.iterations, args.warmup, args.seed,
+                                       args.preview_max_side, device))
+
+    if not args.skip_models:
+        model_manager.load_all_models()
+        for working_size in args.vessel_working_sizes:
+            for tile_size in args.vessel_tile_sizes:
+                segmenter = VesselSegmenter(working_size, tile_size, args.vessel_tile_overlap)
+                for batch_size in args.vessel_batch_sizes:
+                    print(f"Vessel inference at {working_size}px, tile {tile_size or 'off'}, "
+                          f"batch {batch_size}", file=sys.stderr)
+                    results.update(bench_vessel(model_manager, batch_size, args.iterations,
+                                                args.warmup, args.seed, segmenter))
+        for mix in mixes:
+            for batch_size in args.batch_sizes:
+                print(f"Cascade '{mix}', batch {batch_size}", file=sys.stderr)
+                results.update(bench_cascade(model_manager, mix, batch_size, args.iterations,
+                                             args.warmup, args.seed))
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "opencv": cv2.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "torch_threads": torch.get_num_threads(),
+            "device": str(device),
+            "weights": "random" if random_weights else "checkpoint",
+            "precision": model_manager.precision,
+            "profile": args.profile,
+            "iterations": args.iterations,
+            "warmup": args.warmup,
+            "seed": args.seed
+        },
+        "results": results,
+        "decode_savings": decode_savings(results, args.resolutions)
+    }
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.min_delta_ms)
+        report["regressions"] = regressions
+        if baseline.get("meta", {}).get("weights") != report["meta"]["weights"]:
+            print("Warning: baseline was recorded with different weights", file=sys.stderr)
+        exit_code = 1 if regressions else 0
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""
+Convert training checkpoints to memory-mappable state dicts
+
+ModelManager converts checkpoints lazily on first load; running this once at
+build or deploy time means no server process ever has to unpickle the full
+training checkpoints.
+
+Usage (from backend/):
+    python -m tools.convert_weights
+"""
+import argparse
+import os
+import time
+
+from models.model_loader import CHECKPOINT_KEYS
+from models.weights import converted_weights_path, convert_checkpoint, is_converted
+from config import MODEL_PATHS, WEIGHTS_CACHE_DIR
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--output-dir', default=WEIGHTS_CACHE_DIR)
+    parser.add_argument('--force', action='store_true', help="re-convert up-to-date files")
+    args = parser.parse_args()
+
+    for name, path_key in CHECKPOINT_KEYS.items():
+        checkpoint_path = MODEL_PATHS[path_key]
+        output_path = converted_weights_path(args.output_dir, name)
+        if not os.path.exists(checkpoint_path):
+            print(f"{name}: checkpoint not found, skipping")
+            continue
+        if not args.force and is_converted(checkpoint_path, output_path):
+            print(f"{name}: up to date")
+            continue
+        start = time.perf_counter()
+        convert_checkpoint(checkpoint_path, output_path)
+        print(f"{name}: converted to {output_path} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Export the vessel and cascade checkpoints to ONNX or TorchScript
+
+The exported graphs are loaded by ModelManager when MODEL_BACKEND is set to
+'onnx' or 'torchscript'. All graphs are exported in fp32 with a dynamic batch
+axis; the vessel graph also has dynamic spatial axes.
+
+Usage (from backend/):
+    python -m tools.export_models --format onnx
+    python -m tools.export_models --format torchscript --models stage1 stage2
+"""
+import argparse
+import os
+
+import torch
+
+from models.vessel_model import AttentionUNet
+from models.classification_model import DualStreamConvNeXtModel
+from models.graph_backend import exported_model_path, load_exported_model
+from models.model_loader import CHECKPOINT_KEYS
+from config import MODEL_PATHS, EXPORT_DIR
+
+CLASSIFIER_OUTPUTS = ['main_logits', 'aux_logits', 'fused_features', 'attn_weights']
+
+
+def load_eager_model(name):
+    if name == 'vessel':
+        model = AttentionUNet(in_channels=1, out_channels=1)
+    else:
+        model = DualStreamConvNeXtModel(num_classes=2)
+    checkpoint = torch.load(MODEL_PATHS[CHECKPOINT_KEYS[name]], map_location='cpu', weights_only=False)
+    model.load_state_dict(checkpoint['model_state_dict'])
+    return model.eval()
+
+
+def export_model(name, export_format, output_dir, opset):
+    model = load_eager_model(name)
+    path = exported_model_path(output_dir, name, export_format)
+
+    if name == 'vessel':
+        example_inputs = (torch.randn(1, 1, 1024, 1024),)
+        input_names = ['input']
+        output_names = ['logits']
+        dynamic_axes = {
+            'input': {0: 'batch', 2: 'height', 3: 'width'},
+            'logits': {0: 'batch', 2: 'height', 3: 'width'}
+        }
+    else:
+        example_inputs = (torch.randn(2, 1, 288, 288), torch.randn(2, 1, 288, 288))
+        input_names = ['vessel', 'green']
+        output_names = CLASSIFIER_OUTPUTS
+        dynamic_axes = {axis_name: {0: 'batch'} for axis_name in input_names + output_names}
+
+    with torch.no_grad():
+        if export_format == 'onnx':
+            torch.onnx.export(
+                model, example_inputs, path,
+                input_names=input_names,
+                output_names=output_names,
+                dynamic_axes=dynamic_axes,
+                opset_version=opset,
+                do_constant_folding=True
+            )
+        else:
+            traced = torch.jit.trace(model, example_inputs)
+            traced = torch.jit.freeze(traced)
+            traced.save(path)
+
+    return path, model, example_inputs
+
+
+def max_export_error(name, export_format, output_dir, model, example_inputs):
+    """Largest absolute difference between the eager and exported primary outputs"""
+    exported = load_exported_model(output_dir, name, export_format, torch.device('cpu'))
+    with torch.no_grad():
+        expected = model(*example_inputs)
+        actual = exported(*example_inputs)
+    if isinstance(expected, tuple):
+        expected, actual = expected[0], actual[0]
+    return float((expected - actual).abs().max())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--format', required=True, choices=['onnx', 'torchscript'])
+    parser.add_argument('--models', nargs='+', default=list(CHECKPOINT_KEYS),
+                        choices=list(CHECKPOINT_KEYS))
+    parser.add_argument('--output-dir', default=EXPORT_DIR)
+    parser.add_argument('--opset', type=int, default=17)
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for name in args.models:
+        if not os.path.exists(MODEL_PATHS[CHECKPOINT_KEYS[name]]):
+            print(f"{name}: checkpoint not found, skipping")
+            continue
+        path, model, example_inputs = export_model(name, args.format, args.output_dir, args.opset)
+        error = max_export_error(name, args.format, args.output_dir, model, example_inputs)
+        print(f"{name}: exported to {path} (max abs error vs eager: {error:.2e})")
+
+
+if __name__ == '__main__':
+    main()
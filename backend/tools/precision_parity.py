@@ -0,0 +1,216 @@
+"""
+Accuracy-parity check for reduced-precision and compiled inference
+
+Runs the full pipeline on a sample set of fundus images with the reference
+configuration (fp32, deterministic profile, whole-image 1024px segmentation)
+and with the requested precision mode, inference profile and/or vessel
+segmentation mode (working resolution, tiling), then reports grade
+agreement, per-stage maximum probability drift and vessel mask agreement.
+
+The performance profile (torch.compile, channels_last, autotuned cuDNN) is
+not bit-exact: fused kernels reorder floating-point reductions, so expect
+small probability drift and identical grades except for images sitting on a
+decision threshold. Keep the deterministic profile for audit runs.
+
+With --precision int8 the classifiers are quantized dynamically (every
+Linear layer, attention projections included; `int8_coverage` reports the
+counts per model). The vessel U-Net is quantized statically only with
+--calibration-images (default: QUANT_CALIBRATION_DIR) and otherwise stays
+in fp32, which the report shows under `model_precisions`.
+
+Usage (from backend/):
+    python -m tools.precision_parity --images /path/to/samples --precision int8 \
+        --calibration-images /path/to/calibration
+    python -m tools.precision_parity --images /path/to/samples --profile performance
+    python -m tools.precision_parity --images /path/to/samples --vessel-working-size 768
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from models.model_loader import ModelManager
+from models.performance import PROFILES, configure_backends
+from models.quantization import int8_coverage
+from services.cascade_inference import cascade_classify_batch, run_cascade_stage
+from services.preprocessing import preprocess_for_vessel, classifier_inputs_from_vessel
+from services.vessel_inference import VesselSegmenter, segment_vessel_input
+from config import STAGE1_THRESHOLD, QUANT_CALIBRATION_DIR
+
+CASCADE_STAGES = ('stage1', 'stage2', 'stage3a', 'stage3b')
+
+
+def load_images(directory, limit):
+    images = []
+    for filename in sorted(os.listdir(directory)):
+        image_bgr = cv2.imread(os.path.join(directory, filename), cv2.IMREAD_COLOR)
+        if image_bgr is None:
+            continue
+        images.append((filename, cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)))
+        if len(images) >= limit:
+            break
+    return images
+
+
+def collect_probabilities(model_manager, images, batch_size, segmenter=None):
+    """
+    Run segmentation and every cascade stage on every image
+
+    All four stages see all images (not only the ones routed to them) so the
+    drift covers each model's full input distribution. Deeper stages are
+    unloaded after use to keep at most two classifiers resident.
+    """
+    masks = []
+    vessel_inputs = []
+    green_inputs = []
+    for _, image_rgb in images:
+        input_tensor, original_size = preprocess_for_vessel(image_rgb)
+        segmentation = segment_vessel_input(
+            input_tensor, original_size, model_manager.vessel_model, model_manager.device,
+            segmenter=segmenter
+        )
+        vessel_input, green_input = classifier_inputs_from_vessel(
+            input_tensor, segmentation.mask, model_manager.device
+        )
+        masks.append(segmentation.mask)
+        vessel_inputs.append(vessel_input)
+        green_inputs.append(green_input)
+
+    vessel_batch = torch.cat(vessel_inputs).to(model_manager.device)
+    green_batch = torch.cat(green_inputs).to(model_manager.device)
+
+    probabilities = {}
+    for stage in CASCADE_STAGES:
+        probabilities[stage] = torch.cat([
+            run_cascade_stage(model_manager, stage,
+                              vessel_batch[start:start + batch_size],
+                              green_batch[start:start + batch_size])
+            for start in range(0, len(images), batch_size)
+        ])
+        if stage != 'stage1':
+            model_manager.unload_model(stage)
+
+    return masks, probabilities
+
+
+def grades_from_probabilities(model_manager, probabilities, stage1_threshold):
+    # Feed row indices through the cascade in place of images so the routing
+    # logic stays the one in cascade_classify_batch
+    num_images = probabilities['stage1'].shape[0]
+    rows = torch.arange(num_images, dtype=torch.float32).view(num_images, 1)
+
+    def lookup(stage, row_ids, _):
+        return probabilities[stage][row_ids.view(-1).long()]
+
+    results = cascade_classify_batch(rows, rows, model_manager, stage1_threshold,
+                                     run_stage=lookup)
+    return [result["grade"] for result in results]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--images', required=True, help="directory of sample fundus images")
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'int8', 'bf16'])
+    parser.add_argument('--profile', default='deterministic', choices=PROFILES)
+    parser.add_argument('--calibration-images', default=QUANT_CALIBRATION_DIR,
+                        help="images that calibrate the INT8 vessel model (default: "
+                             "QUANT_CALIBRATION_DIR); without them it stays fp32")
+    parser.add_argument('--vessel-working-size', type=int, default=1024)
+    parser.add_argument('--vessel-tile-size', type=int, default=0, help="0 runs the whole image")
+    parser.add_argument('--vessel-tile-overlap', type=int, default=64)
+    parser.add_argument('--limit', type=int, default=64, help="maximum number of images")
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--output', help="optional path for the JSON report")
+    args = parser.parse_args()
+
+    segmenter = VesselSegmenter(args.vessel_working_size, args.vessel_tile_size,
+                                args.vessel_tile_overlap)
+    default_segmentation = segmenter.working_size == 1024 and not segmenter.tile_size
+    if args.precision == 'fp32' and args.profile == 'deterministic' and default_segmentation:
+        sys.exit("Nothing to compare: choose a reduced --precision, --profile performance "
+                 "or a vessel segmentation mode")
+    label = args.precision if args.profile == 'deterministic' else f"{args.precision}-{args.profile}"
+    if segmenter.working_size != 1024:
+        label += f"-working{segmenter.working_size}"
+    if segmenter.tile_size:
+        label += f"-tile{segmenter.tile_size}"
+
+    images = load_images(args.images, args.limit)
+    if not images:
+        sys.exit(f"No readable images in {args.images}")
+
+    candidate = ModelManager(precision=args.precision, profile=args.profile,
+                             vessel_input_size=segmenter.model_input_size,
+                             calibration_dir=args.calibration_images)
+    if args.precision != 'fp32' and candidate.precision == 'fp32':
+        sys.exit(f"Precision '{args.precision}' is not available on this device")
+    reference = ModelManager(precision='fp32', profile='deterministic')
+
+    timings = {}
+    outputs = {}
+    coverage = {}
+    runs = (('fp32', reference, None), (label, candidate, segmenter))
+    for run_label, model_manager, run_segmenter in runs:
+        # cuDNN flags are process-wide, so switch them with each run
+        configure_backends(model_manager.profile)
+        model_manager.load_all_models()
+        if model_manager is candidate and args.precision == 'int8':
+            coverage = {
+                name: int8_coverage(model) for name, model in candidate.resident_models().items()
+                if name != 'vessel'
+            }
+        start = time.perf_counter()
+        outputs[run_label] = collect_probabilities(model_manager, images, args.batch_size,
+                                                   segmenter=run_segmenter)
+        timings[run_label] = time.perf_counter() - start
+
+    reference_masks, reference_probs = outputs['fp32']
+    candidate_masks, candidate_probs = outputs[label]
+
+    reference_grades = grades_from_probabilities(reference, reference_probs, STAGE1_THRESHOLD)
+    candidate_grades = grades_from_probabilities(candidate, candidate_probs, STAGE1_THRESHOLD)
+
+    report = {
+        "precision": args.precision,
+        "profile": args.profile,
+        "vessel_working_size": segmenter.working_size,
+        "vessel_tile_size": segmenter.tile_size or None,
+        "model_precisions": candidate.model_precisions,
+        "int8_coverage": coverage or None,
+        "compiled_models": sorted(candidate.compiled),
+        "num_images": len(images),
+        "grade_agreement": float(np.mean(
+            [a == b for a, b in zip(reference_grades, candidate_grades)]
+        )),
+        "max_probability_drift": {
+            stage: float((candidate_probs[stage] - reference_probs[stage]).abs().max())
+            for stage in CASCADE_STAGES
+        },
+        "mean_probability_drift": {
+            stage: float((candidate_probs[stage] - reference_probs[stage]).abs().mean())
+            for stage in CASCADE_STAGES
+        },
+        "vessel_mask_agreement": float(np.mean(
+            [np.mean(a == b) for a, b in zip(reference_masks, candidate_masks)]
+        )),
+        "seconds": timings,
+        "disagreements": [
+            {"image": name, "fp32_grade": a, f"{label}_grade": b}
+            for (name, _), a, b in zip(images, reference_grades, candidate_grades)
+            if a != b
+        ]
+    }
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,393 @@
+"""
+Offline bulk screening of fundus image directories and archives
+
+Streams images from a directory or a .tar(.gz/.bz2/.xz) / .zip archive
+through the same pipelined analyzer as the API (parallel decode, batched
+cascade, no base64 artifacts) and writes one row per image to a CSV file or
+to a directory of Parquet part files, optionally saving every vessel mask as
+a 1-bit PNG named by the image's SHA-256.
+
+Progress is checkpointed in a file next to the output: each flush of rows is
+followed by appending the content hashes of those images. A rerun with the
+same output skips every file whose hash is already recorded, so an
+interrupted run resumes where it stopped. Rows are written before their
+hashes, so a crash can at worst repeat the rows of the last unfinished flush.
+
+A file whose content was already screened (a duplicate within the source,
+or of an earlier run) is not analyzed again: its row carries only its name,
+hash and `duplicate_of`, the name of the first file with that content, whose
+row holds the result.
+
+With --streams N, N analysis streams share the source and a micro-batch
+scheduler merges their vessel and cascade forward passes.
+
+Usage (from backend/):
+    python -m tools.screen /data/archive.tar --output results.csv
+    python -m tools.screen /data/fundus --output results/ --format parquet --masks masks/
+"""
+import argparse
+import csv
+import hashlib
+import os
+import sys
+import tarfile
+import threading
+import time
+import uuid
+import zipfile
+
+import torch
+
+from models.model_loader import ModelManager
+from services.analysis import ImageAnalyzer
+from services.artifacts import encode_binary_mask_png
+from services.batch_scheduler import MicroBatchScheduler
+from services.quality import QualityGate, QUALITY_GATE_MODES
+from services.vessel_inference import VesselSegmenter
+from config import (
+    allowed_file, STAGE1_THRESHOLD, CASCADE_BATCH_SIZE, REDUCED_DECODE, QUALITY_GATE,
+    QUALITY_GATE_THRESHOLDS,
+    VESSEL_WORKING_SIZE, VESSEL_TILE_SIZE, VESSEL_TILE_OVERLAP, VESSEL_TILE_BATCH_SIZE
+)
+
+COLUMNS = (
+    'name', 'sha256', 'grade', 'severity', 'has_dr', 'confidence',
+    'stage1_result', 'stage2_result', 'stage3_result', 'processing_time', 'quality_issues', 'mask',
+    'error', 'duplicate_of'
+)
+CLASSIFICATION_COLUMNS = (
+    'grade', 'severity', 'has_dr', 'confidence', 'stage1_result', 'stage2_result', 'stage3_result'
+)
+
+
+def iter_directory(path):
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for filename in sorted(files):
+            if allowed_file(filename):
+                file_path = os.path.join(root, filename)
+                with open(file_path, 'rb') as f:
+                    yield os.path.relpath(file_path, path), f.read()
+
+
+def iter_tar(path):
+    # Stream mode reads members sequentially, so compressed archives are never seeked
+    with tarfile.open(path, 'r|*') as archive:
+        for member in archive:
+            if member.isfile() and allowed_file(member.name):
+                yield member.name, archive.extractfile(member).read()
+
+
+def iter_zip(path):
+    with zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            if not info.is_dir() and allowed_file(info.filename):
+                yield info.filename, archive.read(info)
+
+
+def iter_source(path):
+    """Yield (name, bytes) for every image file in a directory, tar or zip archive"""
+    if os.path.isdir(path):
+        return iter_directory(path)
+    if zipfile.is_zipfile(path):
+        return iter_zip(path)
+    if tarfile.is_tarfile(path):
+        return iter_tar(path)
+    raise ValueError(f"{path} is not a directory, tar or zip archive")
+
+
+class Progress:
+    """Append-only log of processed content hashes: one `sha256<TAB>status<TAB>name` line each"""
+    def __init__(self, path, retry_errors=False):
+        # Hash -> name of the file it was screened as; duplicates are kept
+        # apart so a recorded duplicate never marks its original as done
+        self.done = {}
+        self.duplicates = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) != 3:
+                        continue
+                    sha256, status, name = fields
+                    if status == 'duplicate':
+                        self.duplicates.add((sha256, name))
+                    elif not (retry_errors and status == 'error'):
+                        self.done[sha256] = name
+        self.file = open(path, 'a')
+
+    def __contains__(self, sha256):
+        return sha256 in self.done
+
+    def screened_as(self, sha256):
+        return self.done[sha256]
+
+    def recorded(self, sha256, name):
+        return self.done.get(sha256) == name or (sha256, name) in self.duplicates
+
+    def record(self, rows):
+        for row in rows:
+            if row.get('duplicate_of'):
+                status = 'duplicate'
+                self.duplicates.add((row['sha256'], row['name']))
+            else:
+                status = 'error' if row['error'] else 'ok'
+                self.done[row['sha256']] = row['name']
+            self.file.write(f"{row['sha256']}\t{status}\t{row['name']}\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class CsvWriter:
+    def __init__(self, path):
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.DictWriter(self.file, COLUMNS)
+        if new_file:
+            self.writer.writeheader()
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    """
+    Writes every flush as its own part file
+
+    A Parquet file is only readable once its footer is written, so appending
+    row groups to one file would lose a whole interrupted run; each part is
+    written to a temporary name and renamed into place instead.
+    """
+    def __init__(self, directory):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError("--format parquet requires the pyarrow package") from e
+        self.pq = pq
+        self.pa = pa
+        self.schema = pa.schema([
+            ('name', pa.string()), ('sha256', pa.string()), ('grade', pa.int64()),
+            ('severity', pa.string()), ('has_dr', pa.bool_()), ('confidence', pa.float64()),
+            ('stage1_result', pa.string()), ('stage2_result', pa.string()),
+            ('stage3_result', pa.string()), ('processing_time', pa.float64()),
+            ('quality_issues', pa.string()), ('mask', pa.string()), ('error', pa.string()),
+            ('duplicate_of', pa.string())
+        ])
+        self.directory = directory
+        self.run_id = time.strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:6]
+        self.sequence = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, rows):
+        path = os.path.join(self.directory, f"part-{self.run_id}-{self.sequence:05d}.parquet")
+        self.sequence += 1
+        table = self.pa.Table.from_pylist(rows, schema=self.schema)
+        self.pq.write_table(table, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    def close(self):
+        pass
+
+
+class Screening:
+    """Feeds the analyzer from a source, skipping known hashes, and flushes rows in batches"""
+    def __init__(self, source, progress, writer, flush_every):
+        self.source = source
+        self.progress = progress
+        self.writer = writer
+        self.flush_every = flush_every
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.names = {}
+        # Hash -> name of the first file with that content in this run
+        self.seen = {}
+        self.rows = []
+        self.counts = {"screened": 0, "skipped": 0, "duplicates": 0, "errors": 0}
+        self.started = time.perf_counter()
+
+    def images(self):
+        """Thread-safe (image_id, bytes) iterator shared by every analysis stream"""
+        while not self.stop.is_set():
+            with self.lock:
+                item = next(self.source, None)
+                if item is None:
+                    return
+                name, image_bytes = item
+                sha256 = hashlib.sha256(image_bytes).hexdigest()
+                if self.progress.recorded(sha256, name):
+                    self.counts["skipped"] += 1
+                    continue
+                if sha256 in self.progress or sha256 in self.seen:
+                    first = self.seen.get(sha256) or self.progress.screened_as(sha256)
+                    self._add_row(self._duplicate_row(name, sha256, first))
+                    self.counts["duplicates"] += 1
+                    continue
+                self.seen[sha256] = name
+                self.names[sha256] = name
+            yield sha256, image_bytes
+
+    def _duplicate_row(self, name, sha256, first):
+        row = dict.fromkeys(COLUMNS)
+        row.update({"name": name, "sha256": sha256, "duplicate_of": first})
+        return row
+
+    def add(self, result):
+        sha256 = result["image_id"]
+        classification = result.get("classification") or {}
+        row = {column: classification.get(column) for column in CLASSIFICATION_COLUMNS}
+        quality = result.get("quality")
+        row.update({
+            "quality_issues": ';'.join(quality["issues"]) if quality else None,
+            "sha256": sha256,
+            "processing_time": result.get("processing_time"),
+            "mask": result.get("mask"),
+            "error": result.get("error"),
+            "duplicate_of": None
+        })
+        with self.lock:
+            row["name"] = self.names.pop(sha256)
+            self.counts["screened"] += 1
+            if row["error"]:
+                self.counts["errors"] += 1
+            self._add_row(row)
+
+    def _add_row(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.flush_every:
+            self._flush()
+            self.report()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.rows:
+            return
+        self.writer.write(self.rows)
+        self.progress.record(self.rows)
+        self.rows = []
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        print(f"{self.counts['screened']} screened ({self.counts['screened'] / elapsed:.2f}/s), "
+              f"{self.counts['skipped']} skipped, {self.counts['duplicates']} duplicates, "
+              f"{self.counts['errors']} errors", file=sys.stderr)
+
+
+def mask_renderer(mask_dir):
+    """Encode-stage hook: write the full-resolution mask instead of base64 artifacts"""
+    def render(image_id, image_bytes, image_rgb, segmentation, compact):
+        result = {"image_id": image_id}
+        if mask_dir is not None:
+            path = os.path.join(mask_dir, f"{image_id}.png")
+            with open(path, 'wb') as f:
+                f.write(encode_binary_mask_png(segmentation.full_mask()))
+            result["mask"] = path
+        return result
+    return render
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('source', help="directory, tar or zip archive of fundus images")
+    parser.add_argument('--output', required=True,
+                        help="CSV file, or directory of part files for --format parquet")
+    parser.add_argument('--format', default='csv', choices=['csv', 'parquet'])
+    parser.add_argument('--masks', help="directory to write vessel masks to (1-bit PNG)")
+    parser.add_argument('--progress', help="checkpoint file (default: <output>.progress)")
+    parser.add_argument('--retry-errors', action='store_true',
+                        help="screen again images that failed in an earlier run")
+    parser.add_argument('--batch-size', type=int, default=CASCADE_BATCH_SIZE,
+                        help="images per cascade forward pass")
+    parser.add_argument('--streams', type=int, default=1,
+                        help="concurrent analysis streams sharing micro-batched models")
+    parser.add_argument('--decode-workers', type=int, default=max(2, min(8, os.cpu_count() or 1)))
+    parser.add_argument('--encode-workers', type=int, default=2)
+    parser.add_argument('--queue-size', type=int, default=16)
+    parser.add_argument('--flush-every', type=int, default=256, help="rows per checkpoint")
+    parser.add_argument('--threads', type=int, help="torch intra-op threads")
+    parser.add_argument('--quality-gate', default=QUALITY_GATE, choices=QUALITY_GATE_MODES,
+                        help="flag ungradable images, or reject them before any model runs")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.masks:
+        os.makedirs(args.masks, exist_ok=True)
+    progress_path = args.progress or args.output.rstrip(os.sep) + '.progress'
+
+    # Open the outputs first so a missing optional dependency fails before models load
+    writer = ParquetWriter(args.output) if args.format == 'parquet' else CsvWriter(args.output)
+    progress = Progress(progress_path, retry_errors=args.retry_errors)
+
+    segmenter = VesselSegmenter(VESSEL_WORKING_SIZE, VESSEL_TILE_SIZE, VESSEL_TILE_OVERLAP,
+                                VESSEL_TILE_BATCH_SIZE)
+    model_manager = ModelManager(vessel_input_size=segmenter.model_input_size)
+    model_manager.load_all_models()
+    batch_scheduler = None
+    if args.streams > 1:
+        # Each stream submits whole cascade batches, so a merged pass must hold
+        # one from every stream
+        batch_scheduler = MicroBatchScheduler(
+            model_manager, max_batch_size=args.streams * args.batch_size
+        )
+    analyzer = ImageAnalyzer(
+        model_manager,
+        stage1_threshold=STAGE1_THRESHOLD,
+        cascade_batch_size=args.batch_size,
+        batch_scheduler=batch_scheduler,
+        decode_workers=args.decode_workers,
+        encode_workers=args.encode_workers,
+        queue_size=args.queue_size,
+        reduced_decode=REDUCED_DECODE,
+        vessel_segmenter=segmenter,
+        quality_gate=QualityGate(args.quality_gate, **QUALITY_GATE_THRESHOLDS)
+    )
+
+    screening = Screening(iter_source(args.source), progress, writer, args.flush_every)
+    render = mask_renderer(args.masks)
+    failures = []
+
+    def run_stream():
+        try:
+            for _, result in analyzer.analyze(screening.images(), render_artifacts=render):
+                screening.add(result)
+        except Exception as e:
+            failures.append(e)
+            screening.stop.set()
+
+    streams = [threading.Thread(target=run_stream, daemon=True) for _ in range(args.streams)]
+    try:
+        for stream in streams:
+            stream.start()
+        for stream in streams:
+            while stream.is_alive():
+                stream.join(0.5)
+    except KeyboardInterrupt:
+        # Stop feeding new images, let in-flight ones finish and checkpoint them
+        print("Interrupted, finishing images in flight", file=sys.stderr)
+        screening.stop.set()
+        for stream in streams:
+            stream.join()
+    finally:
+        screening.flush()
+        writer.close()
+        progress.close()
+        screening.report()
+
+    if failures:
+        sys.exit(f"Screening stopped: {failures[0]}")
+
+
+if __name__ == '__main__':
+    main()